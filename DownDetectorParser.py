@@ -7,6 +7,24 @@
  - корректный разбор относительных и абсолютных времён
  - создание CSV-файлов с заголовками при первом запуске
  - сохранение в SQLite и в CSV
+ - полнотекстовый поиск по комментариям (SQLite FTS5, search_messages)
+ - словарное хранилище облака тегов с рядами частот (top_words, word_trend, rising_words)
+ - контрольные точки по сервисам и шагам пагинации для возобновления после сбоя
+ - запись в CSV/SQLite в отдельном потоке через ограниченную очередь
+ - CSV с разбиением по дням (и сервисам) и манифестом разделов
+ - перехват ответов пагинации через CDP вместо ожидания и разбора DOM
+ - адаптивное ограничение частоты запросов к каждому хосту
+ - постоянный профиль Chrome с общим дисковым кэшем (CHROME_PROFILE_DIR)
+ - кластеризация почти одинаковых комментариев (MinHash/LSH) с листом clusters в Excel
+ - разбор гистограмм за один проход по HTML без построения дерева
+ - распределение сервисов между процессами/контейнерами через аренду в SQLite (--worker)
+ - остановка пагинации на уже сохранённых сообщениях (id и время последнего сохранённого)
+ - хранение: часовые агрегаты графика, сжатые архивы снимков и сообщений, incremental vacuum (--retention)
+ - HTTP API для чтения: данные по сервису и периоду, пагинация, ETag, кеш ответов, JSON/CSV (--serve)
+ - архив сырых страниц (zstd со словарём, адресация по хешу) и пересборка таблиц из него (--reparse)
+ - надзор за браузером: бюджет времени на сервис, замена зависшего Chrome, перезапуск по страницам и памяти
+ - дозагрузка истории за N дней воркерами по сервисам и диапазонам курсора, с прогрессом и ETA (--backfill)
+ - компактные столбцовые пачки строк (RowBatch) от парсеров до CSV и SQLite без промежуточных копий
  - формирование Excel и отправка в Telegram (если задан токен)
 
 Запуск: python detector404_parser_fixed.py
@@ -14,17 +32,50 @@
 """
 
 import os
+import io
+import sys
+import csv
+import json
+import base64
 import time
 import re
+import queue
+import shutil
+import fcntl
+import threading
 import pytz
 import sqlite3
+import zlib
+import hashlib
+import multiprocessing
+import signal
+import numpy as np
 import pandas as pd
+from array import array
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import groupby
+from operator import itemgetter
 import requests
 import zipfile
-from datetime import datetime
+from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 from bs4 import BeautifulSoup
-from contextlib import closing
+from contextlib import closing, contextmanager
+from urllib.parse import urlsplit, parse_qs
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import zstandard
+except ImportError:  # архив страниц тогда сжимается zlib
+    zstandard = None
+
+try:
+    import psutil
+except ImportError:  # дерево процессов и память браузера тогда читаются из /proc
+    psutil = None
+from html.parser import HTMLParser
 
 from selenium import webdriver
 from selenium.webdriver.firefox.service import Service
@@ -59,19 +110,257 @@ CSV_FILES = {
     "messages": "user_messages.csv",
 }
 CSV_FILES = {k: os.path.join(BASE_DIR, v) for k, v in CSV_FILES.items()}
+CSV_HEADERS = {
+    "graph": ["Компания", "Дата парсинга", "Время", "Жалобы", "Сбои"],
+    "cloud": ["Компания", "Дата парсинга", "Слово", "Частота"],
+    "hist":  ["Компания", "Дата парсинга", "Тип", "Название", "Процент"],
+    "messages": ["Компания", "Дата парсинга", "Время", "Ник", "Комментарий"],
+}
+SQLITE_TABLES = {
+    "graph": "graph_data",
+    "cloud": "cloud_tags",
+    "hist": "histograms",
+    "messages": "user_messages",
+}
 DB_PATH = os.path.join(BASE_DIR, "all_parsed_data.db")
+# Ожидание блокировки SQLite: базу могут одновременно писать несколько воркеров
+SQLITE_TIMEOUT = 60
 
 MSK = pytz.timezone("Europe/Moscow")
 RUN_DATE = datetime.now(MSK).strftime("%Y-%m-%d")
-NOW = datetime.now(MSK)
+NOW = datetime.now(MSK)  # обновляется при каждой загрузке страницы (set_page_time)
+STARTED_AT = NOW
 START_DATE = NOW.date() - relativedelta(days=DAYS_BACK)
 
+# Полнотекстовый поиск по комментариям (SQLite FTS5)
+FTS_ENABLED = True
+FTS_STEMMING = True
+
+# Словарное хранилище облака тегов: целочисленные id слов/компаний и временные ряды частот
+# вместо строк cloud_tags (False — облако пишется в cloud_tags, как раньше)
+CLOUD_SERIES_ENABLED = True
+
+# Контрольные точки обхода: после падения повторный запуск в тот же день продолжает
+# незавершённый обход — пропускает готовые разделы и продолжает пагинацию с сохранённого курсора.
+# Завершённый обход закрывается, и следующий запуск обрабатывает все сервисы заново
+CHECKPOINTS_ENABLED = True
+CHECKPOINT_SECTIONS = ("graph", "cloud", "hist", "messages")
+
+# Запись на диск в отдельном потоке: браузер не ждёт CSV/SQLite.
+# Очередь ограничена — при отставании писателя парсер блокируется (backpressure)
+WRITER_ENABLED = True
+WRITER_QUEUE_SIZE = 64
+
+# CSV по дням: parsed_data/csv/<раздел>/<YYYY-MM-DD>.csv (+ /<сервис>.csv при разбиении по сервисам)
+CSV_PARTITIONED = True
+CSV_PARTITION_BY_SERVICE = False
+CSV_PARTITIONS_DIR = os.path.join(BASE_DIR, "csv")
+CSV_MAX_OPEN_FILES = 64
+CSV_BUFFER_SIZE = 1024 * 1024
+
+# Пагинация сообщений: "dom" — ожидание изменений DOM и разбор всей страницы, "network" —
+# ответы на клик "Показать" перехватываются из performance-лога Chrome (CDP). "network" включается
+# явно: формат ответа пагинации на сайте ещё не проверен, без перехвата он откатывается к DOM
+CAPTURE_MODE = "dom"
+NETWORK_CAPTURE_TIMEOUT = 20
+
+# Ограничение частоты обращений к каждому хосту (token bucket с адаптивным интервалом):
+# интервал растёт при медленных ответах, ошибках и HTTP 429 и постепенно сокращается обратно
+RATE_LIMIT_ENABLED = True
+RATE_LIMIT_START_INTERVAL = 1.0
+RATE_LIMIT_MIN_INTERVAL = 0.5
+RATE_LIMIT_MAX_INTERVAL = 60.0
+RATE_LIMIT_BURST = 2
+RATE_LIMIT_SLOW_SECONDS = 8.0
+RATE_LIMIT_BACKOFF = 2.0
+RATE_LIMIT_RECOVERY = 0.9
+# Состояние вёдер общее для всех процессов (воркеры, дозагрузка): файл под flock.
+# Ведро, которым никто не пользовался RATE_LIMIT_STATE_TTL секунд, начинается заново
+RATE_LIMIT_STATE_PATH = os.path.join(BASE_DIR, "state", "rate_limits.json")
+RATE_LIMIT_STATE_TTL = 600
+
+# Постоянный профиль Chrome с дисковым кэшем между запусками (None — временный профиль).
+# Профиль делится на слоты: одновременно работающие воркеры занимают разные слоты под flock
+CHROME_PROFILE_DIR = os.getenv("CHROME_PROFILE_DIR") or None
+CHROME_PROFILE_SLOTS = 4
+CHROME_PROFILE_WAIT = 300
+CHROME_CACHE_MAX_MB = 300
+
+# Надзор за браузером: жёсткий бюджет времени на сервис (зависший Chrome убивается и заменяется),
+# перезапуск после N загрузок страниц или при превышении RSS всех процессов браузера
+SERVICE_DEADLINE_SECONDS = 900
+BROWSER_PAGE_LOAD_TIMEOUT = 90
+BROWSER_SCRIPT_TIMEOUT = 30
+BROWSER_RECYCLE_PAGES = 50
+BROWSER_RECYCLE_RSS_MB = 1500
+
+# Дозагрузка истории (--backfill DAYS): задания (сервис, диапазон дней) в sweep_jobs,
+# сообщения пишутся крупными пачками в одной транзакции; уже сохранённые (в том числе
+# ежедневными запусками и в архиве) пропускаются по message_id.
+# Окно задания шире диапазона на BACKFILL_OVERLAP_MINUTES с каждой стороны (относительное
+# время на странице неточно). Задание работает не дольше BACKFILL_JOB_SECONDS: затем оно
+# останавливается на контрольной точке и возвращается в очередь без расхода попытки;
+# BACKFILL_DEADLINE_SECONDS — жёсткий срок браузера на задание (вместо SERVICE_DEADLINE_SECONDS)
+BACKFILL_RANGE_DAYS = 1
+BACKFILL_OVERLAP_MINUTES = 90
+BACKFILL_JOB_SECONDS = 1800
+BACKFILL_DEADLINE_SECONDS = 2400
+BACKFILL_MAX_CLICKS = 5000
+BACKFILL_BATCH_ROWS = 2000
+SQLITE_BULK = False  # включается только процессом дозагрузки
+
+# Кластеризация почти одинаковых комментариев (MinHash + LSH) по компании и дню
+NEAR_DUP_ENABLED = True
+NEAR_DUP_NUM_PERM = 64
+NEAR_DUP_BANDS = 16
+NEAR_DUP_THRESHOLD = 0.5
+NEAR_DUP_MAX_SHINGLES = 256
+NEAR_DUP_MAX_CLUSTERS = 5000
+NEAR_DUP_MAX_INDEXES = 32
+
+# Распределение сервисов между процессами/контейнерами через таблицу аренды в SQLite.
+# Воркер берёт сервис в аренду на JOB_LEASE_SECONDS и продлевает её сердцебиением;
+# аренда упавшего воркера истекает, и сервис забирает другой
+JOB_LEASE_SECONDS = 300
+JOB_HEARTBEAT_SECONDS = 30
+JOB_MAX_ATTEMPTS = 3
+JOB_IDLE_POLL_SECONDS = 10
+
+# Пагинация до уже сохранённых сообщений: загружаются id последних HWM_RECENT_IDS
+# сообщений сервиса, и "Показать ещё" прекращается после HWM_OVERLAP знакомых id
+# (или сообщений старше последнего сохранённого на HWM_OVERLAP_MINUTES)
+HWM_ENABLED = True
+HWM_RECENT_IDS = 200
+HWM_OVERLAP = 3
+HWM_OVERLAP_MINUTES = 90
+
+# Хранение в SQLite: сырые точки графика старше N дней сворачиваются в часовые агрегаты,
+# снимки облака/гистограмм и сообщения уходят в сжатые архивные таблицы (None — хранить всё)
+# RETENTION_ON_RUN — запускать хранение после обычного обхода, но не чаще раза в RETENTION_INTERVAL_HOURS
+# (--retention выполняет его всегда); кластеры похожих сообщений живут столько же, сколько сами сообщения
+RETENTION_ON_RUN = True
+RETENTION_INTERVAL_HOURS = 24 * 7
+RETENTION_GRAPH_RAW_DAYS = 30
+RETENTION_CLOUD_DAYS = 90
+RETENTION_HIST_DAYS = 90
+RETENTION_MESSAGES_DAYS = 60
+RETENTION_ARCHIVE_SNAPSHOTS = True
+RETENTION_BOOKKEEPING_DAYS = 14
+RETENTION_VACUUM_PAGES = 5000
+
+# HTTP API только для чтения поверх SQLite (--serve)
+API_HOST = os.getenv("DD_API_HOST", "127.0.0.1")
+API_PORT = int(os.getenv("DD_API_PORT", "8765"))
+API_DEFAULT_LIMIT = 1000
+API_MAX_LIMIT = 10000
+API_CACHE_ENTRIES = 256
+API_CACHE_MAX_BYTES = 2 * 1024 * 1024
+
+# Архив сырых страниц: итоговый HTML сервиса и данные графика/облака, сжатые zstd со словарём
+# (без пакета zstandard — zlib); --reparse пересобирает таблицы из архива без браузера.
+# Лежит в подкаталоге BASE_DIR: в ZIP для Telegram попадают только файлы верхнего уровня
+ARCHIVE_ENABLED = True
+ARCHIVE_DB_PATH = os.path.join(BASE_DIR, "archive", "raw_archive.db")
+ARCHIVE_RETENTION_DAYS = 365  # None — хранить снимки бессрочно
+ARCHIVE_ZSTD_LEVEL = 10
+ARCHIVE_DICT_SIZE = 112 * 1024
+ARCHIVE_DICT_MIN_SAMPLES = 30
+ARCHIVE_DICT_MAX_SAMPLES = 300
+ARCHIVE_REPARSE_WORKERS = None  # None — по числу ядер
+
+
+# ===================== КОМПАКТНЫЕ ПАЧКИ СТРОК =====================
+
+@lru_cache(maxsize=4096)
+def _msk_offset(hour):
+    """Смещение MSK от UTC в секундах для часа hour (часов от эпохи)"""
+    return int(datetime.fromtimestamp(hour * 3600, MSK).utcoffset().total_seconds())
+
+
+@lru_cache(maxsize=4096)
+def _day_string(day):
+    return sys.intern((datetime(1970, 1, 1) + timedelta(days=day)).strftime("%Y-%m-%d"))
+
+
+def ts_date_time(ts):
+    """unix-время -> ("YYYY-MM-DD", "HH:MM:SS") в MSK; строка даты одна на день для всех строк"""
+    local = ts + _msk_offset(ts // 3600)
+    secs = local % 86400
+    return _day_string(local // 86400), f"{secs // 3600:02d}:{secs // 60 % 60:02d}:{secs % 60:02d}"
+
+
+class RowBatch:
+    """Столбцовая пачка строк одного вида (graph / cloud / hist / messages) одного сервиса.
+
+    Сервис и дата запуска хранятся один раз на пачку, момент времени — целыми секундами
+    в array("q"), числа — в array("q"/"d"), строки — в списках (повторяющиеся значения
+    интернируются). Итерация отдаёт кортежи в порядке колонок CSV/SQLite (у messages —
+    ещё message_id и cluster_id), поэтому приёмники принимают и пачку, и список строк.
+    """
+    __slots__ = ("kind", "service", "run_date", "columns")
+
+    # вид -> колонки (имя, код array или None для списка)
+    SCHEMAS = {
+        "graph": (("ts", "q"), ("complaints", "q"), ("failures", "d")),
+        "cloud": (("word", None), ("frequency", "d")),
+        "hist": (("type", None), ("name", None), ("percent", "d")),
+        "messages": (("ts", "q"), ("nickname", None), ("comment", None), ("message_id", None), ("cluster_id", None)),
+    }
+    INTERNED = ("word", "type", "nickname")
+
+    def __init__(self, kind, service, run_date=None):
+        self.kind = kind
+        self.service = sys.intern(service)
+        self.run_date = sys.intern(run_date or RUN_DATE)
+        self.columns = self._empty()
+
+    def _empty(self):
+        return {name: array(code) if code else [] for name, code in self.SCHEMAS[self.kind]}
+
+    def append(self, *values):
+        for (name, _), value in zip(self.SCHEMAS[self.kind], values):
+            if name in self.INTERNED and value is not None:
+                value = sys.intern(value)
+            self.columns[name].append(value)
+
+    def __len__(self):
+        return len(next(iter(self.columns.values())))
+
+    def __iter__(self):
+        service, run_date, c = self.service, self.run_date, self.columns
+        if self.kind == "graph":
+            for ts, complaints, failures in zip(c["ts"], c["complaints"], c["failures"]):
+                day, clock = ts_date_time(ts)
+                yield service, day, clock, complaints, failures
+        elif self.kind == "cloud":
+            for word, frequency in zip(c["word"], c["frequency"]):
+                yield service, run_date, word, frequency
+        elif self.kind == "hist":
+            for kind, name, percent in zip(c["type"], c["name"], c["percent"]):
+                yield service, run_date, kind, name, percent
+        else:
+            for ts, nick, comment, mid, cluster_id in zip(
+                    c["ts"], c["nickname"], c["comment"], c["message_id"], c["cluster_id"]):
+                day, clock = ts_date_time(ts)
+                yield service, day, clock, nick, comment, mid, cluster_id
+
+    def take(self):
+        """Передача накопленных строк новой пачке (без копирования), эта пачка становится пустой"""
+        taken = RowBatch(self.kind, self.service, self.run_date)
+        taken.columns, self.columns = self.columns, self._empty()
+        return taken
+
+    def clear(self):
+        self.columns = self._empty()
+
 
 # ===================== SQLITE HELPERS =====================
 
 def init_sqlite_tables():
     """Инициализация таблиц SQLite один раз при запуске"""
-    with sqlite3.connect(DB_PATH) as conn:
+    with sqlite3.connect(DB_PATH, timeout=SQLITE_TIMEOUT) as conn:
+        # WAL: читатели не блокируют писателей, несколько процессов пишут по очереди без ошибок блокировки
+        conn.execute("PRAGMA journal_mode=WAL")
         cursor = conn.cursor()
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS graph_data (
@@ -112,14 +401,134 @@ def init_sqlite_tables():
                 comment TEXT
             )
         ''')
+        ensure_column(conn, "user_messages", "message_id", "TEXT")
+        ensure_column(conn, "user_messages", "cluster_id", "TEXT")
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_user_messages_company_message_id "
+            "ON user_messages (company, message_id)"
+        )
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS message_clusters (
+                company TEXT,
+                cluster_date TEXT,
+                cluster_id TEXT,
+                size INTEGER,
+                representative TEXT,
+                first_time TEXT,
+                last_time TEXT,
+                PRIMARY KEY (company, cluster_date, cluster_id)
+            )
+        ''')
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_user_messages_company_date "
+            "ON user_messages (company, message_date)"
+        )
+        # Задача хранения выбирает строки по дате без компании (message_date < cutoff, parse_date = ?)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_messages_date ON user_messages (message_date)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_graph_data_date ON graph_data (parse_date)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_cloud_tags_date ON cloud_tags (parse_date)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_histograms_date ON histograms (parse_date)")
+        if FTS_ENABLED:
+            init_messages_fts(conn)
+        if CLOUD_SERIES_ENABLED:
+            init_cloud_series(conn)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sweeps (
+                sweep_id TEXT PRIMARY KEY,
+                kind TEXT,
+                started_at TEXT,
+                finished_at TEXT,
+                messages_max_id INTEGER
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sweep_checkpoints (
+                sweep_id TEXT,
+                service TEXT,
+                section TEXT,
+                done INTEGER DEFAULT 0,
+                last_cursor TEXT,
+                last_message_id TEXT,
+                messages_saved INTEGER DEFAULT 0,
+                updated_at TEXT,
+                PRIMARY KEY (sweep_id, service, section)
+            )
+        ''')
+        rename_column(conn, "sweep_checkpoints", "run_date", "sweep_id")
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS graph_data_hourly (
+                company TEXT,
+                hour TEXT,
+                points INTEGER,
+                complaints_sum INTEGER,
+                complaints_max INTEGER,
+                failures_sum REAL,
+                PRIMARY KEY (company, hour)
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS snapshots_archive (
+                table_name TEXT,
+                company TEXT,
+                parse_date TEXT,
+                rows INTEGER,
+                payload BLOB,
+                PRIMARY KEY (table_name, company, parse_date)
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_messages_archive (
+                company TEXT,
+                message_date TEXT,
+                rows INTEGER,
+                payload BLOB,
+                PRIMARY KEY (company, message_date)
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS retention_runs (
+                finished_at TEXT,
+                report TEXT
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sweep_jobs (
+                sweep_id TEXT,
+                service TEXT,
+                state TEXT DEFAULT 'pending',
+                owner TEXT,
+                lease_expires REAL,
+                heartbeat_at REAL,
+                attempts INTEGER DEFAULT 0,
+                error TEXT,
+                PRIMARY KEY (sweep_id, service)
+            )
+        ''')
         conn.commit()
 
 
+def ensure_column(conn, table, column, decl):
+    """Добавление колонки в существующую таблицу (миграция баз прошлых версий)"""
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+def rename_column(conn, table, old, new):
+    """Переименование колонки существующей таблицы (миграция баз прошлых версий)"""
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+    if old in columns and new not in columns:
+        conn.execute(f"ALTER TABLE {table} RENAME COLUMN {old} TO {new}")
+
+
 def append_to_sqlite(table_name, data):
     """Добавление данных в SQLite порциями"""
     if not data:
         return
-    with sqlite3.connect(DB_PATH) as conn:
+    with sqlite3.connect(DB_PATH, timeout=SQLITE_TIMEOUT) as conn:
+        if SQLITE_BULK:
+            # Дозагрузка истории: в WAL без fsync на каждый коммит, но без риска повредить общую базу
+            conn.execute("PRAGMA synchronous=NORMAL")
         cursor = conn.cursor()
         if table_name == "graph_data":
             cursor.executemany(
@@ -137,144 +546,2618 @@ def append_to_sqlite(table_name, data):
                 data
             )
         elif table_name == "user_messages":
-            cursor.executemany(
-                "INSERT INTO user_messages (company, message_date, message_time, nickname, comment) VALUES (?, ?, ?, ?, ?)",
-                data
-            )
+            rows = data if isinstance(data, RowBatch) else [(list(row) + [None, None])[:7] for row in data]
+            if SQLITE_BULK:
+                # Окна соседних заданий дозагрузки перекрываются и могут выполняться одновременно:
+                # сообщение, уже записанное другим заданием, не вставляется повторно
+                cursor.executemany(
+                    "INSERT INTO user_messages (company, message_date, message_time, nickname, comment, "
+                    "message_id, cluster_id) SELECT ?1, ?2, ?3, ?4, ?5, ?6, ?7 WHERE ?6 IS NULL OR NOT EXISTS "
+                    "(SELECT 1 FROM user_messages WHERE company = ?1 AND message_id = ?6)",
+                    rows
+                )
+            else:
+                cursor.executemany(
+                    "INSERT INTO user_messages (company, message_date, message_time, nickname, comment, "
+                    "message_id, cluster_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    rows
+                )
+            if FTS_ENABLED:
+                sync_messages_fts(conn)
         conn.commit()
 
 
-def append_to_csv(csv_path, data, headers):
-    """Добавление данных в CSV файл порциями"""
-    if not data:
-        return
-    df = pd.DataFrame(data, columns=headers)
-    if os.path.exists(csv_path):
-        df.to_csv(csv_path, mode='a', header=False, index=False, sep=';', encoding='utf-8-sig')
-    else:
-        df.to_csv(csv_path, index=False, sep=';', encoding='utf-8-sig')
+# ===================== ПОЛНОТЕКСТОВЫЙ ПОИСК =====================
 
+RU_WORD_RE = re.compile(r"[0-9a-zа-яё]+", re.IGNORECASE)
 
-# ===================== HELPERS =====================
+# Окончания для облегчённого русского стемминга (в духе Snowball), длинные — первыми
+RU_ENDINGS = sorted({
+    "ившись", "ывшись", "вшись", "ующая", "ующий", "ующие", "ующих", "ующее",
+    "ировать", "ировал", "ость", "ости", "остью", "остей", "ами", "ями", "иями",
+    "ого", "его", "ому", "ему", "ыми", "ими", "ешь", "ишь", "ете", "ите",
+    "ует", "уют", "ают", "яют", "ает", "яет", "ила", "ыла", "ена", "ило", "ыло",
+    "ено", "ели", "или", "ыли", "ать", "ять", "ить", "ыть", "еть", "уть",
+    "ов", "ев", "ей", "ой", "ий", "ый", "ая", "яя", "ое", "ее", "ые", "ие", "ом",
+    "ем", "ам", "ям", "ах", "ях", "ую", "юю", "ут", "ют", "ит", "ат", "ят", "ет",
+    "ал", "ял", "ил", "ыл", "ел", "ся", "сь", "ть", "ию", "ия", "ии", "ье", "ья",
+    "а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "й",
+}, key=len, reverse=True)
 
-def ensure_csv_files_exist():
-    """Создать CSV-файлы с заголовками, если их ещё нет — полезно при первом запуске."""
-    headers_map = {
-        "graph": ["Компания", "Дата парсинга", "Время", "Жалобы", "Сбои"],
-        "cloud": ["Компания", "Дата парсинга", "Слово", "Частота"],
-        "hist":  ["Компания", "Дата парсинга", "Тип", "Название", "Процент"],
-        "messages": ["Компания", "Дата парсинга", "Время", "Ник", "Комментарий"],
-    }
-    for key, path in CSV_FILES.items():
-        if not os.path.exists(path):
-            df = pd.DataFrame(columns=headers_map.get(key, []))
-            df.to_csv(path, index=False, sep=';', encoding='utf-8-sig')
 
+def ru_stem(word):
+    """Облегчённый стемминг русского слова: отбрасывает типичное окончание,
+    оставляя основу не короче 3 символов. Латиница и числа не изменяются."""
+    word = word.lower().replace("ё", "е")
+    if not re.search(r"[а-я]", word):
+        return word
+    if word.endswith(("ся", "сь")) and len(word) > 5:
+        word = word[:-2]
+    for ending in RU_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            return word[:-len(ending)]
+    return word
 
-def normalize_percent(value):
-    """Нормализация процентных значений"""
-    if not value:
-        return None
-    value = value.replace("%", "").replace(",", ".").strip()
-    try:
-        return float(value)
-    except ValueError:
+
+def ru_stem_text(text):
+    """Строка основ слов для индексируемой колонки stems"""
+    if not text:
+        return ""
+    return " ".join(ru_stem(w) for w in RU_WORD_RE.findall(text))
+
+
+def fts_company(company):
+    """Префикс токенов компании в колонке scope: "c" + hex имени (только буквы и цифры, без коллизий)"""
+    return "c" + (company or "").encode("utf-8").hex()
+
+
+def fts_scope(company, message_date, comment):
+    """Колонка scope: основы слов, разбитые по компании и месяцу ("<компания>m202610sоплат"),
+    день компании ("<компания>d20261019") и день ("d20261019").
+
+    Поиск с фильтром компании ищет слова среди токенов её месяцев: длина списков строк, которые
+    FTS5 читает для совпадений и для idf в bm25, ограничена объёмом компании за эти месяцы,
+    а не всей таблицей."""
+    company, day = fts_company(company), str(message_date or "").replace("-", "")
+    words = [f"{company}m{day[:6]}s{stem}" for stem in dict.fromkeys(ru_stem_text(comment).split())]
+    return " ".join(words + [f"{company}d{day}", f"d{day}"])
+
+
+def register_fts_functions(conn):
+    """SQL-функции, которыми заполняются колонки stems и scope"""
+    conn.create_function("ru_stem_text", 1, ru_stem_text, deterministic=True)
+    conn.create_function("fts_scope", 3, fts_scope, deterministic=True)
+
+
+def init_messages_fts(conn):
+    """Создание FTS5-индекса по комментариям и догрузка в него уже сохранённых строк.
+
+    Индекс contentless: хранится только инвертированный индекс, сами тексты
+    остаются в user_messages и подтягиваются по rowid = user_messages.id.
+    Индекс прошлых версий без колонки scope пересоздаётся.
+    """
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(user_messages_fts)")]
+    if columns and "scope" not in columns:
+        print("Пересоздание FTS-индекса с колонкой scope (компания, месяц и день)...")
+        conn.execute("DROP TABLE user_messages_fts")
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS user_messages_fts USING fts5(
+            comment,
+            stems,
+            scope,
+            content='',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    ''')
+    sync_messages_fts(conn)
+
+
+def sync_messages_fts(conn):
+    """Инкрементальная синхронизация FTS: индексируются строки user_messages
+    с id больше последнего проиндексированного rowid."""
+    register_fts_functions(conn)
+    row = conn.execute("SELECT rowid FROM user_messages_fts ORDER BY rowid DESC LIMIT 1").fetchone()
+    last_id = row[0] if row else 0
+    conn.execute(
+        "INSERT INTO user_messages_fts (rowid, comment, stems, scope) "
+        "SELECT id, comment, ru_stem_text(comment), fts_scope(company, message_date, comment) "
+        "FROM user_messages WHERE id > ?",
+        (last_id,)
+    )
+
+
+def fts_stem_term(stem, prefix=""):
+    """Терм основы: с префиксным поиском, а основы из 1–2 букв — точно
+    (префикс "не"* совпал бы с «нет», «неделю» и т.п.)"""
+    return f'"{prefix}{stem}"*' if len(stem) > 2 else f'"{prefix}{stem}"'
+
+
+def build_fts_query(query, stemming=FTS_STEMMING):
+    """Преобразование пользовательского запроса в выражение FTS5 MATCH.
+    Все слова должны встречаться в комментарии (AND); при стемминге ищется по основам с префиксом."""
+    words = RU_WORD_RE.findall(query or "")
+    if not words:
         return None
+    if stemming:
+        terms = [fts_stem_term(ru_stem(w)) for w in words]
+        return "stems : (" + " AND ".join(terms) + ")"
+    terms = [f'"{w.lower()}"' for w in words]
+    return "comment : (" + " AND ".join(terms) + ")"
 
 
-def parse_relative_time(text):
-    """Парсинг относительного или абсолютного времени.
-    Поддерживает:
-      - "только что", "25 минут назад", "2 часа назад" и т.п.
-      - абсолютные даты "17.12.2025, 03:46"
-      - числовые метки в миллисекундах (например 1765931314342)
-    Возвращает datetime с таймзоной MSK или None при нераспознавании.
+def fts_date_terms(date_from, date_to, prefix="d"):
+    """Покрытие дней date_from..date_to (включительно) токенами дня колонки scope:
+    целые годы и месяцы — префиксами "d2026"* / "d202610"*, остальные дни — точными токенами"""
+    terms, day = [], date_from
+    while day <= date_to:
+        year_end = day.replace(month=12, day=31)
+        month_end = day + relativedelta(day=31)
+        if day.month == 1 and day.day == 1 and year_end <= date_to:
+            terms.append(f'"{prefix}{day:%Y}"*')
+            day = year_end + timedelta(days=1)
+        elif day.day == 1 and month_end <= date_to:
+            terms.append(f'"{prefix}{day:%Y%m}"*')
+            day = month_end + timedelta(days=1)
+        else:
+            terms.append(f'"{prefix}{day:%Y%m%d}"')
+            day += timedelta(days=1)
+    return terms
+
+
+def search_messages(query, company=None, date_from=None, date_to=None, limit=50, stemming=FTS_STEMMING):
+    """Поиск комментариев по FTS5-индексу с фильтром по компании и диапазону дат.
+
+    date_from / date_to — строки "YYYY-MM-DD" (включительно).
+    Фильтры входят в сам MATCH токенами колонки scope: с фильтром слова ищутся среди основ
+    месяцев диапазона нужной компании (без компании — каждой), даты — токенами дней.
+    bm25 считается только для отфильтрованных строк, а из user_messages читаются лишь limit лучших.
+    Возвращает список словарей, отсортированных по релевантности (bm25).
     """
-    if not text:
+    words = RU_WORD_RE.findall(query or "")
+    if not words:
+        return []
+    with closing(sqlite3.connect(DB_PATH, timeout=SQLITE_TIMEOUT)) as conn:
+        prefix = fts_company(company) if company else ""
+        partitioned = stemming and (company or date_from or date_to)
+        if partitioned or date_from or date_to:
+            # Открытые границы — первый / последний день сообщений (компании); отдельные MIN и MAX
+            # берутся из индексов дат за O(log n), а не сканом
+            where, params = ("WHERE company = ?", (company,)) if company else ("", ())
+            first, last = conn.execute(
+                f"SELECT (SELECT MIN(message_date) FROM user_messages {where}), "
+                f"(SELECT MAX(message_date) FROM user_messages {where})", params * 2
+            ).fetchone()
+            if first is None:
+                return []
+            start = max(datetime.strptime(str(date_from or first), "%Y-%m-%d").date(),
+                        datetime.strptime(first, "%Y-%m-%d").date())
+            end = min(datetime.strptime(str(date_to or last), "%Y-%m-%d").date(),
+                      datetime.strptime(last, "%Y-%m-%d").date())
+            if start > end:
+                return []
+        if partitioned:
+            # Компании без фильтра — по индексу (company, ...) одним поиском на компанию
+            companies = [company] if company else [row[0] for row in conn.execute('''
+                WITH RECURSIVE c(company) AS (
+                    SELECT MIN(company) FROM user_messages
+                    UNION ALL
+                    SELECT (SELECT MIN(company) FROM user_messages WHERE company > c.company)
+                    FROM c WHERE c.company IS NOT NULL
+                )
+                SELECT company FROM c WHERE company IS NOT NULL
+            ''')]
+            months = []
+            month = start.replace(day=1)
+            while month <= end:
+                months.append(month)
+                month += relativedelta(months=1)
+            partitions = [f"{fts_company(c)}m{m:%Y%m}s" for c in companies for m in months]
+            match = "scope : (" + " AND ".join(
+                "(" + " OR ".join(fts_stem_term(ru_stem(w), part) for part in partitions) + ")" for w in words) + ")"
+        else:
+            match = build_fts_query(query, stemming)
+            if company and not (date_from or date_to):
+                match += f' AND scope : "{prefix}d"*'
+        if date_from or date_to:
+            match += " AND scope : (" + " OR ".join(fts_date_terms(start, end, prefix + "d")) + ")"
+        rows = conn.execute(
+            '''
+            SELECT m.id, m.company, m.message_date, m.message_time, m.nickname, m.comment, f.score
+            FROM (
+                SELECT rowid, bm25(user_messages_fts) AS score
+                FROM user_messages_fts
+                WHERE user_messages_fts MATCH ?
+                ORDER BY score, rowid DESC
+                LIMIT ?
+            ) f
+            JOIN user_messages m ON m.id = f.rowid
+            ORDER BY f.score, m.id DESC
+            ''',
+            (match, int(limit))
+        ).fetchall()
+    return [
+        {
+            "id": r[0], "company": r[1], "date": r[2], "time": r[3],
+            "nickname": r[4], "comment": r[5], "score": r[6],
+        }
+        for r in rows
+    ]
+
+
+# ===================== ОБЛАКО ТЕГОВ: СЛОВАРЬ И ВРЕМЕННЫЕ РЯДЫ =====================
+
+# Кэш интернированных значений: {(путь к БД, таблица, значение): id}
+_DICT_CACHE = {}
+# Поколение словарей, под которое собран кэш: {путь к БД: поколение}
+_DICT_GENERATION = {}
+
+
+def init_cloud_series(conn):
+    """Создание словарных таблиц и рядов частот облака тегов.
+
+    cloud_series хранит одну строку на (компания, слово, момент запуска) с целочисленными
+    ключами и кластеризована по этому ключу (WITHOUT ROWID), поэтому ряд одного слова —
+    это непрерывный диапазон, а выборка за окно времени идёт по индексу (company_id, ts).
+    Строки, накопленные в cloud_tags до появления рядов, переносятся в них, а cloud_tags
+    очищается: облако хранится только рядами. Представление cloud_series_rows отдаёт
+    ряды в прежнем виде (компания, дата, слово, частота) для API.
+    """
+    conn.execute("CREATE TABLE IF NOT EXISTS dict_companies (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)")
+    conn.execute("CREATE TABLE IF NOT EXISTS dict_words (id INTEGER PRIMARY KEY, word TEXT NOT NULL UNIQUE)")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS cloud_series (
+            company_id INTEGER NOT NULL,
+            word_id INTEGER NOT NULL,
+            ts INTEGER NOT NULL,
+            frequency REAL,
+            PRIMARY KEY (company_id, word_id, ts)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_cloud_series_company_ts ON cloud_series (company_id, ts)")
+    # Чистка словарей задачей хранения увеличивает поколение: кэши id в других процессах сбрасываются
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS dict_generation (id INTEGER PRIMARY KEY CHECK (id = 1), generation INTEGER NOT NULL)"
+    )
+    conn.execute("INSERT OR IGNORE INTO dict_generation (id, generation) VALUES (1, 0)")
+    # id — ts и word_id в одном числе: уникален и возрастает по времени (курсор пагинации API).
+    # Дата снимка — по MSK (UTC+3 без перехода на летнее время)
+    conn.execute('''
+        CREATE VIEW IF NOT EXISTS cloud_series_rows AS
+        SELECT s.ts * 16777216 + s.word_id AS id, c.name AS company,
+               date(s.ts, 'unixepoch', '+3 hours') AS parse_date, w.word AS word, s.frequency AS frequency
+        FROM cloud_series s
+        JOIN dict_companies c ON c.id = s.company_id
+        JOIN dict_words w ON w.id = s.word_id
+    ''')
+    if conn.execute("SELECT 1 FROM cloud_tags LIMIT 1").fetchone() is not None:
+        migrate_cloud_tags_to_series(conn)
+
+
+def intern_id(conn, table, value):
+    """Целочисленный id строки в словарной таблице (dict_companies / dict_words), с созданием при отсутствии"""
+    key = (DB_PATH, table, value)
+    cached = _DICT_CACHE.get(key)
+    if cached is not None:
+        return cached
+    column = "name" if table == "dict_companies" else "word"
+    conn.execute(f"INSERT OR IGNORE INTO {table} ({column}) VALUES (?)", (value,))
+    row_id = conn.execute(f"SELECT id FROM {table} WHERE {column} = ?", (value,)).fetchone()[0]
+    _DICT_CACHE[key] = row_id
+    return row_id
+
+
+def sync_dict_cache(conn):
+    """Сброс кэша id, если словари чистились после его заполнения (вызывать внутри пишущей транзакции)"""
+    generation = conn.execute("SELECT generation FROM dict_generation").fetchone()[0]
+    if _DICT_GENERATION.get(DB_PATH) != generation:
+        forget_interned_ids()
+        _DICT_GENERATION[DB_PATH] = generation
+
+
+def forget_interned_ids():
+    """Сброс кэша id: после отката транзакции выданные в ней id могли не сохраниться"""
+    for key in [key for key in _DICT_CACHE if key[0] == DB_PATH]:
+        del _DICT_CACHE[key]
+    _DICT_GENERATION.pop(DB_PATH, None)
+
+
+def lookup_id(conn, table, value):
+    """id строки в словарной таблице без создания; None, если значения нет"""
+    column = "name" if table == "dict_companies" else "word"
+    row = conn.execute(f"SELECT id FROM {table} WHERE {column} = ?", (value,)).fetchone()
+    return row[0] if row else None
+
+
+def to_epoch(value):
+    """datetime / date / "YYYY-MM-DD" / число -> unix-время в секундах (наивные даты считаются MSK)"""
+    if value is None:
         return None
-    text = text.strip()
-    # "только что"
-    if "только" in text:
-        return NOW
-    # Числовая метка (миллисекунды или секунды)
-    if re.fullmatch(r"\d{10,16}", text):
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, str):
+        value = datetime.strptime(value[:10], "%Y-%m-%d")
+    if not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    if value.tzinfo is None:
+        value = MSK.localize(value)
+    return int(value.timestamp())
+
+
+def cloud_rows_to_series(conn, cloud_data, ts):
+    """Строки облака [company, parse_date, word, frequency] -> кортежи ряда с интернированными id"""
+    series = []
+    for company, _, word, freq in cloud_data:
+        if not word:
+            continue
+        series.append((
+            intern_id(conn, "dict_companies", company),
+            intern_id(conn, "dict_words", word),
+            ts,
+            freq,
+        ))
+    return series
+
+
+def append_cloud_series(cloud_data, ts=None):
+    """Добавление снимка облака тегов в словарное хранилище (момент снимка — NOW, если ts не задан)"""
+    if not cloud_data:
+        return
+    ts = to_epoch(ts if ts is not None else NOW)
+    with closing(sqlite3.connect(DB_PATH, timeout=SQLITE_TIMEOUT)) as conn:
+        # Сразу блокировка записи: чистка словарей не может пройти между проверкой кэша и вставкой
+        conn.execute("BEGIN IMMEDIATE")
         try:
-            ts = int(text)
-            if ts > 10**11:
-                dt = datetime.fromtimestamp(ts / 1000, tz=pytz.UTC).astimezone(MSK)
+            sync_dict_cache(conn)
+            conn.executemany(
+                "INSERT OR REPLACE INTO cloud_series (company_id, word_id, ts, frequency) VALUES (?, ?, ?, ?)",
+                cloud_rows_to_series(conn, cloud_data, ts)
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            forget_interned_ids()
+            raise
+
+
+def migrate_cloud_tags_to_series(conn):
+    """Перенос накопленной таблицы cloud_tags в ряды (момент снимка — полночь MSK даты парсинга)
+    с очисткой cloud_tags. Дни, уже записанные в ряды (прошлые версии писали в обе таблицы), пропускаются"""
+    sync_dict_cache(conn)
+    cursor = conn.execute("SELECT company, parse_date, word, frequency FROM cloud_tags")
+    # (компания, день) -> день уже есть в рядах; решение по первой строке дня не меняется
+    # и после вставки его строк из предыдущих порций
+    covered = {}
+    moved = 0
+    while True:
+        chunk = cursor.fetchmany(50000)
+        if not chunk:
+            break
+        series = []
+        for company, parse_date, word, freq in chunk:
+            try:
+                ts = to_epoch(parse_date)
+            except (TypeError, ValueError):
+                continue
+            key = (company, ts)
+            if key not in covered:
+                company_id = lookup_id(conn, "dict_companies", company)
+                covered[key] = company_id is not None and conn.execute(
+                    "SELECT 1 FROM cloud_series WHERE company_id = ? AND ts >= ? AND ts < ? LIMIT 1",
+                    (company_id, ts, ts + 86400)
+                ).fetchone() is not None
+            if not covered[key]:
+                series.extend(cloud_rows_to_series(conn, [[company, parse_date, word, freq]], ts))
+        conn.executemany(
+            "INSERT OR REPLACE INTO cloud_series (company_id, word_id, ts, frequency) VALUES (?, ?, ?, ?)",
+            series
+        )
+        moved += len(series)
+    cleared = conn.execute("DELETE FROM cloud_tags").rowcount
+    print(f"cloud_tags перенесены в cloud_series: {moved} строк, очищено {cleared}")
+
+
+def word_trend(company, word, since=None, until=None):
+    """Ряд частот слова для компании: список (datetime MSK, частота) по возрастанию времени"""
+    with closing(sqlite3.connect(DB_PATH, timeout=SQLITE_TIMEOUT)) as conn:
+        company_id = lookup_id(conn, "dict_companies", company)
+        word_id = lookup_id(conn, "dict_words", word)
+        if company_id is None or word_id is None:
+            return []
+        rows = conn.execute(
+            "SELECT ts, frequency FROM cloud_series "
+            "WHERE company_id = ? AND word_id = ? AND ts >= ? AND ts <= ? ORDER BY ts",
+            (company_id, word_id, to_epoch(since) or 0, to_epoch(until) or 2**62)
+        ).fetchall()
+    return [(datetime.fromtimestamp(ts, tz=pytz.UTC).astimezone(MSK), freq) for ts, freq in rows]
+
+
+def _window_averages(conn, company_id, start, end):
+    """Средняя частота каждого слова компании за окно [start, end): {word_id: avg}"""
+    rows = conn.execute(
+        "SELECT word_id, AVG(frequency) FROM cloud_series "
+        "WHERE company_id = ? AND ts >= ? AND ts < ? GROUP BY word_id",
+        (company_id, start, end)
+    ).fetchall()
+    return dict(rows)
+
+
+def _word_names(conn, word_ids):
+    """{word_id: word} для заданного набора id"""
+    word_ids = list(word_ids)
+    if not word_ids:
+        return {}
+    placeholders = ",".join("?" * len(word_ids))
+    return dict(conn.execute(f"SELECT id, word FROM dict_words WHERE id IN ({placeholders})", word_ids).fetchall())
+
+
+def top_words(company, since=None, until=None, n=20):
+    """Топ-N слов компании по средней частоте за период: список (слово, средняя частота)"""
+    with closing(sqlite3.connect(DB_PATH, timeout=SQLITE_TIMEOUT)) as conn:
+        company_id = lookup_id(conn, "dict_companies", company)
+        if company_id is None:
+            return []
+        averages = _window_averages(conn, company_id, to_epoch(since) or 0, (to_epoch(until) or 2**62 - 1) + 1)
+        best = sorted(averages.items(), key=lambda kv: kv[1], reverse=True)[:n]
+        names = _word_names(conn, (wid for wid, _ in best))
+    return [(names[wid], round(avg, 2)) for wid, avg in best]
+
+
+def rising_words(company, window_hours=24, baseline_days=7, n=20, now=None):
+    """Слова с наибольшим ростом частоты за последние window_hours относительно
+    предшествующего базового периода длиной baseline_days.
+
+    Возвращает список (слово, частота в окне, базовая частота, прирост); слова,
+    отсутствовавшие в базовом периоде, считаются с базовой частотой 0.
+    """
+    end = to_epoch(now if now is not None else datetime.now(MSK)) + 1
+    window_start = end - int(window_hours * 3600)
+    baseline_start = window_start - int(baseline_days * 86400)
+    with closing(sqlite3.connect(DB_PATH, timeout=SQLITE_TIMEOUT)) as conn:
+        company_id = lookup_id(conn, "dict_companies", company)
+        if company_id is None:
+            return []
+        current = _window_averages(conn, company_id, window_start, end)
+        baseline = _window_averages(conn, company_id, baseline_start, window_start)
+        deltas = [(wid, avg, baseline.get(wid, 0.0)) for wid, avg in current.items()]
+        deltas.sort(key=lambda item: item[1] - item[2], reverse=True)
+        deltas = [item for item in deltas if item[1] > item[2]][:n]
+        names = _word_names(conn, (wid for wid, _, _ in deltas))
+    return [(names[wid], round(cur, 2), round(base, 2), round(cur - base, 2)) for wid, cur, base in deltas]
+
+
+# ===================== КОНТРОЛЬНЫЕ ТОЧКИ =====================
+
+# Текущий обход: к нему привязаны контрольные точки (колонка sweep_id в sweep_checkpoints)
+SWEEP_ID = None
+
+
+def open_sweep(kind, sweep_id=None, any_day=False):
+    """Идентификатор обхода вида kind ("run" — обычный запуск, "workers" — общий обход воркеров).
+
+    Незавершённый обход этого дня (запуск упал или его уже начали другие воркеры) продолжается,
+    иначе начинается новый с идентификатором "YYYY-MM-DD-HHMMSS-kind". Закрытые close_sweep
+    обходы не продолжаются. Явный sweep_id (--sweep-id) используется как есть; any_day —
+    продолжать незавершённый обход, начатый в любой день (многодневная дозагрузка).
+    """
+    with closing(jobs_connection()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = (sweep_id,) if sweep_id else conn.execute(
+                "SELECT sweep_id FROM sweeps WHERE kind = ? AND finished_at IS NULL AND sweep_id >= ? "
+                "ORDER BY sweep_id DESC LIMIT 1",
+                (kind, "" if any_day else RUN_DATE)
+            ).fetchone()
+            started = datetime.now(MSK)
+            if row:
+                sweep_id = row[0]
+                print(f"Продолжение обхода {sweep_id}")
             else:
-                dt = datetime.fromtimestamp(ts, tz=pytz.UTC).astimezone(MSK)
-            return dt
+                sweep_id = f"{started:%Y-%m-%d-%H%M%S}-{kind}"
+                # Новый обход в ту же секунду, что и только что закрытый, получает суффикс
+                suffix = 1
+                while conn.execute("SELECT 1 FROM sweeps WHERE sweep_id = ?", (sweep_id,)).fetchone():
+                    suffix += 1
+                    sweep_id = f"{started:%Y-%m-%d-%H%M%S}-{kind}-{suffix}"
+            # Последний id сообщений до начала обхода — граница сохранённых прошлыми запусками
+            conn.execute(
+                "INSERT OR IGNORE INTO sweeps (sweep_id, kind, started_at, messages_max_id) "
+                "SELECT ?, ?, ?, COALESCE(MAX(id), 0) FROM user_messages",
+                (sweep_id, kind, started.strftime("%Y-%m-%d %H:%M:%S"))
+            )
+            conn.execute("COMMIT")
         except Exception:
-            pass
-    # Абсолютная дата формата "17.12.2025, 03:46" или "17.12.2025 03:46"
-    m = re.search(r"(\d{1,2}\.\d{1,2}\.\d{4})[,\s]+(\d{1,2}:\d{2})", text)
-    if m:
+            conn.execute("ROLLBACK")
+            raise
+    return sweep_id
+
+
+def sweep_started(sweep_id=None):
+    """Время начала обхода (datetime MSK) или None, если обход неизвестен"""
+    with closing(jobs_connection()) as conn:
+        row = conn.execute("SELECT started_at FROM sweeps WHERE sweep_id = ?", (sweep_id or SWEEP_ID,)).fetchone()
+    if not row or not row[0]:
+        return None
+    return MSK.localize(datetime.strptime(row[0], "%Y-%m-%d %H:%M:%S"))
+
+
+def close_sweep(sweep_id=None):
+    """Отметка о завершении обхода: его контрольные точки больше не используются"""
+    with closing(jobs_connection()) as conn:
+        conn.execute(
+            "UPDATE sweeps SET finished_at = ? WHERE sweep_id = ? AND finished_at IS NULL",
+            (datetime.now(MSK).strftime("%Y-%m-%d %H:%M:%S"), sweep_id or SWEEP_ID)
+        )
+
+
+def load_checkpoints(service, sweep_id=None):
+    """Контрольные точки сервиса в текущем обходе: {раздел: dict}"""
+    sweep_id = sweep_id or SWEEP_ID
+    if not CHECKPOINTS_ENABLED or not sweep_id:
+        return {}
+    with closing(sqlite3.connect(DB_PATH, timeout=SQLITE_TIMEOUT)) as conn:
+        rows = conn.execute(
+            "SELECT section, done, last_cursor, last_message_id, messages_saved FROM sweep_checkpoints "
+            "WHERE sweep_id = ? AND service = ?",
+            (sweep_id, service)
+        ).fetchall()
+    return {
+        section: {"done": bool(done), "last_cursor": cursor, "last_message_id": mid, "messages_saved": saved or 0}
+        for section, done, cursor, mid, saved in rows
+    }
+
+
+def save_checkpoint(service, section, done=False, last_cursor=None, last_message_id=None,
+                    messages_added=0, sweep_id=None):
+    """Запись контрольной точки раздела; курсор и id сообщения не затираются пустыми значениями"""
+    sweep_id = sweep_id or SWEEP_ID
+    if not CHECKPOINTS_ENABLED or not sweep_id:
+        return
+    if CSV_SINK is not None:
+        # Строки до контрольной точки должны попасть в файлы раньше неё
+        CSV_SINK.flush()
+    with sqlite3.connect(DB_PATH, timeout=SQLITE_TIMEOUT) as conn:
+        conn.execute(
+            '''
+            INSERT INTO sweep_checkpoints
+                (sweep_id, service, section, done, last_cursor, last_message_id, messages_saved, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (sweep_id, service, section) DO UPDATE SET
+                done = MAX(done, excluded.done),
+                last_cursor = COALESCE(excluded.last_cursor, last_cursor),
+                last_message_id = COALESCE(excluded.last_message_id, last_message_id),
+                messages_saved = messages_saved + excluded.messages_saved,
+                updated_at = excluded.updated_at
+            ''',
+            (sweep_id, service, section, int(done), last_cursor, last_message_id,
+             messages_added, datetime.now(MSK).strftime("%Y-%m-%d %H:%M:%S"))
+        )
+        conn.commit()
+
+
+def offer_cursor(service, section, cursor, sweep_id=None):
+    """Начальный курсор пагинации для раздела, у которого своего курсора ещё нет"""
+    sweep_id = sweep_id or SWEEP_ID
+    if not CHECKPOINTS_ENABLED or not sweep_id or not cursor:
+        return
+    with sqlite3.connect(DB_PATH, timeout=SQLITE_TIMEOUT) as conn:
+        conn.execute(
+            '''
+            INSERT INTO sweep_checkpoints (sweep_id, service, section, last_cursor, updated_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (sweep_id, service, section) DO UPDATE SET
+                last_cursor = COALESCE(last_cursor, excluded.last_cursor)
+            ''',
+            (sweep_id, service, section, cursor, datetime.now(MSK).strftime("%Y-%m-%d %H:%M:%S"))
+        )
+        conn.commit()
+
+
+# ===================== РАСПРЕДЕЛЕНИЕ СЕРВИСОВ МЕЖДУ ВОРКЕРАМИ =====================
+
+# Служебная задача формирования отчёта: берётся один раз, когда все сервисы завершены
+REPORT_JOB = "__report__"
+
+
+def jobs_connection():
+    """Соединение в режиме autocommit: транзакции аренды открываются явно через BEGIN IMMEDIATE"""
+    return sqlite3.connect(DB_PATH, timeout=SQLITE_TIMEOUT, isolation_level=None)
+
+
+def enqueue_sweep(sweep_id=None, services=None):
+    """Постановка сервисов обхода в таблицу заданий (повторный вызов ничего не меняет)"""
+    sweep_id = sweep_id or SWEEP_ID
+    with closing(jobs_connection()) as conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO sweep_jobs (sweep_id, service) VALUES (?, ?)",
+            [(sweep_id, service) for service in list(services or SERVICES) + [REPORT_JOB]]
+        )
+    return sweep_id
+
+
+def claim_job(worker_id, sweep_id=None, lease_seconds=None):
+    """Атомарный захват свободного сервиса или сервиса с истёкшей арендой; None — брать нечего"""
+    sweep_id = sweep_id or SWEEP_ID
+    lease_seconds = lease_seconds or JOB_LEASE_SECONDS
+    now = time.time()
+    with closing(jobs_connection()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Аренды, истёкшие на последней попытке, больше не выдаются
+            conn.execute(
+                "UPDATE sweep_jobs SET state = 'failed', error = COALESCE(error, 'аренда истекла') "
+                "WHERE sweep_id = ? AND service != ? AND state = 'running' AND lease_expires < ? AND attempts >= ?",
+                (sweep_id, REPORT_JOB, now, JOB_MAX_ATTEMPTS)
+            )
+            row = conn.execute(
+                '''
+                SELECT service FROM sweep_jobs
+                WHERE sweep_id = ? AND service != ? AND attempts < ?
+                  AND (state = 'pending' OR (state = 'running' AND lease_expires < ?))
+                ORDER BY attempts, rowid LIMIT 1
+                ''',
+                (sweep_id, REPORT_JOB, JOB_MAX_ATTEMPTS, now)
+            ).fetchone()
+            if row is None:
+                # Задание отчёта — только когда все сервисы в конечном состоянии
+                row = conn.execute(
+                    '''
+                    SELECT service FROM sweep_jobs
+                    WHERE sweep_id = ? AND service = ?
+                      AND (state = 'pending' OR (state = 'running' AND lease_expires < ?))
+                      AND NOT EXISTS (
+                          SELECT 1 FROM sweep_jobs
+                          WHERE sweep_id = ? AND service != ? AND state NOT IN ('done', 'failed')
+                      )
+                    ''',
+                    (sweep_id, REPORT_JOB, now, sweep_id, REPORT_JOB)
+                ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute(
+                "UPDATE sweep_jobs SET state = 'running', owner = ?, lease_expires = ?, heartbeat_at = ?, "
+                "attempts = attempts + 1 WHERE sweep_id = ? AND service = ?",
+                (worker_id, now + lease_seconds, now, sweep_id, row[0])
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return row[0]
+
+
+def heartbeat_job(worker_id, service, sweep_id=None, lease_seconds=None):
+    """Продление аренды; False — аренда потеряна (истекла и передана другому воркеру)"""
+    lease_seconds = lease_seconds or JOB_LEASE_SECONDS
+    now = time.time()
+    with closing(jobs_connection()) as conn:
+        cur = conn.execute(
+            "UPDATE sweep_jobs SET lease_expires = ?, heartbeat_at = ? "
+            "WHERE sweep_id = ? AND service = ? AND owner = ? AND state = 'running'",
+            (now + lease_seconds, now, sweep_id or SWEEP_ID, service, worker_id)
+        )
+        return cur.rowcount == 1
+
+
+def complete_job(worker_id, service, sweep_id=None):
+    """Отметка об успешном завершении (только владельцем аренды)"""
+    with closing(jobs_connection()) as conn:
+        cur = conn.execute(
+            "UPDATE sweep_jobs SET state = 'done', lease_expires = NULL, error = NULL "
+            "WHERE sweep_id = ? AND service = ? AND owner = ? AND state = 'running'",
+            (sweep_id or SWEEP_ID, service, worker_id)
+        )
+        return cur.rowcount == 1
+
+
+def fail_job(worker_id, service, error, sweep_id=None):
+    """Ошибка обработки: сервис возвращается в очередь, после JOB_MAX_ATTEMPTS попыток — failed"""
+    with closing(jobs_connection()) as conn:
+        cur = conn.execute(
+            "UPDATE sweep_jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+            "lease_expires = NULL, error = ? "
+            "WHERE sweep_id = ? AND service = ? AND owner = ? AND state = 'running'",
+            (JOB_MAX_ATTEMPTS, str(error)[:500], sweep_id or SWEEP_ID, service, worker_id)
+        )
+        return cur.rowcount == 1
+
+
+def requeue_job(worker_id, service, sweep_id=None):
+    """Возврат задания в очередь без расхода попытки (задание остановилось на контрольной точке)"""
+    with closing(jobs_connection()) as conn:
+        cur = conn.execute(
+            "UPDATE sweep_jobs SET state = 'pending', attempts = MAX(attempts - 1, 0), lease_expires = NULL "
+            "WHERE sweep_id = ? AND service = ? AND owner = ? AND state = 'running'",
+            (sweep_id or SWEEP_ID, service, worker_id)
+        )
+        return cur.rowcount == 1
+
+
+def sweep_status(sweep_id=None):
+    """Число заданий обхода по состояниям, например {"done": 9, "running": 2}"""
+    now = time.time()
+    with closing(jobs_connection()) as conn:
+        rows = conn.execute(
+            "SELECT CASE WHEN state = 'running' AND lease_expires < ? THEN 'expired' ELSE state END, COUNT(*) "
+            "FROM sweep_jobs WHERE sweep_id = ? AND service != ? GROUP BY 1",
+            (now, sweep_id or SWEEP_ID, REPORT_JOB)
+        ).fetchall()
+    return dict(rows)
+
+
+class JobPaused(Exception):
+    """Задание исчерпало свой бюджет времени, продвинувшись: оно продолжится с контрольной точки"""
+
+
+class LeaseHeartbeat:
+    """Фоновое продление аренды сервиса, пока идёт его обработка"""
+
+    def __init__(self, worker_id, service, sweep_id=None, interval=None):
+        self.worker_id = worker_id
+        self.service = service
+        self.sweep_id = sweep_id
+        self.interval = interval or JOB_HEARTBEAT_SECONDS
+        self.lost = False
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name=f"lease-{service}", daemon=True)
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                if not heartbeat_job(self.worker_id, self.service, self.sweep_id):
+                    self.lost = True
+                    print(f"Аренда {self.service} потеряна воркером {self.worker_id}")
+                    return
+            except sqlite3.Error as e:
+                print(f"Ошибка продления аренды {self.service}: {e}")
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop_event.set()
+        self.thread.join()
+        return False
+
+
+def run_jobs(worker_id, handle_service, sweep_id=None, finalize=None):
+    """Цикл воркера: брать сервисы в аренду и обрабатывать, пока обход не завершится.
+
+    handle_service(service) обрабатывает один сервис; finalize() вызывается ровно
+    одним воркером после завершения всех сервисов, он же закрывает обход. Если свободных
+    сервисов нет, но другие ещё в работе, воркер ждёт — их аренда может истечь.
+    """
+    sweep_id = sweep_id or SWEEP_ID
+    processed = 0
+    while True:
+        service = claim_job(worker_id, sweep_id)
+        if service is None:
+            status = sweep_status(sweep_id)
+            if not status.get("running") and not status.get("expired") and not status.get("pending"):
+                break
+            time.sleep(JOB_IDLE_POLL_SECONDS)
+            continue
+        if service == REPORT_JOB:
+            if finalize is not None:
+                finalize()
+            complete_job(worker_id, service, sweep_id)
+            close_sweep(sweep_id)
+            continue
+        print(f"\n=== [{worker_id}] Парсинг {service.upper()} ===")
+        with LeaseHeartbeat(worker_id, service, sweep_id) as lease:
+            try:
+                handle_service(service)
+            except JobPaused as e:
+                print(f"{service}: {e}")
+                requeue_job(worker_id, service, sweep_id)
+                continue
+            except Exception as e:
+                print(f"Ошибка при парсинге {service}: {e}")
+                fail_job(worker_id, service, e, sweep_id)
+                continue
+        if lease.lost:
+            print(f"Сервис {service} уже передан другому воркеру — результат не отмечаем")
+            continue
+        complete_job(worker_id, service, sweep_id)
+        processed += 1
+    print(f"Воркер {worker_id}: обработано сервисов {processed}, итог обхода {sweep_status(sweep_id)}")
+    return processed
+
+
+# ===================== ГРАНИЦА УЖЕ СОХРАНЁННЫХ СООБЩЕНИЙ =====================
+
+def load_stored_message_ids(service, date_from, date_to):
+    """id сообщений сервиса за дни date_from..date_to, уже сохранённых в user_messages или в архиве"""
+    with closing(sqlite3.connect(DB_PATH, timeout=SQLITE_TIMEOUT)) as conn:
+        ids = {
+            row[0] for row in conn.execute(
+                "SELECT message_id FROM user_messages WHERE company = ? AND message_date BETWEEN ? AND ? "
+                "AND message_id IS NOT NULL",
+                (service, str(date_from), str(date_to))
+            )
+        }
+    ids.update(row[5] for row in load_archived_messages(service, date_from, date_to) if row[5])
+    return ids
+
+
+def load_high_water_mark(service, sweep_id=None):
+    """Граница сохранённых сообщений сервиса: (множество id последних сообщений, datetime последнего) или (set(), None).
+
+    Учитываются только сообщения, сохранённые до начала обхода: при продолжении прерванного
+    обхода граница — прошлые запуски, а не уже записанная часть текущего (иначе пагинация
+    с сохранённого курсора остановилась бы на первом же сообщении).
+    """
+    with closing(sqlite3.connect(DB_PATH, timeout=SQLITE_TIMEOUT)) as conn:
+        row = conn.execute(
+            "SELECT messages_max_id FROM sweeps WHERE sweep_id = ?", (sweep_id or SWEEP_ID,)).fetchone()
+        max_id = row[0] if row and row[0] is not None else 2 ** 63 - 1
+        ids = {
+            row[0] for row in conn.execute(
+                "SELECT message_id FROM user_messages WHERE company = ? AND message_id IS NOT NULL "
+                "AND id <= ? ORDER BY message_date DESC, message_time DESC, id DESC LIMIT ?",
+                (service, max_id, HWM_RECENT_IDS)
+            )
+        }
+        row = conn.execute(
+            "SELECT message_date, MAX(message_time) FROM user_messages WHERE company = ? AND id <= ? "
+            "AND message_date = (SELECT MAX(message_date) FROM user_messages WHERE company = ? AND id <= ?)",
+            (service, max_id, service, max_id)
+        ).fetchone()
+    latest = None
+    if row and row[0] and row[1]:
+        try:
+            latest = MSK.localize(datetime.strptime(f"{row[0]} {row[1]}", "%Y-%m-%d %H:%M:%S"))
+        except ValueError:
+            latest = None
+    return ids, latest
+
+
+# ===================== ХРАНЕНИЕ, ПРОРЕЖИВАНИЕ И СЖАТИЕ БАЗЫ =====================
+
+def pack_rows(rows):
+    """Строки -> сжатый JSON для архивных таблиц"""
+    return zlib.compress(json.dumps(rows, ensure_ascii=False).encode("utf-8"), 9)
+
+
+def unpack_rows(payload):
+    return json.loads(zlib.decompress(payload).decode("utf-8")) if payload else []
+
+
+def merge_archived_rows(payload, rows, key):
+    """Строки архива + новые строки без повторов: новая строка заменяет архивную с тем же ключом key(row).
+    Повторная архивация тех же строк (например, дня, пересобранного --reparse) ничего не дублирует"""
+    merged = {key(row): row for row in unpack_rows(payload)}
+    merged.update((key(row), row) for row in rows)
+    return list(merged.values())
+
+
+def message_key(row):
+    """Ключ архивной строки сообщения [time, nickname, comment, message_id, cluster_id]"""
+    return row[3] or (row[0], row[1], row[2])
+
+
+def retention_cutoff(days):
+    """Дата "YYYY-MM-DD", строки раньше которой подлежат обработке; None — не ограничено"""
+    if days is None:
+        return None
+    return (NOW.date() - relativedelta(days=days)).strftime("%Y-%m-%d")
+
+
+def downsample_graph_data(conn, cutoff):
+    """Сырые точки графика раньше cutoff -> часовые агрегаты graph_data_hourly.
+
+    Каждый запуск заново снимает окно графика, поэтому одна точка (компания, дата, время)
+    встречается в graph_data многократно; в агрегат идёт только последний снятый вариант точки.
+    День сворачивается целиком, поэтому агрегат часа пересчитывается из сырых точек и заменяет
+    прежний: сырые строки, которые --reparse вернул за уже свёрнутый день, не суммируются повторно.
+    """
+    days = [r[0] for r in conn.execute(
+        "SELECT DISTINCT parse_date FROM graph_data WHERE parse_date < ? ORDER BY parse_date", (cutoff,))]
+    moved = 0
+    for day in days:
+        conn.execute(
+            '''
+            WITH latest AS (
+                SELECT MAX(id) AS id FROM graph_data WHERE parse_date = ? GROUP BY company, parse_time
+            )
+            INSERT INTO graph_data_hourly (company, hour, points, complaints_sum, complaints_max, failures_sum)
+            SELECT company, parse_date || ' ' || substr(parse_time, 1, 2) || ':00',
+                   COUNT(*), SUM(complaints), MAX(complaints), SUM(failures)
+            FROM graph_data JOIN latest USING (id)
+            GROUP BY company, parse_date || ' ' || substr(parse_time, 1, 2)
+            ON CONFLICT (company, hour) DO UPDATE SET
+                points = excluded.points,
+                complaints_sum = excluded.complaints_sum,
+                complaints_max = excluded.complaints_max,
+                failures_sum = excluded.failures_sum
+            ''',
+            (day,)
+        )
+        moved += conn.execute("DELETE FROM graph_data WHERE parse_date = ?", (day,)).rowcount
+        conn.commit()
+    return moved
+
+
+def expire_snapshots(conn, table, cutoff, archive=RETENTION_ARCHIVE_SNAPSHOTS):
+    """Снимки cloud_tags / histograms раньше cutoff: в snapshots_archive (по компании и дню) или удаление.
+
+    День уходит в архив целиком, а снова появиться в таблице может только целиком пересобранным
+    (--reparse), поэтому архивная запись дня заменяется, а не дополняется.
+    """
+    columns = {"cloud_tags": "word, frequency", "histograms": "type, name, percent"}[table]
+    days = [r[0] for r in conn.execute(
+        f"SELECT DISTINCT parse_date FROM {table} WHERE parse_date < ? ORDER BY parse_date", (cutoff,))]
+    moved = 0
+    for day in days:
+        if archive:
+            by_company = {}
+            for row in conn.execute(f"SELECT company, {columns} FROM {table} WHERE parse_date = ?", (day,)):
+                by_company.setdefault(row[0], []).append(list(row[1:]))
+            for company, rows in by_company.items():
+                conn.execute(
+                    "INSERT OR REPLACE INTO snapshots_archive (table_name, company, parse_date, rows, payload) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (table, company, day, len(rows), pack_rows(rows))
+                )
+        moved += conn.execute(f"DELETE FROM {table} WHERE parse_date = ?", (day,)).rowcount
+        conn.commit()
+    return moved
+
+
+def expire_cloud_series(conn, cutoff, archive=RETENTION_ARCHIVE_SNAPSHOTS):
+    """Ряды облака раньше cutoff: в snapshots_archive (table_name "cloud_series", строки [ts, слово, частота]
+    по компании и дню) или удаление. Затем из словаря удаляются слова, на которые больше не ссылается
+    ни один ряд, а поколение словарей увеличивается — кэши id в процессах сбрасываются"""
+    cutoff_ts = to_epoch(cutoff)
+    moved = 0
+    for company_id, company in conn.execute("SELECT id, name FROM dict_companies").fetchall():
+        if archive:
+            by_day = {}
+            for ts, word, freq in conn.execute(
+                    "SELECT s.ts, w.word, s.frequency FROM cloud_series s JOIN dict_words w ON w.id = s.word_id "
+                    "WHERE s.company_id = ? AND s.ts < ? ORDER BY s.ts", (company_id, cutoff_ts)):
+                by_day.setdefault(datetime.fromtimestamp(ts, MSK).strftime("%Y-%m-%d"), []).append([ts, word, freq])
+            for day, rows in by_day.items():
+                existing = conn.execute(
+                    "SELECT payload FROM snapshots_archive WHERE table_name = 'cloud_series' AND company = ? "
+                    "AND parse_date = ?", (company, day)
+                ).fetchone()
+                if existing:
+                    rows = merge_archived_rows(existing[0], rows, key=lambda row: (row[0], row[1]))
+                conn.execute(
+                    "INSERT OR REPLACE INTO snapshots_archive (table_name, company, parse_date, rows, payload) "
+                    "VALUES ('cloud_series', ?, ?, ?, ?)",
+                    (company, day, len(rows), pack_rows(rows))
+                )
+        moved += conn.execute(
+            "DELETE FROM cloud_series WHERE company_id = ? AND ts < ?", (company_id, cutoff_ts)).rowcount
+        conn.commit()
+    if moved:
+        removed = conn.execute("DELETE FROM dict_words WHERE id NOT IN (SELECT word_id FROM cloud_series)").rowcount
+        if removed:
+            conn.execute("UPDATE dict_generation SET generation = generation + 1")
+        conn.commit()
+        forget_interned_ids()
+    return moved
+
+
+def delete_user_messages(conn, where, params_seq):
+    """Удаление сообщений по условию where (для каждого набора параметров) вместе с записями FTS"""
+    params_seq = list(params_seq)
+    if FTS_ENABLED:
+        register_fts_functions(conn)
+        conn.executemany(
+            "INSERT INTO user_messages_fts (user_messages_fts, rowid, comment, stems, scope) "
+            f"SELECT 'delete', id, comment, ru_stem_text(comment), fts_scope(company, message_date, comment) "
+            f"FROM user_messages WHERE {where}",
+            params_seq
+        )
+    return conn.executemany(f"DELETE FROM user_messages WHERE {where}", params_seq).rowcount
+
+
+def archive_user_messages(conn, cutoff):
+    """Сообщения раньше cutoff -> user_messages_archive (сжатый JSON на компанию и день), с удалением из FTS"""
+    days = [r[0] for r in conn.execute(
+        "SELECT DISTINCT message_date FROM user_messages WHERE message_date < ? ORDER BY message_date", (cutoff,))]
+    moved = 0
+    for day in days:
+        by_company = {}
+        for row in conn.execute(
+                "SELECT company, message_time, nickname, comment, message_id, cluster_id FROM user_messages "
+                "WHERE message_date = ? ORDER BY id", (day,)):
+            by_company.setdefault(row[0], []).append(list(row[1:]))
+        for company, rows in by_company.items():
+            existing = conn.execute(
+                "SELECT payload FROM user_messages_archive WHERE company = ? AND message_date = ?", (company, day)
+            ).fetchone()
+            if existing:
+                rows = merge_archived_rows(existing[0], rows, key=message_key)
+            conn.execute(
+                "INSERT OR REPLACE INTO user_messages_archive (company, message_date, rows, payload) VALUES (?, ?, ?, ?)",
+                (company, day, len(rows), pack_rows(rows))
+            )
+        moved += delete_user_messages(conn, "message_date = ?", [(day,)])
+        conn.commit()
+    return moved
+
+
+def load_archived_messages(company, date_from=None, date_to=None):
+    """Сообщения из архива: строки [company, date, time, nickname, comment, message_id, cluster_id]"""
+    sql = "SELECT message_date, payload FROM user_messages_archive WHERE company = ?"
+    params = [company]
+    if date_from:
+        sql += " AND message_date >= ?"
+        params.append(str(date_from))
+    if date_to:
+        sql += " AND message_date <= ?"
+        params.append(str(date_to))
+    with closing(sqlite3.connect(DB_PATH, timeout=SQLITE_TIMEOUT)) as conn:
+        result = []
+        for day, payload in conn.execute(sql + " ORDER BY message_date", params):
+            result.extend([company, day] + row for row in unpack_rows(payload))
+    return result
+
+
+def compact_database(conn, pages=RETENTION_VACUUM_PAGES, optimize_fts=False):
+    """Возврат свободных страниц файлу (incremental vacuum) и обновление статистики планировщика.
+    optimize_fts — ещё и слияние сегментов FTS (полная перезапись индекса, только для --retention)"""
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        # Однократный перевод базы в режим incremental: требует полного VACUUM
+        print("Перевод базы в режим auto_vacuum=INCREMENTAL (однократный VACUUM)...")
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+    freed = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    conn.execute(f"PRAGMA incremental_vacuum({int(pages)})")
+    if optimize_fts:
+        conn.execute("INSERT INTO user_messages_fts (user_messages_fts) VALUES ('optimize')")
+    if conn.execute("SELECT name FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone() is None:
+        conn.execute("ANALYZE")
+    else:
+        conn.execute("PRAGMA optimize")
+    conn.commit()
+    return min(freed, pages)
+
+
+def expire_bookkeeping(conn, cutoff):
+    """Обходы, закончившиеся (или начатые и брошенные) раньше cutoff, с их контрольными точками и заданиями.
+
+    Обход выбирается по времени из sweeps, а не по виду идентификатора: --sweep-id может быть любым.
+    Незавершённая дозагрузка сохраняется. Точки и задания без записи в sweeps (прошлые версии
+    ключевали их датой) удаляются по времени последнего изменения.
+    """
+    expired = [(row[0],) for row in conn.execute(
+        "SELECT sweep_id FROM sweeps WHERE COALESCE(finished_at, started_at) < ? "
+        "AND (finished_at IS NOT NULL OR kind NOT GLOB 'backfill-*')", (cutoff,))]
+    report = {
+        "sweep_checkpoints": conn.executemany("DELETE FROM sweep_checkpoints WHERE sweep_id = ?", expired).rowcount,
+        "sweep_jobs": conn.executemany("DELETE FROM sweep_jobs WHERE sweep_id = ?", expired).rowcount,
+        "sweeps": conn.executemany("DELETE FROM sweeps WHERE sweep_id = ?", expired).rowcount,
+    }
+    report["sweep_checkpoints"] += conn.execute(
+        "DELETE FROM sweep_checkpoints WHERE sweep_id NOT IN (SELECT sweep_id FROM sweeps) AND updated_at < ?",
+        (cutoff,)).rowcount
+    report["sweep_jobs"] += conn.execute(
+        "DELETE FROM sweep_jobs WHERE sweep_id NOT IN (SELECT sweep_id FROM sweeps) "
+        "AND COALESCE(heartbeat_at, lease_expires, 0) < ?", (to_epoch(cutoff),)).rowcount
+    conn.commit()
+    return report
+
+
+def retention_due():
+    """Пора ли выполнять хранение после обычного обхода: с прошлого раза прошло RETENTION_INTERVAL_HOURS"""
+    with closing(sqlite3.connect(DB_PATH, timeout=SQLITE_TIMEOUT)) as conn:
+        row = conn.execute("SELECT MAX(finished_at) FROM retention_runs").fetchone()
+    if not row or not row[0]:
+        return True
+    last = MSK.localize(datetime.strptime(row[0], "%Y-%m-%d %H:%M:%S"))
+    return datetime.now(MSK) - last >= timedelta(hours=RETENTION_INTERVAL_HOURS)
+
+
+def run_retention(optimize_fts=False):
+    """Задача хранения: прореживание графика, архивирование снимков и сообщений, сжатие базы.
+    optimize_fts — слияние сегментов FTS: дорого на больших базах, поэтому только в --retention"""
+    started = time.monotonic()
+    size_before = os.path.getsize(DB_PATH) if os.path.exists(DB_PATH) else 0
+    with closing(sqlite3.connect(DB_PATH, timeout=SQLITE_TIMEOUT)) as conn:
+        report = {}
+        cutoff = retention_cutoff(RETENTION_GRAPH_RAW_DAYS)
+        if cutoff:
+            report["graph_data -> hourly"] = downsample_graph_data(conn, cutoff)
+        for table, days in (("cloud_tags", RETENTION_CLOUD_DAYS), ("histograms", RETENTION_HIST_DAYS)):
+            cutoff = retention_cutoff(days)
+            if cutoff:
+                report[table] = expire_snapshots(conn, table, cutoff)
+        cutoff = retention_cutoff(RETENTION_CLOUD_DAYS)
+        if cutoff and CLOUD_SERIES_ENABLED:
+            report["cloud_series"] = expire_cloud_series(conn, cutoff)
+        cutoff = retention_cutoff(RETENTION_MESSAGES_DAYS)
+        if cutoff:
+            report["user_messages -> archive"] = archive_user_messages(conn, cutoff)
+            # Кластеры уходят вместе с сообщениями: у оставшихся сообщений cluster_id не висит
+            report["message_clusters"] = conn.execute(
+                "DELETE FROM message_clusters WHERE cluster_date < ?", (cutoff,)).rowcount
+            conn.commit()
+        cutoff = retention_cutoff(RETENTION_BOOKKEEPING_DAYS)
+        if cutoff:
+            report.update(expire_bookkeeping(conn, cutoff))
+        report["pages freed"] = compact_database(conn, optimize_fts=optimize_fts and FTS_ENABLED)
+    cutoff = retention_cutoff(ARCHIVE_RETENTION_DAYS)
+    if cutoff:
+        report["raw_snapshots"] = expire_archive(cutoff)
+    with closing(sqlite3.connect(DB_PATH, timeout=SQLITE_TIMEOUT)) as conn:
+        conn.execute("INSERT INTO retention_runs (finished_at, report) VALUES (?, ?)",
+                     (datetime.now(MSK).strftime("%Y-%m-%d %H:%M:%S"), json.dumps(report, ensure_ascii=False)))
+        conn.commit()
+    size_after = os.path.getsize(DB_PATH)
+    print("Хранение: " + ", ".join(f"{k}: {v}" for k, v in report.items()))
+    print(f"Размер базы: {size_before / 1024 / 1024:.1f} -> {size_after / 1024 / 1024:.1f} МБ "
+          f"за {time.monotonic() - started:.1f} с")
+    return report
+
+
+# ===================== АРХИВ СЫРЫХ СТРАНИЦ =====================
+
+# вид снимка -> семейство (своё словарь zstd): HTML страниц и JSON данных графика/облака
+ARCHIVE_KINDS = {"page": "html", "final": "html", "chart": "json", "cloud": "json"}
+_ZSTD_DICTS = {}
+
+
+def archive_exists():
+    """Есть ли архив; архив прежних версий из BASE_DIR переносится в ARCHIVE_DB_PATH"""
+    legacy = os.path.join(BASE_DIR, "raw_archive.db")
+    if legacy != ARCHIVE_DB_PATH and os.path.exists(legacy) and not os.path.exists(ARCHIVE_DB_PATH):
+        os.makedirs(os.path.dirname(ARCHIVE_DB_PATH), exist_ok=True)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(legacy + suffix):
+                os.replace(legacy + suffix, ARCHIVE_DB_PATH + suffix)
+        print(f"Архив перенесён в {ARCHIVE_DB_PATH}")
+    return os.path.exists(ARCHIVE_DB_PATH)
+
+
+def archive_connection():
+    """Соединение с базой архива (отдельный файл, чтобы не раздувать основную базу)"""
+    if not archive_exists():
+        os.makedirs(os.path.dirname(ARCHIVE_DB_PATH), exist_ok=True)
+    conn = sqlite3.connect(ARCHIVE_DB_PATH, timeout=SQLITE_TIMEOUT)
+    # Новый архив сразу в режиме incremental: место от удалённых снимков возвращается без VACUUM
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS raw_blobs (
+            hash TEXT PRIMARY KEY,
+            family TEXT NOT NULL,
+            codec TEXT NOT NULL,
+            dict_id INTEGER,
+            size INTEGER,
+            data BLOB
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS raw_snapshots (
+            service TEXT,
+            run_ts INTEGER,
+            kind TEXT,
+            run_date TEXT,
+            hash TEXT,
+            PRIMARY KEY (service, run_ts, kind)
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_raw_snapshots_date ON raw_snapshots (run_date, service)")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS raw_dicts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            family TEXT,
+            created_at INTEGER,
+            samples INTEGER,
+            data BLOB
+        )
+    ''')
+    return conn
+
+
+def _zstd_dict(conn, dict_id):
+    key = (ARCHIVE_DB_PATH, dict_id)
+    if key not in _ZSTD_DICTS:
+        row = conn.execute("SELECT data FROM raw_dicts WHERE id = ?", (dict_id,)).fetchone()
+        _ZSTD_DICTS[key] = zstandard.ZstdCompressionDict(row[0])
+    return _ZSTD_DICTS[key]
+
+
+def compress_blob(conn, raw, family):
+    """bytes -> (codec, dict_id, data): zstd с последним словарём семейства, если он обучен"""
+    if zstandard is None:
+        return "zlib", None, zlib.compress(raw, 9)
+    dict_id = conn.execute("SELECT MAX(id) FROM raw_dicts WHERE family = ?", (family,)).fetchone()[0]
+    dict_data = _zstd_dict(conn, dict_id) if dict_id else None
+    return "zstd", dict_id, zstandard.ZstdCompressor(level=ARCHIVE_ZSTD_LEVEL, dict_data=dict_data).compress(raw)
+
+
+def decompress_blob(conn, codec, dict_id, data):
+    if codec == "zlib":
+        return zlib.decompress(data)
+    if zstandard is None:
+        raise RuntimeError("Для чтения архива, сжатого zstd, нужен пакет zstandard")
+    dict_data = _zstd_dict(conn, dict_id) if dict_id else None
+    return zstandard.ZstdDecompressor(dict_data=dict_data).decompress(data)
+
+
+def load_blob(conn, digest):
+    codec, dict_id, data = conn.execute(
+        "SELECT codec, dict_id, data FROM raw_blobs WHERE hash = ?", (digest,)).fetchone()
+    return decompress_blob(conn, codec, dict_id, data)
+
+
+def archive_snapshot(service, kind, content, run_ts, run_date=None):
+    """Сохранение снимка: content — HTML (str) или данные для JSON; одинаковое содержимое хранится один раз"""
+    if isinstance(content, str):
+        raw = content.encode("utf-8")
+    else:
+        raw = json.dumps(content, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    digest = hashlib.sha256(raw).hexdigest()
+    family = ARCHIVE_KINDS[kind]
+    with closing(archive_connection()) as conn:
+        if conn.execute("SELECT 1 FROM raw_blobs WHERE hash = ?", (digest,)).fetchone() is None:
+            codec, dict_id, data = compress_blob(conn, raw, family)
+            conn.execute(
+                "INSERT OR IGNORE INTO raw_blobs (hash, family, codec, dict_id, size, data) VALUES (?, ?, ?, ?, ?, ?)",
+                (digest, family, codec, dict_id, len(raw), data)
+            )
+        conn.execute(
+            "INSERT OR REPLACE INTO raw_snapshots (service, run_ts, kind, run_date, hash) VALUES (?, ?, ?, ?, ?)",
+            (service, to_epoch(run_ts), kind, run_date or RUN_DATE, digest)
+        )
+        conn.commit()
+
+
+def train_archive_dicts(force=False):
+    """Обучение словарей zstd по накопленным снимкам и пересжатие блобов, сжатых без словаря"""
+    if zstandard is None or not archive_exists():
+        return
+    with closing(archive_connection()) as conn:
+        for family in sorted(set(ARCHIVE_KINDS.values())):
+            has_dict = conn.execute("SELECT 1 FROM raw_dicts WHERE family = ?", (family,)).fetchone()
+            if has_dict and not force:
+                continue
+            hashes = [r[0] for r in conn.execute(
+                "SELECT hash FROM raw_blobs WHERE family = ? ORDER BY random() LIMIT ?",
+                (family, ARCHIVE_DICT_MAX_SAMPLES))]
+            if len(hashes) < ARCHIVE_DICT_MIN_SAMPLES:
+                continue
+            samples = [load_blob(conn, h) for h in hashes]
+            try:
+                trained = zstandard.train_dictionary(ARCHIVE_DICT_SIZE, samples, level=ARCHIVE_ZSTD_LEVEL)
+            except zstandard.ZstdError as e:
+                print(f"Не удалось обучить словарь архива ({family}): {e}")
+                continue
+            conn.execute(
+                "INSERT INTO raw_dicts (family, created_at, samples, data) VALUES (?, ?, ?, ?)",
+                (family, int(time.time()), len(samples), trained.as_bytes())
+            )
+            before = after = 0
+            for digest, codec, dict_id, data in conn.execute(
+                    "SELECT hash, codec, dict_id, data FROM raw_blobs WHERE family = ? AND dict_id IS NULL",
+                    (family,)).fetchall():
+                raw = decompress_blob(conn, codec, dict_id, data)
+                codec, dict_id, packed = compress_blob(conn, raw, family)
+                before += len(data)
+                after += min(len(data), len(packed))
+                if len(packed) < len(data):
+                    conn.execute("UPDATE raw_blobs SET codec = ?, dict_id = ?, data = ? WHERE hash = ?",
+                                 (codec, dict_id, packed, digest))
+            conn.commit()
+            print(f"Словарь архива {family}: {len(samples)} образцов, пересжато {before / 1024:.0f} -> {after / 1024:.0f} КБ")
+
+
+def archive_stats():
+    """Объём архива по семействам: исходный и сжатый"""
+    if not archive_exists():
+        return
+    with closing(archive_connection()) as conn:
+        for family, count, raw, stored in conn.execute(
+                "SELECT family, COUNT(*), SUM(size), SUM(length(data)) FROM raw_blobs GROUP BY family"):
+            print(f"Архив {family}: {count} блобов, {raw / 1024 / 1024:.1f} -> {stored / 1024 / 1024:.1f} МБ "
+                  f"(x{raw / max(stored, 1):.1f})")
+
+
+def expire_archive(cutoff):
+    """Удаление снимков архива раньше cutoff и блобов, на которые больше не ссылается ни один снимок"""
+    if not archive_exists():
+        return 0
+    with closing(archive_connection()) as conn:
+        removed = conn.execute("DELETE FROM raw_snapshots WHERE run_date < ?", (cutoff,)).rowcount
+        if removed:
+            conn.execute("DELETE FROM raw_blobs WHERE hash NOT IN (SELECT hash FROM raw_snapshots)")
+            conn.commit()
+        compact_database(conn)
+    return removed
+
+
+def set_page_time(moment=None):
+    """NOW на момент загрузки страницы или подгрузки блока: от него отсчитывается "N минут назад" """
+    global NOW
+    NOW = moment or datetime.now(MSK)
+
+
+def set_reference_time(run_ts, run_date):
+    """Глобальные NOW / RUN_DATE / START_DATE на момент запуска, от которого отсчитывалось время на странице"""
+    global NOW, RUN_DATE, START_DATE
+    NOW = datetime.fromtimestamp(run_ts, MSK)
+    RUN_DATE = run_date
+    START_DATE = NOW.date() - relativedelta(days=DAYS_BACK)
+
+
+def reparse_day(task):
+    """Разбор всех снимков сервиса за день (выполняется в процессе пула): (service, run_date, строки по видам)"""
+    global NOW, RUN_DATE, START_DATE
+    service, run_date = task
+    saved = NOW, RUN_DATE, START_DATE
+    result = {"graph": {}, "cloud": [], "hist": [], "messages": {}}
+    try:
+        with closing(archive_connection()) as conn:
+            runs = {}
+            for run_ts, kind, digest in conn.execute(
+                    "SELECT run_ts, kind, hash FROM raw_snapshots WHERE service = ? AND run_date = ? ORDER BY run_ts",
+                    (service, run_date)):
+                runs.setdefault(run_ts, {})[kind] = load_blob(conn, digest).decode("utf-8")
+        for run_ts, blobs in runs.items():
+            set_reference_time(run_ts, run_date)
+            if "chart" in blobs:
+                for row in chart_to_rows(json.loads(blobs["chart"]), service):
+                    result["graph"][(row[1], row[2])] = row
+            if "cloud" in blobs:
+                result["cloud"].append((run_ts, cloud_tags_to_rows(service, json.loads(blobs["cloud"]))))
+            if "page" in blobs:
+                result["hist"].extend(parse_histograms(blobs["page"], service))
+            html = blobs.get("final") or blobs.get("page")
+            if html:
+                for row in parse_messages_html(html, service):
+                    result["messages"].setdefault(row[5], row)
+    finally:
+        NOW, RUN_DATE, START_DATE = saved
+    result["graph"] = list(result["graph"].values())
+    result["messages"] = list(result["messages"].values())
+    return service, run_date, result
+
+
+def replace_reparsed_rows(conn, service, run_date, result):
+    """Замена строк сервиса за день пересобранными: точки графика и сообщения — по ключу, снимки — за весь день"""
+    conn.executemany("DELETE FROM graph_data WHERE company = ? AND parse_date = ? AND parse_time = ?",
+                     [(service, r[1], r[2]) for r in result["graph"]])
+    conn.executemany("INSERT INTO graph_data (company, parse_date, parse_time, complaints, failures) VALUES (?, ?, ?, ?, ?)",
+                     result["graph"])
+    cloud = [row for _, rows in result["cloud"] for row in rows]
+    if cloud and CLOUD_SERIES_ENABLED:
+        day_start = to_epoch(run_date)
+        conn.execute(
+            "DELETE FROM cloud_series WHERE company_id = (SELECT id FROM dict_companies WHERE name = ?) "
+            "AND ts >= ? AND ts < ?",
+            (service, day_start, day_start + 86400)
+        )
+        sync_dict_cache(conn)
+        for run_ts, rows in result["cloud"]:
+            conn.executemany(
+                "INSERT OR REPLACE INTO cloud_series (company_id, word_id, ts, frequency) VALUES (?, ?, ?, ?)",
+                cloud_rows_to_series(conn, rows, run_ts)
+            )
+    elif cloud:
+        conn.execute("DELETE FROM cloud_tags WHERE company = ? AND parse_date = ?", (service, run_date))
+        conn.executemany("INSERT INTO cloud_tags (company, parse_date, word, frequency) VALUES (?, ?, ?, ?)", cloud)
+    if result["hist"]:
+        conn.execute("DELETE FROM histograms WHERE company = ? AND parse_date = ?", (service, run_date))
+        conn.executemany("INSERT INTO histograms (company, parse_date, type, name, percent) VALUES (?, ?, ?, ?, ?)",
+                         result["hist"])
+    messages = result["messages"]
+    delete_user_messages(
+        conn,
+        "company = ? AND (message_id = ? OR (message_id IS NULL AND message_date = ? AND message_time = ? AND comment = ?))",
+        [(service, r[5], r[1], r[2], r[4]) for r in messages]
+    )
+    conn.executemany(
+        "INSERT INTO user_messages (company, message_date, message_time, nickname, comment, message_id, cluster_id) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        messages
+    )
+    if FTS_ENABLED:
+        sync_messages_fts(conn)
+    conn.commit()
+
+
+def rebuild_from_archive(date_from=None, date_to=None, services=None, workers=None):
+    """Пересборка таблиц SQLite из архива страниц: разбор по (сервис, день) в пуле процессов"""
+    if not archive_exists():
+        print(f"Архив {ARCHIVE_DB_PATH} не найден.")
+        return
+    init_sqlite_tables()
+    sql = "SELECT DISTINCT service, run_date FROM raw_snapshots WHERE 1 = 1"
+    params = []
+    if date_from:
+        sql += " AND run_date >= ?"
+        params.append(str(date_from))
+    if date_to:
+        sql += " AND run_date <= ?"
+        params.append(str(date_to))
+    if services:
+        sql += f" AND service IN ({','.join('?' * len(services))})"
+        params.extend(services)
+    with closing(archive_connection()) as conn:
+        tasks = conn.execute(sql + " ORDER BY run_date, service", params).fetchall()
+    if not tasks:
+        print("В архиве нет снимков за указанный период.")
+        return
+    workers = workers or ARCHIVE_REPARSE_WORKERS or os.cpu_count() or 1
+    print(f"Пересборка из архива: {len(tasks)} пар (сервис, день), процессов: {workers}")
+    started = time.monotonic()
+    totals = {"graph": 0, "cloud": 0, "hist": 0, "messages": 0}
+    with multiprocessing.Pool(workers) as pool, \
+            closing(sqlite3.connect(DB_PATH, timeout=SQLITE_TIMEOUT)) as conn:
+        for done, (service, run_date, result) in enumerate(pool.imap_unordered(reparse_day, tasks), 1):
+            try:
+                replace_reparsed_rows(conn, service, run_date, result)
+            except Exception:
+                conn.rollback()
+                forget_interned_ids()
+                raise
+            totals["graph"] += len(result["graph"])
+            totals["cloud"] += sum(len(rows) for _, rows in result["cloud"])
+            totals["hist"] += len(result["hist"])
+            totals["messages"] += len(result["messages"])
+            print(f"[{done}/{len(tasks)}] {service} {run_date}: график {len(result['graph'])}, "
+                  f"гистограммы {len(result['hist'])}, сообщения {len(result['messages'])}")
+    print(f"Пересборка завершена за {time.monotonic() - started:.1f} с: "
+          + ", ".join(f"{k}: {v}" for k, v in totals.items()))
+    return totals
+
+
+# ===================== CSV ПО ДНЯМ =====================
+
+class CsvSink:
+    """Запись CSV с разбиением по дням (и, опционально, по сервисам).
+
+    Файлы держатся открытыми с большим буфером. Серия строк одного раздела
+    форматируется модулем csv одним writerows в общий строковый буфер и уходит
+    в файл одной записью уже в UTF-8; формат тот же, что у append_to_csv
+    (разделитель ";", utf-8-sig, заголовки из CSV_HEADERS). Манифест
+    manifest.json перечисляет разделы с датой, сервисом и числом строк,
+    чтобы читатели открывали только нужные файлы. Манифест обновляется
+    приращениями под flock, поэтому его могут вести несколько процессов сразу.
+    """
+
+    def __init__(self, root=None, by_service=None, max_open=CSV_MAX_OPEN_FILES):
+        self.root = root or CSV_PARTITIONS_DIR
+        self.by_service = CSV_PARTITION_BY_SERVICE if by_service is None else by_service
+        self.max_open = max_open
+        self.handles = {}
+        self.lock = threading.Lock()
+        self.manifest_path = os.path.join(self.root, "manifest.json")
+        self.pending = {}
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer, delimiter=";", lineterminator="\n")
+
+    def partition_path(self, key, day, service):
+        if self.by_service:
+            return os.path.join(key, day, f"{service}.csv")
+        return os.path.join(key, f"{day}.csv")
+
+    def _file(self, relpath, key):
+        f = self.handles.pop(relpath, None)
+        if f is None:
+            if len(self.handles) >= self.max_open:
+                # Закрываем самый давно использованный файл
+                oldest = next(iter(self.handles))
+                self.handles.pop(oldest).close()
+            path = os.path.join(self.root, relpath)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+            f = open(path, "ab", buffering=CSV_BUFFER_SIZE)
+            if is_new:
+                # BOM и заголовок, как у файла, открытого в utf-8-sig
+                self.writer.writerow(CSV_HEADERS[key])
+                f.write(b"\xef\xbb\xbf" + self._take_buffer())
+        # Последний использованный — в конец словаря (порядок вставки = LRU)
+        self.handles[relpath] = f
+        return f
+
+    def _take_buffer(self):
+        data = self.buffer.getvalue().encode("utf-8")
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return data
+
+    def write(self, key, rows):
+        """Добавление строк раздела key; дата — вторая колонка строки, сервис — первая"""
+        if not rows:
+            return
+        width = len(CSV_HEADERS[key])
+        with self.lock:
+            # Строки идут подряд по дням: каждая серия одного дня/сервиса уходит в открытый
+            # writer раздела одним writerows, без поиска файла и учёта на каждую строку
+            for (day, service), group in groupby(rows, key=itemgetter(1, 0)):
+                group = list(group)
+                if len(group[0]) > width:
+                    group = [row[:width] for row in group]
+                day = str(day)[:10] or RUN_DATE
+                relpath = self.partition_path(key, day, service)
+                f = self._file(relpath, key)
+                self.writer.writerows(group)
+                f.write(self._take_buffer())
+                entry = self.pending.setdefault(key, {}).setdefault(relpath, {
+                    "date": day,
+                    "service": service if self.by_service else None,
+                    "rows": 0,
+                })
+                entry["rows"] += len(group)
+
+    def flush(self):
+        """Сброс буферов в файлы и обновление манифеста"""
+        with self.lock:
+            for f in self.handles.values():
+                f.flush()
+            if self.pending:
+                os.makedirs(self.root, exist_ok=True)
+                with open(self.manifest_path + ".lock", "w") as lock_file:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    manifest = load_csv_manifest(self.root)
+                    for key, entries in self.pending.items():
+                        for relpath, entry in entries.items():
+                            current = manifest.setdefault(key, {}).setdefault(relpath, dict(entry, rows=0))
+                            current["rows"] += entry["rows"]
+                    tmp_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+                    with open(tmp_path, "w", encoding="utf-8") as f:
+                        json.dump(manifest, f, ensure_ascii=False, indent=1, sort_keys=True)
+                    os.replace(tmp_path, self.manifest_path)
+                self.pending = {}
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            for f in self.handles.values():
+                f.close()
+            self.handles.clear()
+
+
+# Активный CSV-приёмник текущего запуска (None — запись в единые файлы CSV_FILES)
+CSV_SINK = None
+
+
+def load_csv_manifest(root=None):
+    """Манифест разделов CSV: {раздел: {относительный путь: {date, service, rows}}}"""
+    path = os.path.join(root or CSV_PARTITIONS_DIR, "manifest.json")
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Ошибка чтения манифеста CSV {path}: {e}")
+        return {}
+
+
+def csv_partition_files(key, date_from=None, date_to=None, service=None, root=None):
+    """Пути к файлам раздела key, попадающим в диапазон дат (включительно) и сервис"""
+    root = root or CSV_PARTITIONS_DIR
+    paths = []
+    for relpath, entry in sorted(load_csv_manifest(root).get(key, {}).items()):
+        day = entry.get("date") or ""
+        if date_from and day < str(date_from):
+            continue
+        if date_to and day > str(date_to):
+            continue
+        if service and entry.get("service") not in (None, service):
+            continue
+        path = os.path.join(root, relpath)
+        if os.path.exists(path):
+            paths.append(path)
+    return paths
+
+
+def csv_partitions_modified_since(moment, root=None):
+    """Относительные пути разделов всех видов, дописанных не раньше moment (datetime)"""
+    root = root or CSV_PARTITIONS_DIR
+    since = moment.timestamp()
+    relpaths = []
+    for key, entries in sorted(load_csv_manifest(root).items()):
+        for relpath in sorted(entries):
+            path = os.path.join(root, relpath)
+            if os.path.exists(path) and os.path.getmtime(path) >= since:
+                relpaths.append(relpath)
+    return relpaths
+
+
+def read_csv_partitions(key, date_from=None, date_to=None, service=None, root=None):
+    """DataFrame раздела key только из нужных дневных файлов"""
+    frames = []
+    for path in csv_partition_files(key, date_from, date_to, service, root):
+        try:
+            frames.append(pd.read_csv(path, sep=";", encoding="utf-8-sig"))
+        except Exception as e:
+            print(f"Ошибка чтения {path}: {e}")
+    if not frames:
+        return pd.DataFrame(columns=CSV_HEADERS[key])
+    df = pd.concat(frames, ignore_index=True)
+    if service:
+        df = df[df[CSV_HEADERS[key][0]] == service]
+    return df
+
+
+def append_to_csv(csv_path, data, headers):
+    """Добавление данных в CSV файл порциями"""
+    if not data:
+        return
+    width = len(headers)
+    exists = os.path.exists(csv_path)
+    with open(csv_path, "a" if exists else "w", newline="", encoding="utf-8" if exists else "utf-8-sig") as f:
+        writer = csv.writer(f, delimiter=";", lineterminator="\n")
+        if not exists:
+            writer.writerow(headers)
+        writer.writerows(row[:width] for row in data)
+
+
+# ===================== ФОНОВАЯ ЗАПИСЬ =====================
+
+class PersistenceWriter:
+    """Отдельный поток записи: парсер кладёт задачи в ограниченную очередь и сразу
+    возвращается к браузеру, а поток выполняет их строго по порядку.
+
+    Порядок важен: контрольная точка ставится в очередь после пачки строк
+    и поэтому фиксируется только когда сами строки уже записаны. После ошибки
+    записи следующие контрольные точки пропускаются, пока ошибку не заберёт
+    take_error() — обработка сервиса тогда считается неудачной.
+    """
+
+    def __init__(self, maxsize=WRITER_QUEUE_SIZE):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.thread = threading.Thread(target=self._run, name="persistence-writer", daemon=True)
+        self.tasks_done = 0
+        self.errors = 0
+        self.failure = None
+        self.skipped_checkpoints = 0
+        self.max_depth = 0
+        self.blocked_seconds = 0.0
+        self.write_seconds = 0.0
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def submit(self, func, *args, **kwargs):
+        """Поставить задачу в очередь; блокирует парсер, пока в очереди нет места"""
+        started = time.perf_counter()
+        self.queue.put((func, args, kwargs))
+        self.blocked_seconds += time.perf_counter() - started
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    return
+                func, args, kwargs = task
+                if func is save_checkpoint and self.failure is not None:
+                    # Строки раздела не записаны — отмечать его обработанным нельзя
+                    self.skipped_checkpoints += 1
+                    print(f"Контрольная точка {args[:2]} пропущена после ошибки записи")
+                    continue
+                started = time.perf_counter()
+                try:
+                    func(*args, **kwargs)
+                except Exception as e:
+                    self.errors += 1
+                    if self.failure is None:
+                        self.failure = e
+                    print(f"Ошибка фоновой записи ({getattr(func, '__name__', func)}): {e}")
+                self.write_seconds += time.perf_counter() - started
+                self.tasks_done += 1
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """Дождаться записи всех поставленных задач"""
+        self.queue.join()
+
+    def take_error(self):
+        """Дождаться записи и вернуть первую ошибку с прошлого вызова (None — ошибок не было)"""
+        self.flush()
+        error, self.failure = self.failure, None
+        return error
+
+    def close(self):
+        """Записать всё оставшееся и остановить поток"""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def metrics(self):
+        return {
+            "depth": self.queue.qsize(),
+            "max_depth": self.max_depth,
+            "tasks_done": self.tasks_done,
+            "errors": self.errors,
+            "skipped_checkpoints": self.skipped_checkpoints,
+            "blocked_seconds": round(self.blocked_seconds, 2),
+            "write_seconds": round(self.write_seconds, 2),
+        }
+
+    def report(self, prefix="Очередь записи"):
+        m = self.metrics()
+        print(f"{prefix}: глубина {m['depth']} (макс. {m['max_depth']}/{self.queue.maxsize}), "
+              f"задач {m['tasks_done']}, ошибок {m['errors']}, "
+              f"пропущено контрольных точек {m['skipped_checkpoints']}, "
+              f"ожидание парсера {m['blocked_seconds']} с, запись {m['write_seconds']} с")
+
+
+# Активный писатель текущего запуска (None — запись синхронная)
+WRITER = None
+
+
+def persist(func, *args, **kwargs):
+    """Выполнить запись через фоновый поток, если он запущен, иначе сразу"""
+    if WRITER is not None:
+        WRITER.submit(func, *args, **kwargs)
+    else:
+        func(*args, **kwargs)
+
+
+def store_rows(key, rows):
+    """Запись строк одного вида (graph / cloud / hist / messages) во все хранилища"""
+    if not rows:
+        return
+    if key == "messages" and NEAR_DUP_ENABLED:
+        rows = NEAR_DUPLICATES.assign(rows)
+    if CSV_SINK is not None:
+        CSV_SINK.write(key, rows)
+    else:
+        append_to_csv(CSV_FILES[key], rows, CSV_HEADERS[key])
+    if key == "cloud" and CLOUD_SERIES_ENABLED:
+        # Облако в SQLite хранится только рядами с интернированными id, без строк cloud_tags
+        append_cloud_series(rows)
+    else:
+        append_to_sqlite(SQLITE_TABLES[key], rows)
+    if key == "messages" and NEAR_DUP_ENABLED:
+        save_message_clusters()
+
+
+# ===================== ОГРАНИЧЕНИЕ ЧАСТОТЫ ЗАПРОСОВ =====================
+
+class HostRateLimiter:
+    """Token bucket на каждый хост, общий для всех потоков процесса, а при state_path —
+    и для всех процессов, работающих с тем же файлом состояния (читается и пишется под flock).
+
+    Ведро пополняется одним токеном за interval секунд и вмещает не более burst
+    токенов. По результату каждого обращения (report) интервал хоста адаптируется:
+    429, ошибки и медленные ответы умножают его на backoff (а Retry-After
+    приостанавливает хост целиком), быстрые успешные ответы плавно возвращают
+    его к min_interval. Счётчики запросов и ожидания — свои у каждого процесса.
+    """
+
+    def __init__(self, start_interval=RATE_LIMIT_START_INTERVAL, min_interval=RATE_LIMIT_MIN_INTERVAL,
+                 max_interval=RATE_LIMIT_MAX_INTERVAL, burst=RATE_LIMIT_BURST,
+                 slow_seconds=RATE_LIMIT_SLOW_SECONDS, backoff=RATE_LIMIT_BACKOFF, recovery=RATE_LIMIT_RECOVERY,
+                 state_path=None, state_ttl=RATE_LIMIT_STATE_TTL):
+        self.start_interval = start_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.burst = burst
+        self.slow_seconds = slow_seconds
+        self.backoff = backoff
+        self.recovery = recovery
+        self.state_path = state_path
+        self.state_ttl = state_ttl
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.hosts = {}
+
+    @staticmethod
+    def host_of(url):
+        return urlsplit(url).hostname or url
+
+    @contextmanager
+    def _locked_buckets(self):
+        """Вёдра всех хостов на время изменения: в памяти или из файла состояния под flock"""
+        with self.lock:
+            if not self.state_path:
+                yield self.buckets
+                return
+            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+            with open(self.state_path + ".lock", "w") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    with open(self.state_path, encoding="utf-8") as f:
+                        buckets = json.load(f)
+                except (OSError, ValueError):
+                    buckets = {}
+                yield buckets
+                tmp_path = f"{self.state_path}.{os.getpid()}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(buckets, f)
+                os.replace(tmp_path, self.state_path)
+
+    def _bucket(self, buckets, host, now):
+        bucket = buckets.get(host)
+        if bucket is None or now - bucket["updated"] > self.state_ttl:
+            bucket = {"interval": self.start_interval, "tokens": float(self.burst), "updated": now, "paused_until": 0.0}
+            buckets[host] = bucket
+        return bucket
+
+    def _stats(self, host):
+        stats = self.hosts.get(host)
+        if stats is None:
+            stats = {"interval": self.start_interval, "requests": 0, "throttled": 0, "errors": 0, "waited": 0.0}
+            self.hosts[host] = stats
+        return stats
+
+    def acquire(self, url):
+        """Дождаться разрешения на обращение к хосту url"""
+        host = self.host_of(url)
+        waited = 0.0
+        while True:
+            with self._locked_buckets() as buckets:
+                # Время — по часам системы: вёдра делят процессы, у которых свой monotonic
+                now = time.time()
+                bucket = self._bucket(buckets, host, now)
+                bucket["tokens"] = min(self.burst,
+                                       bucket["tokens"] + max(0.0, now - bucket["updated"]) / bucket["interval"])
+                bucket["updated"] = now
+                delay = max(0.0, bucket["paused_until"] - now)
+                if delay == 0.0:
+                    if bucket["tokens"] >= 1.0:
+                        bucket["tokens"] -= 1.0
+                        stats = self._stats(host)
+                        stats["interval"] = bucket["interval"]
+                        stats["requests"] += 1
+                        stats["waited"] += waited
+                        return waited
+                    delay = (1.0 - bucket["tokens"]) * bucket["interval"]
+            time.sleep(delay)
+            waited += delay
+
+    def report(self, url, latency=None, status=None, error=False, retry_after=None):
+        """Результат обращения: адаптация интервала хоста"""
+        host = self.host_of(url)
+        with self._locked_buckets() as buckets:
+            now = time.time()
+            bucket = self._bucket(buckets, host, now)
+            stats = self._stats(host)
+            throttled = status == 429 or (status is not None and status >= 500)
+            if throttled or error or (latency is not None and latency > self.slow_seconds):
+                bucket["interval"] = min(self.max_interval, bucket["interval"] * self.backoff)
+                bucket["tokens"] = min(bucket["tokens"], 0.0)
+                if throttled:
+                    stats["throttled"] += 1
+                if error:
+                    stats["errors"] += 1
+                if retry_after:
+                    bucket["paused_until"] = max(bucket["paused_until"], now + retry_after)
+            else:
+                bucket["interval"] = max(self.min_interval, bucket["interval"] * self.recovery)
+            stats["interval"] = bucket["interval"]
+
+    def stats(self):
+        with self.lock:
+            return {host: {k: (round(v, 2) if isinstance(v, float) else v) for k, v in stats.items()}
+                    for host, stats in self.hosts.items()}
+
+    def report_stats(self):
+        for host, st in self.stats().items():
+            print(f"Лимит {host}: интервал {st['interval']} с, запросов {st['requests']}, "
+                  f"429/5xx {st['throttled']}, ошибок {st['errors']}, ожидание {st['waited']} с")
+
+
+RATE_LIMITER = HostRateLimiter(state_path=RATE_LIMIT_STATE_PATH) if RATE_LIMIT_ENABLED else None
+
+
+def parse_retry_after(value):
+    """Значение заголовка Retry-After в секундах (поддерживаются только секунды)"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def rate_limited(url):
+    """Ожидание слота для обращения к хосту url (без лимитера — сразу)"""
+    if RATE_LIMITER is not None:
+        RATE_LIMITER.acquire(url)
+
+
+def report_request(url, started, status=None, error=False, retry_after=None):
+    """Сообщить лимитеру о результате обращения, начатого в момент started (time.monotonic)"""
+    if RATE_LIMITER is not None:
+        RATE_LIMITER.report(url, latency=time.monotonic() - started, status=status,
+                            error=error, retry_after=retry_after)
+
+
+def load_page(driver, url):
+    """driver.get через лимитер: время загрузки и ошибки влияют на темп обращений к хосту"""
+    rate_limited(url)
+    started = time.monotonic()
+    try:
+        driver.get(url)
+    except Exception:
+        report_request(url, started, error=True)
+        raise
+    report_request(url, started)
+    set_page_time()
+    record_page_load(driver, url, time.monotonic() - started)
+    if BROWSER is not None:
+        BROWSER.pages += 1
+
+
+def http_request(method, url, **kwargs):
+    """requests.request через лимитер с учётом 429 / 5xx и Retry-After"""
+    rate_limited(url)
+    started = time.monotonic()
+    try:
+        response = requests.request(method, url, **kwargs)
+    except Exception:
+        report_request(url, started, error=True)
+        raise
+    report_request(url, started, status=response.status_code,
+                   retry_after=parse_retry_after(response.headers.get("Retry-After")))
+    return response
+
+
+# ===================== ПОЧТИ ДУБЛИКАТЫ КОММЕНТАРИЕВ (MinHash / LSH) =====================
+
+_MINHASH_PRIME = (1 << 31) - 1
+_MINHASH_RNG = np.random.RandomState(20240601)
+_MINHASH_A = _MINHASH_RNG.randint(1, _MINHASH_PRIME, size=NEAR_DUP_NUM_PERM).astype(np.uint64)
+_MINHASH_B = _MINHASH_RNG.randint(0, _MINHASH_PRIME, size=NEAR_DUP_NUM_PERM).astype(np.uint64)
+
+
+def comment_shingles(text):
+    """Шинглы комментария: символьные 3-граммы отсортированных основ слов.
+
+    Сортировка делает шинглы независимыми от порядка слов ("не работает приложение"
+    и "приложение не работает!!" совпадают), стемминг — от словоформ, а 3-граммы
+    сглаживают опечатки. Число шинглов ограничено NEAR_DUP_MAX_SHINGLES.
+    """
+    stems = sorted(set(ru_stem(w) for w in RU_WORD_RE.findall(text or "")))
+    joined = " ".join(stems)
+    if len(joined) < 3:
+        return {joined} if joined else set()
+    shingles = {joined[i:i + 3] for i in range(len(joined) - 2)}
+    if len(shingles) > NEAR_DUP_MAX_SHINGLES:
+        shingles = set(sorted(shingles)[:NEAR_DUP_MAX_SHINGLES])
+    return shingles
+
+
+def minhash_signature(shingles):
+    """MinHash-сигнатура из NEAR_DUP_NUM_PERM хэшей (векторно через numpy)"""
+    if not shingles:
+        return None
+    hashes = np.fromiter((zlib.crc32(sh.encode("utf-8")) for sh in shingles), dtype=np.uint64, count=len(shingles))
+    values = (np.outer(_MINHASH_A, hashes) + _MINHASH_B[:, None]) % _MINHASH_PRIME
+    return values.min(axis=1)
+
+
+class NearDuplicateIndex:
+    """LSH-индекс кластеров комментариев одной компании за один день.
+
+    Сигнатура режется на NEAR_DUP_BANDS полос; совпадение хотя бы одной полосы
+    с кластером даёт кандидата, который подтверждается оценкой сходства Жаккара
+    с представителем кластера. Число кластеров ограничено: давно не пополнявшиеся
+    вытесняются вместе со своими корзинами.
+    """
+
+    def __init__(self, max_clusters=NEAR_DUP_MAX_CLUSTERS):
+        self.max_clusters = max_clusters
+        self.rows_per_band = NEAR_DUP_NUM_PERM // NEAR_DUP_BANDS
+        self.buckets = {}
+        self.clusters = OrderedDict()
+
+    def _band_keys(self, signature):
+        r = self.rows_per_band
+        return [(band, signature[band * r:(band + 1) * r].tobytes()) for band in range(NEAR_DUP_BANDS)]
+
+    def add(self, cluster_id, text, size=1):
+        """Добавление комментария; возвращает (cluster_id, размер кластера).
+        cluster_id — id для нового кластера, если похожего не найдено."""
+        signature = minhash_signature(comment_shingles(text))
+        if signature is None:
+            return cluster_id, size
+        keys = self._band_keys(signature)
+        for key in keys:
+            candidate = self.buckets.get(key)
+            if candidate is None or candidate not in self.clusters:
+                continue
+            cluster = self.clusters[candidate]
+            if float(np.mean(cluster["signature"] == signature)) >= NEAR_DUP_THRESHOLD:
+                cluster["size"] += size
+                self.clusters.move_to_end(candidate)
+                return candidate, cluster["size"]
+        if cluster_id in self.clusters:
+            cluster = self.clusters[cluster_id]
+            cluster["size"] += size
+            self.clusters.move_to_end(cluster_id)
+            return cluster_id, cluster["size"]
+        self.clusters[cluster_id] = {"signature": signature, "keys": keys, "size": size}
+        for key in keys:
+            self.buckets.setdefault(key, cluster_id)
+        while len(self.clusters) > self.max_clusters:
+            _, evicted = self.clusters.popitem(last=False)
+            for key in evicted["keys"]:
+                if self.buckets.get(key) not in self.clusters:
+                    self.buckets.pop(key, None)
+        return cluster_id, size
+
+
+class NearDuplicateDetector:
+    """Потоковая кластеризация: индекс на (компания, день), не более NEAR_DUP_MAX_INDEXES индексов.
+
+    Новый индекс прогревается кластерами этого дня из message_clusters, поэтому
+    повторный запуск в тот же день продолжает те же кластеры.
+    """
+
+    def __init__(self, max_indexes=NEAR_DUP_MAX_INDEXES):
+        self.max_indexes = max_indexes
+        self.indexes = OrderedDict()
+        self.updates = {}
+
+    def _index(self, company, day):
+        key = (company, day)
+        index = self.indexes.get(key)
+        if index is None:
+            index = NearDuplicateIndex()
+            for cluster_id, size, representative in load_message_clusters(company, day):
+                index.add(cluster_id, representative, size)
+            self.indexes[key] = index
+            while len(self.indexes) > self.max_indexes:
+                self.indexes.popitem(last=False)
+        self.indexes.move_to_end(key)
+        return index
+
+    def assign(self, rows):
+        """Строки сообщений -> те же строки с id кластера седьмой колонкой (после id сообщения);
+        изменения размеров кластеров копятся до pop_updates(). RowBatch заполняется на месте."""
+        batch = rows if isinstance(rows, RowBatch) else None
+        out = []
+        for i, row in enumerate(rows):
+            company, day, msg_time, _, text = row[:5]
+            cluster_id = day + "-" + hashlib.sha1(f"{company}|{text}".encode("utf-8")).hexdigest()[:12]
+            cluster_id, _ = self._index(company, day).add(cluster_id, text)
+            key = (company, day, cluster_id)
+            update = self.updates.get(key)
+            if update is None:
+                self.updates[key] = {"added": 1, "representative": text, "first": msg_time, "last": msg_time}
+            else:
+                update["added"] += 1
+                update["first"] = min(update["first"], msg_time)
+                update["last"] = max(update["last"], msg_time)
+            if batch is not None:
+                batch.columns["cluster_id"][i] = cluster_id
+            else:
+                out.append((list(row[:6]) + [None])[:6] + [cluster_id])
+        return batch if batch is not None else out
+
+    def pop_updates(self):
+        updates, self.updates = self.updates, {}
+        return updates
+
+
+NEAR_DUPLICATES = NearDuplicateDetector()
+
+
+def load_message_clusters(company, day):
+    """Кластеры компании за день из SQLite: [(cluster_id, size, representative)]"""
+    try:
+        with closing(sqlite3.connect(DB_PATH, timeout=SQLITE_TIMEOUT)) as conn:
+            return conn.execute(
+                "SELECT cluster_id, size, representative FROM message_clusters "
+                "WHERE company = ? AND cluster_date = ? ORDER BY size DESC LIMIT ?",
+                (company, day, NEAR_DUP_MAX_CLUSTERS)
+            ).fetchall()
+    except sqlite3.Error:
+        return []
+
+
+def save_message_clusters():
+    """Сохранение накопленных изменений кластеров в message_clusters"""
+    updates = NEAR_DUPLICATES.pop_updates()
+    if not updates:
+        return
+    with sqlite3.connect(DB_PATH, timeout=SQLITE_TIMEOUT) as conn:
+        conn.executemany(
+            '''
+            INSERT INTO message_clusters (company, cluster_date, cluster_id, size, representative, first_time, last_time)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (company, cluster_date, cluster_id) DO UPDATE SET
+                size = size + excluded.size,
+                first_time = MIN(first_time, excluded.first_time),
+                last_time = MAX(last_time, excluded.last_time)
+            ''',
+            [(company, day, cluster_id, u["added"], u["representative"], u["first"], u["last"])
+             for (company, day, cluster_id), u in updates.items()]
+        )
+        conn.commit()
+
+
+def message_clusters_report(date_from=None, min_size=2):
+    """Кластеры похожих комментариев для отчёта: DataFrame, крупные сверху"""
+    with closing(sqlite3.connect(DB_PATH, timeout=SQLITE_TIMEOUT)) as conn:
+        return pd.read_sql_query(
+            "SELECT company AS 'Компания', cluster_date AS 'Дата', size AS 'Количество', "
+            "first_time AS 'Первое', last_time AS 'Последнее', representative AS 'Комментарий' "
+            "FROM message_clusters WHERE cluster_date >= ? AND size >= ? "
+            "ORDER BY cluster_date DESC, size DESC",
+            conn, params=(date_from or str(START_DATE), min_size)
+        )
+
+
+# ===================== HELPERS =====================
+
+def ensure_csv_files_exist():
+    """Создать CSV-файлы с заголовками, если их ещё нет — полезно при первом запуске."""
+    for key, path in CSV_FILES.items():
+        if not os.path.exists(path):
+            df = pd.DataFrame(columns=CSV_HEADERS.get(key, []))
+            df.to_csv(path, index=False, sep=';', encoding='utf-8-sig')
+
+
+def normalize_percent(value):
+    """Нормализация процентных значений"""
+    if not value:
+        return None
+    value = value.replace("%", "").replace(",", ".").strip()
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def parse_relative_time(text):
+    """Парсинг относительного или абсолютного времени.
+    Поддерживает:
+      - "только что", "25 минут назад", "2 часа назад" и т.п.
+      - абсолютные даты "17.12.2025, 03:46"
+      - числовые метки в миллисекундах (например 1765931314342)
+    Возвращает datetime с таймзоной MSK или None при нераспознавании.
+    """
+    if not text:
+        return None
+    text = text.strip()
+    # "только что"
+    if "только" in text:
+        return NOW
+    # Числовая метка (миллисекунды или секунды)
+    if re.fullmatch(r"\d{10,16}", text):
+        try:
+            ts = int(text)
+            if ts > 10**11:
+                dt = datetime.fromtimestamp(ts / 1000, tz=pytz.UTC).astimezone(MSK)
+            else:
+                dt = datetime.fromtimestamp(ts, tz=pytz.UTC).astimezone(MSK)
+            return dt
+        except Exception:
+            pass
+    # Абсолютная дата формата "17.12.2025, 03:46" или "17.12.2025 03:46"
+    m = re.search(r"(\d{1,2}\.\d{1,2}\.\d{4})[,\s]+(\d{1,2}:\d{2})", text)
+    if m:
+        try:
+            dt = datetime.strptime(f"{m.group(1)} {m.group(2)}", "%d.%m.%Y %H:%M")
+            dt = MSK.localize(dt)
+            return dt
+        except Exception:
+            pass
+    # Относительные форматы: "25 минут назад", "2 часа назад" и т.п.
+    rel_match = re.match(r"(\d+)\s*(минут|минуты|час|часа|часов|дн|дня|дней|дн\.|недел|неделя|недель|месяц|месяца|месяцев|год|года|лет)", text)
+    if rel_match:
+        num = int(rel_match.group(1))
+        unit = rel_match.group(2)
+        try:
+            if "мин" in unit:
+                return NOW - relativedelta(minutes=num)
+            if "час" in unit:
+                return NOW - relativedelta(hours=num)
+            if unit.startswith("дн") or "дня" in unit or "дней" in unit:
+                return NOW - relativedelta(days=num)
+            if "нед" in unit:
+                return NOW - relativedelta(weeks=num)
+            if "месяц" in unit:
+                return NOW - relativedelta(months=num)
+            if "год" in unit or "лет" in unit:
+                return NOW - relativedelta(years=num)
+        except Exception:
+            return None
+    return None
+
+
+# ===================== БРАУЗЕР И ПРОФИЛЬ =====================
+
+class ProfileSlot:
+    """Слот постоянного профиля Chrome, занятый текущим процессом.
+
+    Chrome не допускает одновременной работы двух экземпляров с одним
+    user-data-dir, поэтому корень CHROME_PROFILE_DIR делится на CHROME_PROFILE_SLOTS
+    каталогов; слот занимается эксклюзивным flock на slot-N.lock и освобождается
+    при release() или завершении процесса.
+    """
+
+    def __init__(self, root=None, slots=CHROME_PROFILE_SLOTS, wait_seconds=CHROME_PROFILE_WAIT):
+        self.root = root or CHROME_PROFILE_DIR
+        self.slots = slots
+        self.wait_seconds = wait_seconds
+        self.path = None
+        self.lock_file = None
+        self.warm = False
+
+    def acquire(self):
+        os.makedirs(self.root, exist_ok=True)
+        deadline = time.monotonic() + self.wait_seconds
+        while True:
+            for n in range(self.slots):
+                lock_file = open(os.path.join(self.root, f"slot-{n}.lock"), "w")
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    lock_file.close()
+                    continue
+                self.lock_file = lock_file
+                self.path = os.path.join(self.root, f"slot-{n}")
+                self.warm = os.path.isdir(os.path.join(self.path, "cache"))
+                self._remove_stale_singletons()
+                trim_profile_cache(self.path)
+                print(f"Профиль Chrome: {self.path} ({'тёплый' if self.warm else 'холодный'} кэш)")
+                return self
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Нет свободного слота профиля в {self.root}")
+            time.sleep(1)
+
+    def _remove_stale_singletons(self):
+        """Замки Chrome от аварийно завершённого процесса: слот наш по flock, значит они устарели"""
+        for name in ("SingletonLock", "SingletonSocket", "SingletonCookie"):
+            path = os.path.join(self.path, name)
+            if os.path.lexists(path):
+                os.remove(path)
+
+    def reset(self):
+        """Удаление повреждённого профиля слота: следующий запуск начнёт с чистого"""
+        print(f"Профиль {self.path} повреждён — удаляем")
+        shutil.rmtree(self.path, ignore_errors=True)
+        self.warm = False
+
+    def apply(self, options):
+        options.add_argument(f"--user-data-dir={self.path}")
+        options.add_argument(f"--disk-cache-dir={os.path.join(self.path, 'cache')}")
+        options.add_argument(f"--disk-cache-size={CHROME_CACHE_MAX_MB * 1024 * 1024}")
+
+    def release(self):
+        if self.lock_file is not None:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+            self.lock_file.close()
+            self.lock_file = None
+
+
+def trim_profile_cache(profile_path, max_mb=CHROME_CACHE_MAX_MB):
+    """Ограничение размера кэша слота: удаляются самые старые файлы сверх лимита.
+
+    --disk-cache-size ограничивает только HTTP-кэш, а code cache и GPU-кэш растут отдельно.
+    """
+    cache_dir = os.path.join(profile_path, "cache")
+    files, total = [], 0
+    for base, _, names in os.walk(cache_dir):
+        for name in names:
+            path = os.path.join(base, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+    limit = max_mb * 1024 * 1024
+    if total <= limit:
+        return
+    for _, size, path in sorted(files):
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        if total <= limit * 0.8:
+            break
+    print(f"Кэш профиля {profile_path} сокращён до {total / 1024 / 1024:.0f} МБ")
+
+
+def build_chrome_options(profile=None):
+    """Опции Chrome для парсинга"""
+    options = ChromeOptions()
+    options.add_argument("--headless")
+    options.add_argument("--no-sandbox")
+    options.add_argument("--disable-dev-shm-usage")
+    options.add_argument("--window-size=1920,1080")
+    if CAPTURE_MODE == "network":
+        enable_network_capture(options)
+    if profile is not None:
+        profile.apply(options)
+    return options
+
+
+def start_browser():
+    """Запуск Chrome; с CHROME_PROFILE_DIR — на постоянном профиле.
+
+    Возвращает (driver, profile). Если Chrome не стартует на сохранённом профиле,
+    профиль считается повреждённым, удаляется, и запуск повторяется на чистом.
+    """
+    profile = ProfileSlot().acquire() if CHROME_PROFILE_DIR else None
+    service = ChromeService(ChromeDriverManager().install())
+    try:
+        try:
+            driver = webdriver.Chrome(service=service, options=build_chrome_options(profile))
+        except Exception as e:
+            if profile is None:
+                raise
+            print(f"Chrome не запустился с профилем {profile.path}: {e}")
+            profile.reset()
+            driver = webdriver.Chrome(service=ChromeService(ChromeDriverManager().install()),
+                                      options=build_chrome_options(profile))
+    except Exception:
+        if profile is not None:
+            profile.release()
+        raise
+    return driver, profile
+
+
+def stop_browser(driver, profile=None):
+    """Закрытие Chrome и освобождение слота профиля"""
+    try:
+        driver.quit()
+    except Exception as e:
+        print(f"Ошибка закрытия браузера: {e}")
+    finally:
+        if profile is not None:
+            profile.release()
+
+
+# Замеры загрузки страниц за запуск: [{"url", "seconds", "dom_ms", "load_ms", "resources", "cached"}]
+PAGE_LOAD_STATS = []
+
+PAGE_TIMING_JS = """
+const nav = performance.getEntriesByType('navigation')[0];
+const res = performance.getEntriesByType('resource');
+return {
+    dom_ms: nav ? nav.domContentLoadedEventEnd : null,
+    load_ms: nav ? nav.loadEventEnd : null,
+    resources: res.length,
+    cached: res.filter(r => r.transferSize === 0 && r.decodedBodySize > 0).length
+};
+"""
+
+
+def record_page_load(driver, url, seconds):
+    """Сохранение времени загрузки страницы и доли ресурсов из кэша (Navigation/Resource Timing)"""
+    try:
+        timing = driver.execute_script(PAGE_TIMING_JS) or {}
+    except Exception:
+        timing = {}
+    PAGE_LOAD_STATS.append({"url": url, "seconds": round(seconds, 3), **timing})
+
+
+def report_page_loads(profile=None):
+    """Итог по загрузкам страниц: холодный (первая страница / новый профиль) и тёплый режим"""
+    if not PAGE_LOAD_STATS:
+        return
+    warm_profile = bool(profile and profile.warm)
+    groups = {"холодные": [], "тёплые": []}
+    for i, stat in enumerate(PAGE_LOAD_STATS):
+        groups["тёплые" if warm_profile or i > 0 else "холодные"].append(stat)
+    for label, stats in groups.items():
+        if not stats:
+            continue
+        load = [st["load_ms"] for st in stats if st.get("load_ms")]
+        resources = sum(st.get("resources") or 0 for st in stats)
+        cached = sum(st.get("cached") or 0 for st in stats)
+        avg_load = f"{sum(load) / len(load):.0f} мс" if load else "н/д"
+        print(f"Загрузки страниц, {label}: {len(stats)}, среднее load {avg_load}, "
+              f"среднее driver.get {sum(st['seconds'] for st in stats) / len(stats):.2f} с, "
+              f"ресурсов из кэша {cached}/{resources}")
+
+
+def process_tree(pid):
+    """pid и все его потомки (chromedriver -> chrome -> renderer/gpu/...)"""
+    if psutil is not None:
+        try:
+            root = psutil.Process(pid)
+            return [pid] + [p.pid for p in root.children(recursive=True)]
+        except psutil.Error:
+            return []
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # поле comm в скобках может содержать пробелы: ppid идёт вторым после ")"
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    tree, stack = [], [pid]
+    while stack:
+        current = stack.pop()
+        tree.append(current)
+        stack.extend(children.get(current, []))
+    return tree
+
+
+def process_rss_mb(pids):
+    """Суммарный RSS процессов в МБ"""
+    total = 0
+    for pid in pids:
+        if psutil is not None:
+            try:
+                total += psutil.Process(pid).memory_info().rss
+            except psutil.Error:
+                pass
+            continue
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except (OSError, ValueError):
+            continue
+    return total / 1024 / 1024
+
+
+class BrowserSupervisor:
+    """Владелец единственного Chrome на время обхода.
+
+    run(service, func) выполняет func(driver) под сторожевым таймером: по истечении
+    SERVICE_DEADLINE_SECONDS дерево процессов chromedriver/Chrome убивается, из-за чего
+    зависший вызов Selenium в основном потоке сразу завершается ошибкой, а браузер
+    заменяется новым. После сервиса браузер перезапускается, если загружено
+    BROWSER_RECYCLE_PAGES страниц или RSS превысил BROWSER_RECYCLE_RSS_MB.
+    """
+
+    def __init__(self, deadline=None, recycle_pages=None, recycle_rss_mb=None):
+        self.deadline = deadline or SERVICE_DEADLINE_SECONDS
+        self.recycle_pages = recycle_pages or BROWSER_RECYCLE_PAGES
+        self.recycle_rss_mb = recycle_rss_mb or BROWSER_RECYCLE_RSS_MB
+        self.driver = None
+        self.profile = None
+        self.pages = 0
+        self.killed = False
+        self.lock = threading.Lock()
+        self.stats = {"starts": 0, "timeouts": 0, "crashes": 0, "recycles": 0}
+        self.recycle_rss = []
+
+    def start(self):
+        self.driver, self.profile = start_browser()
         try:
-            dt = datetime.strptime(f"{m.group(1)} {m.group(2)}", "%d.%m.%Y %H:%M")
-            dt = MSK.localize(dt)
-            return dt
+            self.driver.set_page_load_timeout(BROWSER_PAGE_LOAD_TIMEOUT)
+            self.driver.set_script_timeout(BROWSER_SCRIPT_TIMEOUT)
+        except Exception as e:
+            print(f"Не удалось задать таймауты браузера: {e}")
+        self.pages = 0
+        self.killed = False
+        self.stats["starts"] += 1
+        return self.driver
+
+    def pids(self):
+        try:
+            return process_tree(self.driver.service.process.pid)
         except Exception:
-            pass
-    # Относительные форматы: "25 минут назад", "2 часа назад" и т.п.
-    rel_match = re.match(r"(\d+)\s*(минут|минуты|час|часа|часов|дн|дня|дней|дн\.|недел|неделя|недель|месяц|месяца|месяцев|год|года|лет)", text)
-    if rel_match:
-        num = int(rel_match.group(1))
-        unit = rel_match.group(2)
+            return []
+
+    def rss_mb(self):
+        return process_rss_mb(self.pids()) if self.driver is not None else 0.0
+
+    def kill(self):
+        """Принудительное завершение chromedriver и всех процессов Chrome"""
+        with self.lock:
+            self.killed = True
+            for pid in reversed(self.pids()):
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+
+    def stop(self):
+        if self.driver is None:
+            return
+        if self.killed:
+            # Процессы уже убиты: quit() только потратил бы время на таймауты
+            if self.profile is not None:
+                self.profile.release()
+        else:
+            stop_browser(self.driver, self.profile)
+        self.driver = None
+        self.profile = None
+
+    def restart(self, reason):
+        print(f"Перезапуск браузера: {reason}")
+        self.stop()
+        return self.start()
+
+    def driver_alive(self):
         try:
-            if "мин" in unit:
-                return NOW - relativedelta(minutes=num)
-            if "час" in unit:
-                return NOW - relativedelta(hours=num)
-            if unit.startswith("дн") or "дня" in unit or "дней" in unit:
-                return NOW - relativedelta(days=num)
-            if "нед" in unit:
-                return NOW - relativedelta(weeks=num)
-            if "месяц" in unit:
-                return NOW - relativedelta(months=num)
-            if "год" in unit or "лет" in unit:
-                return NOW - relativedelta(years=num)
+            return self.driver.service.process.poll() is None
         except Exception:
-            return None
-    return None
+            return False
+
+    def run(self, service, func):
+        """func(driver) с жёстким бюджетом времени; при зависании — TimeoutException и новый браузер"""
+        if self.driver is None:
+            self.start()
+
+        def expire():
+            print(f"{service}: превышен бюджет {self.deadline} с — браузер будет убит и заменён")
+            self.kill()
+
+        timer = threading.Timer(self.deadline, expire)
+        timer.daemon = True
+        started = time.monotonic()
+        timer.start()
+        try:
+            return func(self.driver)
+        except Exception as e:
+            if self.killed:
+                raise TimeoutException(f"{service}: превышен бюджет {self.deadline} с") from e
+            raise
+        finally:
+            timer.cancel()
+            with self.lock:
+                killed = self.killed
+            if killed:
+                self.stats["timeouts"] += 1
+                self.restart(f"таймаут сервиса {service} ({time.monotonic() - started:.0f} с)")
+            elif not self.driver_alive():
+                self.stats["crashes"] += 1
+                self.restart(f"chromedriver завершился во время {service}")
+            else:
+                self.maybe_recycle()
+
+    def maybe_recycle(self):
+        rss = self.rss_mb()
+        if self.pages >= self.recycle_pages or rss >= self.recycle_rss_mb:
+            self.stats["recycles"] += 1
+            self.recycle_rss.append(rss)
+            self.restart(f"плановый после {self.pages} страниц, RSS {rss:.0f} МБ")
+
+    def report(self):
+        rss = f", RSS при плановых перезапусках: средний {sum(self.recycle_rss) / len(self.recycle_rss):.0f} МБ, " \
+              f"максимум {max(self.recycle_rss):.0f} МБ" if self.recycle_rss else ""
+        print(f"Браузер: запусков {self.stats['starts']}, таймаутов {self.stats['timeouts']}, "
+              f"падений {self.stats['crashes']}, плановых перезапусков {self.stats['recycles']}{rss}, "
+              f"текущий RSS {self.rss_mb():.0f} МБ")
+
+
+BROWSER = None
 
 
 # ===================== PARSING FUNCTIONS =====================
 
-def parse_graph_data(driver, service):
-    """Парсинг данных графика"""
+def fetch_chart_data(driver):
+    """Данные графика Chart.js со страницы (datasets с точками {x: мс, y})"""
     graph_js = """
     const canvas = document.querySelector('canvas[data-err="сетевые сбои"]');
     const chart = Chart.getChart(canvas);
     return chart ? chart.data : null;
     """
     try:
-        chart = driver.execute_script(graph_js)
+        return driver.execute_script(graph_js)
     except Exception:
-        chart = None
+        return None
+
+
+def parse_graph_data(driver, service):
+    """Парсинг данных графика"""
+    return chart_to_rows(fetch_chart_data(driver), service)
+
+
+def chart_to_rows(chart, service):
+    """Данные графика -> RowBatch("graph"): строки [service, date, time, complaints, failures]"""
+    graph_data = RowBatch("graph", service)
     if not chart:
-        return []
-    graph_data = []
+        return graph_data
     if len(chart["datasets"]) >= 2:
         for c, n in zip(chart["datasets"][0]["data"], chart["datasets"][1]["data"]):
-            dt = datetime.fromtimestamp(c["x"] / 1000, tz=pytz.UTC).astimezone(MSK)
-            graph_data.append([
-                service,
-                dt.strftime("%Y-%m-%d"),
-                dt.strftime("%H:%M:%S"),
-                int(c["y"]),
-                float(n["y"])
-            ])
+            graph_data.append(int(c["x"] // 1000), int(c["y"]), float(n["y"]))
     elif len(chart["datasets"]) > 0:
         for c in chart["datasets"][0]["data"]:
-            dt = datetime.fromtimestamp(c["x"] / 1000, tz=pytz.UTC).astimezone(MSK)
-            graph_data.append([
-                service,
-                dt.strftime("%Y-%m-%d"),
-                dt.strftime("%H:%M:%S"),
-                int(c["y"]),
-                float(0)
-            ])
+            graph_data.append(int(c["x"] // 1000), int(c["y"]), float(0))
     return graph_data
 
 
@@ -294,69 +3177,345 @@ def parse_cloud_tags(driver):
     return tags or []
 
 
-def parse_histograms(soup, service):
-    """Парсинг гистограмм"""
-    hist_data = []
-    for span in soup.select("label span.region"):
-        percent = normalize_percent(span.get("data-pos", ""))
-        if percent is not None:
-            hist_data.append([
-                service, RUN_DATE, "Регион",
-                span.find_previous("a").text.strip(), percent
-            ])
-    for span in soup.select("label span.cause"):
-        percent = normalize_percent(span.get("data-pos", ""))
-        if percent is not None:
-            hist_data.append([
-                service, RUN_DATE, "Неполадка",
-                span.find_previous("a").text.strip(), percent
-            ])
-    for span in soup.select("div.os span[data-size]"):
-        text = span.text.strip()
+def cloud_tags_to_rows(service, tags):
+    cloud_data = RowBatch("cloud", service)
+    for t in tags:
+        cloud_data.append(t.get("word"), round(float(t.get("freq", 0)), 2))
+    return cloud_data
+
+
+class HistogramExtractor(HTMLParser):
+    """Однопроходный разбор гистограмм по потоку тегов, без построения дерева.
+
+    Повторяет выборки прежней версии на BeautifulSoup:
+      - "label span.region" / "label span.cause" — процент из data-pos, название —
+        текст ближайшего предшествующего в документе <a> (как find_previous("a"));
+      - "div.os span[data-size]" — текст вида "45% Android".
+    Текст <a> и span устройств накапливается, пока элемент открыт, поэтому
+    названия, которые заканчиваются после span, собираются полностью.
+    """
+
+    VOID_TAGS = {
+        "area", "base", "br", "col", "embed", "hr", "img", "input", "keygen", "link",
+        "menuitem", "meta", "param", "source", "track", "wbr",
+        "basefont", "bgsound", "command", "frame", "image", "isindex", "nextid", "spacer",
+    }
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.stack = []
+        self.label_depth = 0
+        self.os_div_depth = 0
+        self.last_a = None
+        self.open_collectors = []
+        self.regions = []
+        self.causes = []
+        self.devices = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        classes = (attrs.get("class") or "").split()
+        collector = None
+        if tag == "a":
+            collector = []
+            self.last_a = collector
+        elif tag == "span":
+            if self.label_depth and ("region" in classes or "cause" in classes):
+                target = self.regions if "region" in classes else self.causes
+                if self.last_a is not None:
+                    target.append((attrs.get("data-pos") or "", self.last_a))
+            if self.os_div_depth and "data-size" in attrs:
+                collector = []
+                self.devices.append(collector)
+        if tag in self.VOID_TAGS:
+            return
+        is_label = tag == "label"
+        is_os_div = tag == "div" and "os" in classes
+        self.label_depth += is_label
+        self.os_div_depth += is_os_div
+        if collector is not None:
+            self.open_collectors.append(collector)
+        self.stack.append((tag, is_label, is_os_div, collector))
+
+    def handle_startendtag(self, tag, attrs):
+        # <span .../> и т.п.: элемент без содержимого
+        self.handle_starttag(tag, attrs)
+        if tag not in self.VOID_TAGS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if not any(item[0] == tag for item in self.stack):
+            return
+        while self.stack:
+            name, is_label, is_os_div, collector = self.stack.pop()
+            self.label_depth -= is_label
+            self.os_div_depth -= is_os_div
+            if collector is not None:
+                self.open_collectors.remove(collector)
+            if name == tag:
+                break
+
+    def handle_data(self, data):
+        for collector in self.open_collectors:
+            collector.append(data)
+
+
+def parse_histograms(html, service):
+    """Парсинг гистограмм из HTML страницы за один проход"""
+    if not isinstance(html, str):
+        html = str(html)
+    extractor = HistogramExtractor()
+    extractor.feed(html)
+    extractor.close()
+    hist_data = RowBatch("hist", service)
+    for kind, items in (("Регион", extractor.regions), ("Неполадка", extractor.causes)):
+        for raw, name_parts in items:
+            percent = normalize_percent(raw)
+            if percent is not None:
+                hist_data.append(kind, "".join(name_parts).strip(), percent)
+    for text_parts in extractor.devices:
+        text = "".join(text_parts).strip()
         if "%" in text:
             raw, name = text.split("%", 1)
             percent = normalize_percent(raw)
             if percent is not None:
-                hist_data.append([
-                    service, RUN_DATE, "Устройство",
-                    name.strip(), percent
-                ])
+                hist_data.append("Устройство", name.strip(), percent)
     return hist_data
 
 
+# ===================== ПЕРЕХВАТ ОТВЕТОВ ПАГИНАЦИИ (CDP) =====================
+
+def enable_network_capture(options):
+    """Включить performance-лог Chrome: из него читаются события Network.* DevTools"""
+    options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+
+
+def drain_performance_log(driver):
+    """Очистить накопленный performance-лог, чтобы после клика видеть только новые ответы"""
+    try:
+        driver.get_log("performance")
+    except Exception:
+        pass
+
+
+def _collect_html_and_cursor(value, html_parts, cursors):
+    """Рекурсивный обход JSON-ответа: HTML-фрагменты с сообщениями и значение курсора"""
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key in ("last", "data-last", "data_last", "dataLast") and isinstance(item, (str, int)):
+                cursors.append(str(item))
+            else:
+                _collect_html_and_cursor(item, html_parts, cursors)
+    elif isinstance(value, list):
+        for item in value:
+            _collect_html_and_cursor(item, html_parts, cursors)
+    elif isinstance(value, str) and "data-text" in value:
+        html_parts.append(value)
+
+
+def parse_pagination_body(body):
+    """Разбор тела ответа пагинации (HTML или JSON с HTML внутри).
+    Возвращает (фрагмент BeautifulSoup, курсор или None) либо None, если сообщений в ответе нет."""
+    if not body:
+        return None
+    html_parts, cursors = [], []
+    stripped = body.lstrip()
+    if stripped.startswith(("{", "[")):
+        try:
+            _collect_html_and_cursor(json.loads(stripped), html_parts, cursors)
+        except ValueError:
+            html_parts = [body]
+    else:
+        html_parts = [body]
+    html = "".join(html_parts)
+    if "data-text" not in html:
+        return None
+    return BeautifulSoup(html, "html.parser"), (cursors[-1] if cursors else None)
+
+
+def wait_pagination_response(driver, timeout=NETWORK_CAPTURE_TIMEOUT, dom_progress=None):
+    """Ожидание XHR/fetch-ответа с новыми сообщениями после клика "Показать".
+
+    Сигнал завершения — событие Network.loadingFinished для ответа, тело которого
+    содержит span[data-text]; тело забирается через Network.getResponseBody.
+    Возвращает результат parse_pagination_body или None по таймауту. dom_progress(driver) —
+    страница уже обновилась: тогда лог просматривается ещё раз, и если ответа в нём нет,
+    ожидание заканчивается сразу, не дожидаясь таймаута (вызывающий разберёт DOM).
+    """
+    deadline = time.monotonic() + timeout
+    pending = {}
+    dom_changed = False
+    while time.monotonic() < deadline:
+        try:
+            entries = driver.get_log("performance")
+        except Exception as e:
+            print(f"performance-лог недоступен: {e}")
+            return None
+        for entry in entries:
+            try:
+                message = json.loads(entry["message"])["message"]
+            except (KeyError, ValueError, TypeError):
+                continue
+            method = message.get("method")
+            params = message.get("params", {})
+            request_id = params.get("requestId")
+            if method == "Network.responseReceived":
+                response = params.get("response", {})
+                if params.get("type") in ("XHR", "Fetch") and response.get("status", 0) < 400:
+                    pending[request_id] = response.get("url")
+            elif method == "Network.loadingFailed":
+                pending.pop(request_id, None)
+            elif method == "Network.loadingFinished" and request_id in pending:
+                url = pending.pop(request_id)
+                try:
+                    result = driver.execute_cdp_cmd("Network.getResponseBody", {"requestId": request_id})
+                except Exception as e:
+                    print(f"Не удалось получить тело ответа {url}: {e}")
+                    continue
+                body = result.get("body", "")
+                if result.get("base64Encoded"):
+                    body = base64.b64decode(body).decode("utf-8", errors="replace")
+                parsed = parse_pagination_body(body)
+                if parsed is not None:
+                    print(f"Перехвачен ответ пагинации: {url}")
+                    return parsed
+        if dom_changed:
+            return None
+        dom_changed = dom_progress is not None and dom_progress(driver)
+        time.sleep(0.1)
+    return None
+
+
 # ===================== PARSER FOR USER MESSAGES (FIXED) =====================
 
-def parse_user_messages(driver, wait, service, max_clicks=100):
-    """Надёжный парсер сообщений: сначала парсим видимые сообщения, затем кликаем 'Показать ещё' и парсим добавившиеся id."""
-    messages_data = []
+def page_message_ids(driver):
+    """id сообщений (span[data-text] в div.report), которые сейчас есть на странице"""
+    try:
+        return driver.execute_script(
+            "const root = document.querySelector('div.report') || document;"
+            "return Array.from(root.querySelectorAll('span[data-text]'), s => s.getAttribute('data-text'));"
+        ) or []
+    except Exception:
+        soup = BeautifulSoup(driver.page_source, "html.parser")
+        report = soup.find("div", class_="report") or soup
+        return [s.get("data-text") for s in report.find_all("span", attrs={"data-text": True})]
+
+
+def parse_message_span(span_id):
+    """span[data-text=id] -> (datetime, ник, текст) или None, если нет времени/текста"""
+    author_span = span_id.find_next(lambda tag: tag.name == "span" and tag.has_attr("data-author"))
+    nick = (author_span.text.strip() if author_span else "Гость")
+    time_span = span_id.find_next(lambda tag: tag.name == "span" and tag.has_attr("data-tick"))
+    dt = parse_relative_time(time_span.text.strip() if time_span else "")
+    text_div = None
+    if time_span:
+        text_div = time_span.find_next(lambda tag: tag.name == "div")
+    if not text_div:
+        text_div = span_id.find_next("div")
+    if not dt or not text_div:
+        return None
+    return dt, nick, text_div.text.strip()
+
+
+def parse_messages_html(html, service):
+    """Все сообщения сохранённой страницы (без браузера) до первого старше START_DATE"""
+    soup = BeautifulSoup(html, "html.parser")
+    report = soup.find("div", class_="report") or soup
+    rows, seen = RowBatch("messages", service), set()
+    for span_id in report.find_all("span", attrs={"data-text": True}):
+        mid = span_id.get("data-text")
+        if not mid or mid in seen:
+            continue
+        seen.add(mid)
+        entry = parse_message_span(span_id)
+        if not entry:
+            continue
+        dt, nick, text = entry
+        if dt.date() < START_DATE:
+            break
+        rows.append(to_epoch(dt), nick, text, mid, None)
+    return rows
+
+
+def parse_user_messages(driver, wait, service, max_clicks=100, resume=None, backfill=None):
+    """Надёжный парсер сообщений: сначала парсим видимые сообщения, затем кликаем 'Показать ещё' и парсим добавившиеся id.
+
+    resume — контрольная точка раздела messages прошлого (прерванного) запуска. Если в ней есть
+    курсор data-last, начальный блок уже сохранён: он пропускается, а перед первым кликом курсор
+    кнопки подменяется сохранённым, чтобы подгрузка продолжилась с места остановки.
+
+    backfill — окно дозагрузки {"oldest", "newest", "section", "older_section", "sweep_id", "deadline"}:
+    сообщения новее newest пропускаются, на первом старше oldest пагинация останавливается, а курсор
+    этого блока передаётся разделу older_section (заданию предыдущего диапазона). Вместо границы
+    сохранённых пропускаются все уже сохранённые за дни окна id, а сообщения пишутся пачками по
+    BACKFILL_BATCH_ROWS. После deadline (time.monotonic) пагинация останавливается на контрольной
+    точке, и функция возвращает True (без продвижения — RuntimeError).
+    """
+    messages_data = RowBatch("messages", service)
     seen_ids = set()
     consecutive_failures = 0
     max_consecutive_failures = 4
+    resume_cursor = (resume or {}).get("last_cursor")
+    network_capture = CAPTURE_MODE == "network"
+    section = backfill["section"] if backfill else "messages"
+    checkpoint_sweep = backfill["sweep_id"] if backfill else None
+    batch_rows = BACKFILL_BATCH_ROWS if backfill else 1
+    paused = False
+
+    if backfill:
+        known_ids, latest_saved = load_stored_message_ids(
+            service, backfill["oldest"].date(), (backfill["newest"] - timedelta(seconds=1)).date()), None
+    elif HWM_ENABLED:
+        known_ids, latest_saved = load_high_water_mark(service)
+    else:
+        known_ids, latest_saved = set(), None
+    stop_before = latest_saved - timedelta(minutes=HWM_OVERLAP_MINUTES) if latest_saved else None
+    known_hits = 0
+    if known_ids or latest_saved:
+        print(f"Граница сохранённых: {len(known_ids)} id, последнее сообщение {latest_saved}")
+
+    def flush_batch(batch_ids, cursor, force=False):
+        """Запись накопленных сообщений (при force — любого их числа) и контрольная точка с курсором"""
+        if not messages_data or (len(messages_data) < batch_rows and not force):
+            return
+        count = len(messages_data)
+        save_messages_batch(messages_data)
+        last_id = next((i for i in reversed(batch_ids) if i in seen_ids), None)
+        persist(save_checkpoint, service, section, last_cursor=cursor, last_message_id=last_id,
+                messages_added=count, sweep_id=checkpoint_sweep)
 
     def parse_ids_from_report(report, ids_list, out_messages, seen_set):
+        nonlocal known_hits
         parsed = 0
         for mid in ids_list:
             try:
                 if not mid or mid in seen_set:
                     continue
+                if mid in known_ids:
+                    seen_set.add(mid)
+                    if backfill:
+                        continue
+                    # Уже сохранено прошлым запуском: после небольшого перекрытия дальше не листаем
+                    known_hits += 1
+                    if known_hits >= HWM_OVERLAP:
+                        print(f"Дошли до сохранённых ранее сообщений (id {mid}).")
+                        return parsed, True
+                    continue
                 span_id = report.find("span", attrs={"data-text": mid})
-                if not span_id:
+                entry = parse_message_span(span_id) if span_id else None
+                if not entry:
                     continue
-                author_span = span_id.find_next(lambda tag: tag.name == "span" and tag.has_attr("data-author"))
-                nick = (author_span.text.strip() if author_span else "Гость")
-                time_span = span_id.find_next(lambda tag: tag.name == "span" and tag.has_attr("data-tick"))
-                dt = parse_relative_time(time_span.text.strip() if time_span else "")
-                text_div = None
-                if time_span:
-                    text_div = time_span.find_next(lambda tag: tag.name == "div")
-                if not text_div:
-                    text_div = span_id.find_next("div")
-                if not dt or not text_div:
+                dt, nick, text = entry
+                if backfill and dt >= backfill["newest"]:
+                    # Новее диапазона задания: его сохраняет другое задание
+                    seen_set.add(mid)
                     continue
-                if dt.date() < START_DATE:
+                if (dt < backfill["oldest"]) if backfill else (dt.date() < START_DATE):
+                    return parsed, True
+                if stop_before and dt < stop_before:
+                    print(f"Сообщение {mid} старше границы сохранённых ({dt:%Y-%m-%d %H:%M}).")
                     return parsed, True
-                msg_text = text_div.text.strip()
-                out_messages.append([service, dt.strftime("%Y-%m-%d"), dt.strftime("%H:%M:%S"), nick, msg_text])
+                out_messages.append(to_epoch(dt), nick, text, mid, None)
                 seen_set.add(mid)
                 parsed += 1
             except Exception as e:
@@ -364,22 +3523,34 @@ def parse_user_messages(driver, wait, service, max_clicks=100):
                 continue
         return parsed, False
 
-    # 1) Парсим начальные видимые сообщения
+    # 1) Парсим начальные видимые сообщения (при возобновлении они уже сохранены)
     soup_init = BeautifulSoup(driver.page_source, "html.parser")
     report_init = soup_init.find("div", class_="report") or soup_init
     ids_init = [s.get("data-text") for s in report_init.find_all("span", attrs={"data-text": True})]
+    batch_ids, batch_cursor = [], None
+    if resume_cursor:
+        print(f"Возобновление пагинации с курсора data-last={resume_cursor} "
+              f"(ранее сохранено {resume.get('messages_saved', 0)} сообщений)")
+        ids_init = []
     if ids_init:
         parsed_count, reached_old = parse_ids_from_report(report_init, ids_init, messages_data, seen_ids)
-        if parsed_count:
-            print(f"Парсинг начального блока: найдено {parsed_count} сообщений, сохраняем.")
-            save_messages_batch(messages_data)
-            messages_data.clear()
+        print(f"Парсинг начального блока: найдено {parsed_count} сообщений.")
+        try:
+            cursor_init = driver.find_element(By.XPATH, "//button[contains(@data-title, 'Показать') or contains(@aria-label, 'Показать') or contains(text(), 'Показать')]").get_attribute("data-last")
+        except Exception:
+            cursor_init = None
+        batch_ids, batch_cursor = ids_init, cursor_init
+        flush_batch(batch_ids, batch_cursor, force=reached_old)
         if reached_old:
-            print("В начальном блоке обнаружены сообщения старше START_DATE — завершаем.")
-            return
+            print("В начальном блоке обнаружены сообщения старше границы периода — завершаем.")
+            return False
 
     # 2) Основной цикл кликов
     for attempt in range(max_clicks):
+        if backfill and time.monotonic() >= backfill["deadline"]:
+            print("Бюджет задания дозагрузки исчерпан — остановка на контрольной точке.")
+            paused = True
+            break
         print(f"\nПопытка загрузки #{attempt + 1}")
         try:
             button = wait.until(
@@ -391,22 +3562,38 @@ def parse_user_messages(driver, wait, service, max_clicks=100):
             print(f"Кнопка не найдена: {e}")
             break
 
-        soup_before = BeautifulSoup(driver.page_source, "html.parser")
-        report_before = soup_before.find("div", class_="report") or soup_before
-        ids_before = [s.get("data-text") for s in report_before.find_all("span", attrs={"data-text": True})]
-        set_before = set(filter(None, ids_before))
+        if network_capture:
+            # Новые сообщения придут в ответе на клик: очищаем лог, чтобы видеть только его
+            drain_performance_log(driver)
+        # id, уже стоящие на странице, — база нового блока и при перехвате, и при разборе DOM
+        # (после возобновления на странице есть сохранённые прошлым запуском, но не seen_ids)
+        ids_before = page_message_ids(driver)
+        set_before = set(filter(None, ids_before)) | seen_ids
+
+        if resume_cursor:
+            try:
+                driver.execute_script("arguments[0].setAttribute('data-last', arguments[1]);", button, resume_cursor)
+            except Exception as e:
+                print(f"Не удалось восстановить курсор пагинации: {e}")
+            resume_cursor = None
 
         try:
             last_before = button.get_attribute("data-last")
         except Exception:
             last_before = None
 
+        page_url = driver.current_url
+        rate_limited(page_url)
+        click_started = time.monotonic()
         try:
             driver.execute_script("arguments[0].scrollIntoView({behavior: 'auto', block: 'center'});", button)
             time.sleep(0.15)
             driver.execute_script("arguments[0].click();", button)
             print("Клик выполнен")
+            # Время в подгруженном блоке отсчитано от момента подгрузки, а не загрузки страницы
+            set_page_time()
         except Exception as e:
+            report_request(page_url, click_started, error=True)
             print(f"Не удалось кликнуть по кнопке: {e}")
             consecutive_failures += 1
             if consecutive_failures >= max_consecutive_failures:
@@ -415,45 +3602,64 @@ def parse_user_messages(driver, wait, service, max_clicks=100):
             time.sleep(2)
             continue
 
-        try:
-            def progress_detected(drv):
+        def progress_detected(drv):
+            try:
+                btn = drv.find_element(By.XPATH, "//button[contains(@data-title, 'Показать') or contains(@aria-label, 'Показать') or contains(text(), 'Показать')]")
+                last_now = btn.get_attribute("data-last")
+                if last_before and last_now and last_now != last_before:
+                    return True
+            except Exception:
+                pass
+            try:
+                return len(drv.find_elements(By.CSS_SELECTOR, "span[data-text]")) > len(ids_before)
+            except Exception:
+                return False
+
+        captured = wait_pagination_response(driver, dom_progress=progress_detected) if network_capture else None
+        if captured is not None:
+            report_after, last_after = captured
+            ids_after = [s.get("data-text") for s in report_after.find_all("span", attrs={"data-text": True})]
+            new_ids = [i for i in ids_after if i and i not in set_before]
+            print(f"Найдено новых id сообщений в ответе: {len(new_ids)}")
+            if last_after is None:
                 try:
-                    btn = drv.find_element(By.XPATH, "//button[contains(@data-title, 'Показать') or contains(@aria-label, 'Показать') or contains(text(), 'Показать')]")
-                    last_now = btn.get_attribute("data-last")
-                    if last_before and last_now and last_now != last_before:
-                        return True
+                    last_after = driver.find_element(By.XPATH, "//button[contains(@data-title, 'Показать') or contains(@aria-label, 'Показать') or contains(text(), 'Показать')]").get_attribute("data-last")
                 except Exception:
-                    pass
+                    last_after = None
+        else:
+            if network_capture:
+                print("Ответ пагинации не перехвачен — разбираем DOM.")
+            try:
+                wait_long = WebDriverWait(driver, 45, poll_frequency=0.5)
                 try:
-                    return len(drv.find_elements(By.CSS_SELECTOR, "span[data-text]")) > len(ids_before)
-                except Exception:
-                    return False
+                    wait_long.until(progress_detected)
+                    print("Обнаружено изменение (data-last или новые span[data-text])")
+                except TimeoutException:
+                    print("За таймаут не произошло заметного прогресса. Обработаем DOM в любом случае.")
+            except Exception as e:
+                print(f"Ошибка ожидания прогресса: {e}")
 
-            wait_long = WebDriverWait(driver, 45, poll_frequency=0.5)
-            try:
-                wait_long.until(progress_detected)
-                print("Обнаружено изменение (data-last или новые span[data-text])")
-            except TimeoutException:
-                print("За таймаут не произошло заметного прогресса. Обработаем DOM в любом случае.")
-        except Exception as e:
-            print(f"Ошибка ожидания прогресса: {e}")
+            time.sleep(0.6)
 
-        time.sleep(0.6)
+            soup_after = BeautifulSoup(driver.page_source, "html.parser")
+            report_after = soup_after.find("div", class_="report") or soup_after
+            ids_after = [s.get("data-text") for s in report_after.find_all("span", attrs={"data-text": True})]
 
-        soup_after = BeautifulSoup(driver.page_source, "html.parser")
-        report_after = soup_after.find("div", class_="report") or soup_after
-        ids_after = [s.get("data-text") for s in report_after.find_all("span", attrs={"data-text": True})]
+            new_ids = [i for i in ids_after if i and i not in set_before]
+            print(f"Найдено новых id сообщений: {len(new_ids)}")
 
-        new_ids = [i for i in ids_after if i and i not in set_before]
-        print(f"Найдено новых id сообщений: {len(new_ids)}")
+            try:
+                last_after = driver.find_element(By.XPATH, "//button[contains(@data-title, 'Показать') or contains(@aria-label, 'Показать') or contains(text(), 'Показать')]").get_attribute("data-last")
+            except Exception:
+                last_after = None
 
-        try:
-            last_after = driver.find_element(By.XPATH, "//button[contains(@data-title, 'Показать') or contains(@aria-label, 'Показать') or contains(text(), 'Показать')]").get_attribute("data-last")
-        except Exception:
-            last_after = None
+        # Время до появления новых сообщений — задержка ответа сайта на подгрузку; клик без новых
+        # сообщений — неудачное обращение, если только лента не закончилась (data-last не изменился)
+        list_ended = not new_ids and last_before and last_after and last_before == last_after
+        report_request(page_url, click_started, error=not new_ids and not list_ended)
 
         if not new_ids:
-            if last_before and last_after and last_before == last_after:
+            if list_ended:
                 print("data-last не изменился и новых id нет — достигнут конец или загрузка не продвигается.")
                 break
             else:
@@ -467,100 +3673,368 @@ def parse_user_messages(driver, wait, service, max_clicks=100):
 
         parsed_count, reached_old = parse_ids_from_report(report_after, new_ids, messages_data, seen_ids)
         print(f"Спарсено {parsed_count} новых сообщений (из {len(new_ids)} найденных id)")
-        if parsed_count:
-            save_messages_batch(messages_data)
-            messages_data.clear()
+        batch_ids, batch_cursor = new_ids, last_after
+        flush_batch(batch_ids, batch_cursor, force=reached_old)
         if reached_old:
+            if backfill and last_before:
+                # С этого блока начинается окно предыдущего диапазона: оно не листает ленту с начала
+                persist(offer_cursor, service, backfill["older_section"], last_before, sweep_id=checkpoint_sweep)
             print("Достигнут блок со старыми сообщениями — завершаем.")
-            return
+            return False
 
         consecutive_failures = 0
-        time.sleep(0.8)
 
-    if messages_data:
-        save_messages_batch(messages_data)
+    # Остаток пачки — с курсором последнего разобранного блока
+    flush_batch(batch_ids, batch_cursor, force=True)
+    if paused:
+        if not batch_cursor:
+            raise RuntimeError("бюджет задания дозагрузки исчерпан, а пагинация не продвинулась")
+        # Курсор сохраняется, даже если в пропущенных блоках не было сообщений окна
+        persist(save_checkpoint, service, section, last_cursor=batch_cursor, sweep_id=checkpoint_sweep)
 
     print(f"Завершено. Всего уникальных id: {len(seen_ids)}")
+    return paused
 
 
 # ===================== Сохранение пачки сообщений =====================
 
 def save_messages_batch(messages_data):
-    """Сохранение порции сообщений"""
+    """Сохранение порции сообщений: строки передаются новой пачке, messages_data остаётся пустой"""
     if messages_data:
-        append_to_csv(CSV_FILES["messages"], messages_data,
-                     ["Компания", "Дата парсинга", "Время", "Ник", "Комментарий"])
-        append_to_sqlite("user_messages", messages_data)
+        persist(store_rows, "messages", messages_data.take())
+
+
+# ===================== ДОЗАГРУЗКА ИСТОРИИ =====================
+
+def open_backfill(days):
+    """Обход дозагрузки за days дней -> (sweep_id, день отсчёта диапазонов).
+
+    Незавершённая дозагрузка продолжается и после полуночи: её диапазоны отсчитываются
+    от дня начала (он в начале sweep_id), поэтому задания и контрольные точки те же.
+    """
+    sweep_id = open_sweep(f"backfill-{days}d", any_day=True)
+    return sweep_id, datetime.strptime(sweep_id[:10], "%Y-%m-%d").date()
+
+
+def backfill_jobs(days, anchor, services=None):
+    """Задания "service@YYYY-MM-DD" — сервис и первый день диапазона, отсчёт от дня anchor;
+    сначала свежие диапазоны всех сервисов"""
+    jobs = []
+    for offset in range(0, days, BACKFILL_RANGE_DAYS):
+        first_day = anchor - relativedelta(days=offset + BACKFILL_RANGE_DAYS - 1)
+        jobs.extend(f"{service}@{first_day:%Y-%m-%d}" for service in (services or SERVICES))
+    return jobs
+
+
+def backfill_range(job):
+    """Задание -> (сервис, начало диапазона, конец диапазона) в MSK"""
+    service, first_day = job.split("@", 1)
+    oldest = MSK.localize(datetime.strptime(first_day, "%Y-%m-%d"))
+    newest = min(oldest + relativedelta(days=BACKFILL_RANGE_DAYS), NOW + timedelta(minutes=1))
+    return service, oldest, newest
+
+
+def seed_cursor(driver, moment):
+    """Курсор data-last для начала пагинации с момента moment.
+
+    Если курсор кнопки — числовая метка времени (мс или с), подставляется метка moment,
+    и задание сразу листает свой диапазон. Иначе курсор непрозрачный: None, пагинация идёт
+    с начала, а более новые сообщения пропускаются.
+    """
+    try:
+        current = driver.find_element(By.XPATH, "//button[contains(@data-title, 'Показать') or contains(@aria-label, 'Показать') or contains(text(), 'Показать')]").get_attribute("data-last")
+    except Exception:
+        return None
+    if not current or not current.isdigit() or len(current) not in (10, 13):
+        return None
+    scale = 1000 if len(current) == 13 else 1
+    return str(int(moment.timestamp() * scale))
+
+
+def parse_backfill_range(driver, wait, job, sweep_id):
+    """Сообщения одного задания дозагрузки с учётом его контрольной точки.
+
+    Окно задания шире диапазона на BACKFILL_OVERLAP_MINUTES с каждой стороны: сообщения у границы
+    дней попадают в оба соседних окна, а повтор отсекается по message_id. Дойдя до начала окна,
+    задание передаёт курсор заданию предыдущего диапазона (offer_cursor) — при непрозрачном курсоре
+    оно начинает оттуда, а не листает ленту с начала. Исчерпав BACKFILL_JOB_SECONDS, задание
+    сохраняет курсор и завершается JobPaused.
+    """
+    service, oldest, newest = backfill_range(job)
+    section = f"backfill@{oldest:%Y-%m-%d}"
+    checkpoint = load_checkpoints(service, sweep_id=sweep_id).get(section, {})
+    if checkpoint.get("done"):
+        print(f"Диапазон {job} уже загружен.")
+        return
+    overlap = timedelta(minutes=BACKFILL_OVERLAP_MINUTES)
+    load_page(driver, f"https://detector404.ru/{service}")
+    time.sleep(4)
+    cursor = checkpoint.get("last_cursor")
+    if not cursor and newest < NOW:
+        cursor = seed_cursor(driver, newest + overlap)
+    resume = dict(checkpoint, last_cursor=cursor) if cursor else None
+    print(f"Дозагрузка {service}: {oldest:%Y-%m-%d %H:%M} — {newest:%Y-%m-%d %H:%M}, "
+          f"курсор {cursor or 'с начала ленты'}")
+    older_section = f"backfill@{oldest - relativedelta(days=BACKFILL_RANGE_DAYS):%Y-%m-%d}"
+    paused = parse_user_messages(
+        driver, wait, service, max_clicks=BACKFILL_MAX_CLICKS, resume=resume,
+        backfill={"oldest": oldest - overlap, "newest": newest + overlap, "section": section,
+                  "older_section": older_section, "sweep_id": sweep_id,
+                  "deadline": time.monotonic() + BACKFILL_JOB_SECONDS})
+    if paused:
+        raise JobPaused(f"бюджет {BACKFILL_JOB_SECONDS} с исчерпан, продолжение с контрольной точки")
+    persist(save_checkpoint, service, section, done=True, sweep_id=sweep_id)
+
+
+def finish_backfill(sweep_id):
+    """Завершение дозагрузки: догрузка FTS и статистика планировщика"""
+    started = time.monotonic()
+    with closing(sqlite3.connect(DB_PATH, timeout=SQLITE_TIMEOUT)) as conn:
+        if FTS_ENABLED:
+            sync_messages_fts(conn)
+        conn.execute("PRAGMA optimize")
+        conn.commit()
+    print(f"FTS и статистика после дозагрузки обновлены за {time.monotonic() - started:.1f} с")
+    print(f"Итог дозагрузки {sweep_id}: {sweep_status(sweep_id)}")
+
+
+class BackfillProgress:
+    """Прогресс дозагрузки по всем воркерам: задания, сообщения и ETA по темпу этого воркера"""
+
+    def __init__(self, sweep_id):
+        self.sweep_id = sweep_id
+        self.started = time.monotonic()
+        self.finished_at_start = self.finished()
+
+    def finished(self):
+        status = sweep_status(self.sweep_id)
+        return status.get("done", 0) + status.get("failed", 0), sum(status.values())
+
+    def messages(self):
+        with closing(sqlite3.connect(DB_PATH, timeout=SQLITE_TIMEOUT)) as conn:
+            return conn.execute("SELECT COALESCE(SUM(messages_saved), 0) FROM sweep_checkpoints WHERE sweep_id = ?",
+                                (self.sweep_id,)).fetchone()[0]
+
+    def report(self):
+        finished, total = self.finished()
+        elapsed = time.monotonic() - self.started
+        messages = self.messages()
+        progressed = finished - self.finished_at_start[0]
+        if progressed > 0:
+            eta = timedelta(seconds=int(elapsed / progressed * (total - finished)))
+        else:
+            eta = "н/д"
+        print(f"Дозагрузка: заданий {finished}/{total} ({finished / max(total, 1):.0%}), "
+              f"сообщений {messages}, {progressed / max(elapsed, 1) * 3600:.1f} заданий/ч, ETA {eta}")
 
 
 # ===================== MAIN PARSING LOOP =====================
 
-def main():
-    """Основная функция парсинга"""
+def parse_service(driver, wait, service):
+    """Парсинг одного сервиса по разделам с учётом контрольных точек текущего обхода"""
+    checkpoints = load_checkpoints(service)
+    pending = [s for s in CHECKPOINT_SECTIONS if not checkpoints.get(s, {}).get("done")]
+    if not pending:
+        print("Все разделы уже обработаны в этом запуске — пропускаем.")
+        return
+    if len(pending) < len(CHECKPOINT_SECTIONS):
+        print(f"Продолжение после прерывания, осталось: {', '.join(pending)}")
+
+    load_page(driver, f"https://detector404.ru/{service}")
+    time.sleep(4)
+    page_html = driver.page_source
+    # Снимки привязаны к моменту загрузки страницы: от него отсчитывается относительное время
+    # сообщений при пересборке, и по нему снимки одного прохода собираются вместе
+    loaded_at = NOW
+    if ARCHIVE_ENABLED:
+        persist(archive_snapshot, service, "page", page_html, loaded_at)
+
+    if "graph" in pending or ARCHIVE_ENABLED:
+        chart = fetch_chart_data(driver)
+        if ARCHIVE_ENABLED and chart:
+            persist(archive_snapshot, service, "chart", chart, loaded_at)
+    if "graph" in pending:
+        graph_data = chart_to_rows(chart, service)
+        persist(store_rows, "graph", graph_data)
+        persist(save_checkpoint, service, "graph", done=True)
+
+    if "cloud" in pending or ARCHIVE_ENABLED:
+        tags = parse_cloud_tags(driver)
+        if ARCHIVE_ENABLED and tags:
+            persist(archive_snapshot, service, "cloud", tags, loaded_at)
+    if "cloud" in pending:
+        if tags:
+            persist(store_rows, "cloud", cloud_tags_to_rows(service, tags))
+        persist(save_checkpoint, service, "cloud", done=True)
+
+    if "hist" in pending:
+        hist_data = parse_histograms(page_html, service)
+        persist(store_rows, "hist", hist_data)
+        persist(save_checkpoint, service, "hist", done=True)
+
+    parse_user_messages(driver, wait, service, resume=checkpoints.get("messages"))
+    if ARCHIVE_ENABLED:
+        persist(archive_snapshot, service, "final", driver.page_source, loaded_at)
+    persist(save_checkpoint, service, "messages", done=True)
+
+
+def main(worker_id=None, backfill_days=None, sweep_id=None):
+    """Основная функция парсинга.
+
+    С worker_id процесс работает воркером: берёт сервисы в аренду из sweep_jobs
+    (несколько процессов/контейнеров на общей базе), а отчёт формирует и отправляет
+    тот воркер, который первым увидит завершение всех сервисов. Воркеры присоединяются
+    к незавершённому обходу этого дня или к обходу sweep_id; после отчёта обход закрывается.
+
+    С backfill_days — дозагрузка истории сообщений за столько дней (всегда в режиме
+    воркера): задания (сервис, диапазон), запись пачками, итог — FTS и статистика вместо отчёта.
+    """
+    global WRITER, CSV_SINK, BROWSER, SQLITE_BULK, SWEEP_ID
     init_sqlite_tables()
     ensure_csv_files_exist()
+    if backfill_days:
+        SQLITE_BULK = True
+        SWEEP_ID, anchor = open_backfill(backfill_days)
+        sweep_id = enqueue_sweep(SWEEP_ID, backfill_jobs(backfill_days, anchor))
+        progress = BackfillProgress(sweep_id)
+    else:
+        SWEEP_ID = open_sweep("workers" if worker_id else "run", sweep_id)
+    if CSV_PARTITIONED:
+        CSV_SINK = CsvSink(by_service=True if worker_id else None)
+    if WRITER_ENABLED:
+        WRITER = PersistenceWriter().start()
+    if worker_id and not backfill_days:
+        sweep_id = enqueue_sweep()
 
-    options = ChromeOptions()
-    options.add_argument("--headless")
-    options.add_argument("--no-sandbox")
-    options.add_argument("--disable-dev-shm-usage")
-    options.add_argument("--window-size=1920,1080")
+    def flush_writes():
+        if WRITER is not None:
+            WRITER.flush()
+        if CSV_SINK is not None:
+            CSV_SINK.flush()
 
-    with webdriver.Chrome(
-        service=ChromeService(ChromeDriverManager().install()),
-        options=options
-    ) as driver:
-        wait = WebDriverWait(driver, 60)
-        for service in SERVICES:
-            print(f"\n=== Парсинг {service.upper()} ===")
-            try:
-                driver.get(f"https://detector404.ru/{service}")
-                time.sleep(4)
-
-                graph_data = parse_graph_data(driver, service)
-                if graph_data:
-                    append_to_csv(CSV_FILES["graph"], graph_data,
-                                ["Компания", "Дата парсинга", "Время", "Жалобы", "Сбои"])
-                    append_to_sqlite("graph_data", graph_data)
-
-                tags = parse_cloud_tags(driver)
-                if tags:
-                    cloud_data = [[service, RUN_DATE, t.get("word"), round(float(t.get("freq", 0)), 2)] for t in tags]
-                    append_to_csv(CSV_FILES["cloud"], cloud_data,
-                                ["Компания", "Дата парсинга", "Слово", "Частота"])
-                    append_to_sqlite("cloud_tags", cloud_data)
-
-                soup = BeautifulSoup(driver.page_source, "html.parser")
-                hist_data = parse_histograms(soup, service)
-                if hist_data:
-                    append_to_csv(CSV_FILES["hist"], hist_data,
-                                ["Компания", "Дата парсинга", "Тип", "Название", "Процент"])
-                    append_to_sqlite("histograms", hist_data)
-
-                parse_user_messages(driver, wait, service)
+    def run_service(service, task):
+        """Сервис в браузере и запись его данных; ошибка записи — ошибка сервиса"""
+        try:
+            BROWSER.run(service, task)
+        finally:
+            flush_writes()
+            write_error = WRITER.take_error() if WRITER is not None else None
+        if write_error is not None:
+            raise RuntimeError(f"ошибка записи данных {service}: {write_error}")
 
-            except Exception as e:
-                print(f"Ошибка при парсинге {service}: {e}")
-                continue
+    def finalize():
+        flush_writes()
+        if backfill_days:
+            finish_backfill(sweep_id)
+            return
+        if RETENTION_ON_RUN and retention_due():
+            run_retention()
+        create_excel_report()
+        send_to_telegram()
+
+    def terminate(signum, frame):
+        """SIGTERM (docker stop): браузер убивается сразу, а очередь записи дописывается
+        и поток писателя дожидается в finally ниже — до SIGKILL, который придёт следом"""
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        print("Получен SIGTERM: дописываем очередь записи и завершаемся")
+        if BROWSER is not None:
+            BROWSER.kill()
+        raise SystemExit(128 + signum)
+
+    def parse_with(service):
+        return lambda driver: parse_service(driver, WebDriverWait(driver, 60), service)
+
+    def backfill_with(job):
+        return lambda driver: parse_backfill_range(driver, WebDriverWait(driver, 60), job, sweep_id)
+
+    profile = None
+    previous_handler = signal.signal(signal.SIGTERM, terminate)
+    try:
+        BROWSER = BrowserSupervisor(deadline=BACKFILL_DEADLINE_SECONDS if backfill_days else None)
+        BROWSER.start()
+        try:
+            if worker_id:
+                def handle_service(service):
+                    try:
+                        # Сервис отмечается выполненным только после записи его данных
+                        run_service(service, backfill_with(service) if backfill_days else parse_with(service))
+                    finally:
+                        if WRITER is not None:
+                            WRITER.report()
+                        if backfill_days:
+                            progress.report()
+                run_jobs(worker_id, handle_service, sweep_id=sweep_id, finalize=finalize)
+            else:
+                for service in SERVICES:
+                    print(f"\n=== Парсинг {service.upper()} ===")
+                    try:
+                        run_service(service, parse_with(service))
+                    except Exception as e:
+                        print(f"Ошибка при парсинге {service}: {e}")
+                        continue
+                    finally:
+                        if WRITER is not None:
+                            WRITER.report()
+        finally:
+            profile = BROWSER.profile
+            BROWSER.report()
+            BROWSER.stop()
+            BROWSER = None
+    finally:
+        # Дописываем очередь даже при падении браузера или SIGTERM
+        if WRITER is not None:
+            WRITER.close()
+            WRITER.report("Запись завершена")
+            WRITER = None
+        if CSV_SINK is not None:
+            CSV_SINK.close()
+            CSV_SINK = None
+        signal.signal(signal.SIGTERM, previous_handler)
+        SQLITE_BULK = False
+        if RATE_LIMITER is not None:
+            RATE_LIMITER.report_stats()
+        report_page_loads(profile)
+        if ARCHIVE_ENABLED:
+            train_archive_dicts()
+            archive_stats()
 
-    create_excel_report()
-    send_to_telegram()
+    if not worker_id:
+        # Все сервисы пройдены: следующий запуск начнёт новый обход
+        close_sweep(SWEEP_ID)
+        if RETENTION_ON_RUN and retention_due():
+            run_retention()
+        create_excel_report()
+        send_to_telegram()
 
 
 # ===================== Создание Excel файла =====================
 
-def create_excel_report():
-    """Создание итогового Excel файла"""
+def create_excel_report(date_from=None, date_to=None):
+    """Создание итогового Excel файла.
+    Из дневных разделов CSV читаются только дни окна отчёта: по умолчанию с START_DATE по сегодня"""
     excel_path = os.path.join(BASE_DIR, "all_parsed_data.xlsx")
+    date_from = date_from or str(START_DATE)
+    date_to = date_to or datetime.now(MSK).strftime("%Y-%m-%d")
     sheets_data = {}
     for sheet_name, csv_path in CSV_FILES.items():
+        frames = []
         if os.path.exists(csv_path) and os.path.getsize(csv_path) > 0:
             try:
-                df = pd.read_csv(csv_path, sep=";", encoding="utf-8-sig")
-                if not df.empty:
-                    sheets_data[sheet_name] = df
+                frames.append(pd.read_csv(csv_path, sep=";", encoding="utf-8-sig"))
             except Exception as e:
                 print(f"Ошибка чтения {csv_path}: {e}")
+        if CSV_PARTITIONED:
+            frames.append(read_csv_partitions(sheet_name, date_from, date_to))
+        frames = [df for df in frames if not df.empty]
+        if frames:
+            sheets_data[sheet_name] = pd.concat(frames, ignore_index=True)
+    if NEAR_DUP_ENABLED:
+        try:
+            clusters = message_clusters_report()
+            if not clusters.empty:
+                sheets_data["clusters"] = clusters
+        except Exception as e:
+            print(f"Ошибка чтения кластеров сообщений: {e}")
     if sheets_data:
         with pd.ExcelWriter(excel_path, engine="openpyxl") as writer:
             for sheet_name, df in sheets_data.items():
@@ -579,14 +4053,14 @@ def send_to_telegram(excel_path=None):
     def send_message(text):
         url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
         try:
-            requests.post(url, json={"chat_id": CHAT_ID, "text": text}, timeout=10)
+            http_request("POST", url, json={"chat_id": CHAT_ID, "text": text}, timeout=10)
         except Exception as e:
             print(f"Ошибка отправки сообщения: {e}")
     def send_file(file_path):
         url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendDocument"
         try:
             with open(file_path, "rb") as f:
-                requests.post(url, data={"chat_id": CHAT_ID}, files={"document": f}, timeout=30)
+                http_request("POST", url, data={"chat_id": CHAT_ID}, files={"document": f}, timeout=30)
         except Exception as e:
             print(f"Ошибка отправки файла: {e}")
     ZIP_NAME = f"detector404_parsing_{RUN_DATE}.zip"
@@ -597,6 +4071,13 @@ def send_to_telegram(excel_path=None):
                 full_path = os.path.join(BASE_DIR, file_name)
                 if (os.path.isfile(full_path) and file_name != ZIP_NAME and not file_name.endswith(".zip")):
                     zipf.write(full_path, arcname=file_name)
+            if CSV_PARTITIONED:
+                # Новые строки пишутся в дневные разделы csv/<вид>/...: берём дописанные этим обходом
+                # (с его начала — в том числе до падения, если обход продолжался)
+                since = (sweep_started() if SWEEP_ID else None) or STARTED_AT
+                for relpath in csv_partitions_modified_since(since):
+                    zipf.write(os.path.join(CSV_PARTITIONS_DIR, relpath),
+                               arcname=os.path.join(os.path.basename(CSV_PARTITIONS_DIR), relpath))
         send_message(f"Парсинг detector404 завершён.\nДата: {RUN_DATE}\nСервисов: {len(SERVICES)}")
         if excel_path:
             send_file(excel_path)
@@ -610,5 +4091,262 @@ def send_to_telegram(excel_path=None):
         send_message(f"Ошибка при отправке результатов: {e}")
 
 
+# ===================== HTTP API ДЛЯ ЧТЕНИЯ =====================
+
+# ресурс -> (таблица, колонка даты, выбираемые колонки); первая колонка — курсор пагинации
+API_RESOURCES = {
+    "graph": ("graph_data", "parse_date", ["id", "parse_date", "parse_time", "complaints", "failures"]),
+    "graph_hourly": ("graph_data_hourly", "substr(hour, 1, 10)",
+                     ["rowid AS id", "hour", "points", "complaints_sum", "complaints_max", "failures_sum"]),
+    "messages": ("user_messages", "message_date",
+                 ["id", "message_date", "message_time", "nickname", "comment", "message_id", "cluster_id"]),
+    "histograms": ("histograms", "parse_date", ["id", "parse_date", "type", "name", "percent"]),
+    "cloud": ("cloud_series_rows" if CLOUD_SERIES_ENABLED else "cloud_tags", "parse_date",
+              ["id", "parse_date", "word", "frequency"]),
+}
+
+
+class ApiState:
+    """Версия данных и кеш ответов API.
+
+    Версия растёт, когда PRAGMA data_version отдельного соединения показывает
+    коммит любого другого соединения (фоновый writer, воркеры, задача хранения);
+    при этом кеш ответов сбрасывается.
+    """
+
+    def __init__(self):
+        self.conn = sqlite3.connect(DB_PATH, timeout=SQLITE_TIMEOUT, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.boot = f"{os.getpid():x}{int(time.time()):x}"
+        self.data_version = None
+        self.version = 0
+        self.modified = time.time()
+        self.cache = OrderedDict()
+        self.hits = self.misses = 0
+
+    def current(self):
+        """(версия, время последнего изменения базы)"""
+        with self.lock:
+            data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+            if data_version != self.data_version:
+                self.data_version = data_version
+                self.version += 1
+                self.modified = max(os.path.getmtime(path) for path in (DB_PATH, DB_PATH + "-wal")
+                                    if os.path.exists(path))
+                self.cache.clear()
+            return self.version, self.modified
+
+    def get(self, key):
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, version, content_type, body):
+        with self.lock:
+            if version != self.version:
+                return
+            self.cache[key] = (content_type, body)
+            while len(self.cache) > API_CACHE_ENTRIES:
+                self.cache.popitem(last=False)
+
+
+def api_query(conn, service, resource, params):
+    """Курсор по строкам ресурса с фильтрами from/to/latest, after (id) и limit"""
+    table, date_column, columns = API_RESOURCES[resource]
+    limit = max(1, min(int(params.get("limit", API_DEFAULT_LIMIT)), API_MAX_LIMIT))
+    after = int(params.get("after", 0))
+    where = ["company = ?"]
+    args = [service]
+    if params.get("latest") in ("1", "true"):
+        where.append(f"{date_column} = (SELECT MAX({date_column}) FROM {table} WHERE company = ?)")
+        args.append(service)
+    for name, op in (("from", ">="), ("to", "<=")):
+        if params.get(name):
+            datetime.strptime(params[name], "%Y-%m-%d")
+            where.append(f"{date_column} {op} ?")
+            args.append(params[name])
+    id_column = columns[0].split()[0]
+    if after:
+        where.append(f"{id_column} > ?")
+        args.append(after)
+    sql = (f"SELECT {', '.join(columns)} FROM {table} WHERE {' AND '.join(where)} "
+           f"ORDER BY {id_column} LIMIT ?")
+    names = [c.split()[-1] for c in columns]
+    return names, conn.execute(sql, args + [limit + 1]), limit
+
+
+def api_stream(names, cursor, limit, fmt, meta):
+    """Тело ответа кусками: JSON {"items": [...], "next_after", "has_more"} или CSV с заголовком"""
+    buffer = io.StringIO()
+    if fmt == "csv":
+        writer = csv.writer(buffer, delimiter=";", lineterminator="\n")
+        writer.writerow(names)
+    else:
+        buffer.write(json.dumps(meta, ensure_ascii=False)[:-1] + ', "items": [')
+    count, last_id, has_more = 0, None, False
+    for row in cursor:
+        if count == limit:
+            has_more = True
+            break
+        if fmt == "csv":
+            writer.writerow(row)
+        else:
+            buffer.write(("," if count else "") + json.dumps(dict(zip(names, row)), ensure_ascii=False))
+        count += 1
+        last_id = row[0]
+        if buffer.tell() >= 64 * 1024:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    if fmt != "csv":
+        buffer.write(f'], "count": {count}, "next_after": {json.dumps(last_id)}, "has_more": {json.dumps(has_more)}}}')
+    yield buffer.getvalue().encode("utf-8")
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    """GET /api/services, GET /api/<service>/<graph|graph_hourly|messages|histograms|cloud>"""
+    state = None
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def not_modified(self, etag, modified):
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match:
+            return etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*"
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since:
+            try:
+                return int(modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        path = [p for p in parts.path.split("/") if p]
+        params = {k: v[-1] for k, v in parse_qs(parts.query).items()}
+        if path == ["api", "services"]:
+            return self.send_json(200, {"services": SERVICES, "resources": list(API_RESOURCES)})
+        if len(path) != 3 or path[0] != "api" or path[1] not in SERVICES or path[2] not in API_RESOURCES:
+            return self.send_json(404, {"error": "ожидается /api/<service>/<resource>"})
+        service, resource = path[1], path[2]
+        fmt = params.get("format") or ("csv" if "text/csv" in self.headers.get("Accept", "") else "json")
+        if fmt not in ("json", "csv"):
+            return self.send_json(400, {"error": "format: json или csv"})
+
+        version, modified = self.state.current()
+        etag = f'"{self.state.boot}-{version}-{zlib.crc32((self.path + fmt).encode()):08x}"'
+        last_modified = formatdate(modified, usegmt=True)
+        if self.not_modified(etag, modified):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
+            self.end_headers()
+            return
+        content_type = "text/csv; charset=utf-8" if fmt == "csv" else "application/json; charset=utf-8"
+        cache_key = (self.path, fmt)
+        cached = self.state.get(cache_key)
+        if cached:
+            content_type, body = cached
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
+            self.send_header("X-Cache", "hit")
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        with closing(sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True, timeout=SQLITE_TIMEOUT)) as conn:
+            try:
+                names, cursor, limit = api_query(conn, service, resource, params)
+            except ValueError as e:
+                return self.send_json(400, {"error": f"неверный параметр: {e}"})
+            # Тело отдаётся потоком без Content-Length (соединение закрывается в конце ответа)
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
+            self.send_header("X-Cache", "miss")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            chunks, size = [], 0
+            for chunk in api_stream(names, cursor, limit, fmt, {"service": service, "resource": resource}):
+                self.wfile.write(chunk)
+                if chunks is not None:
+                    chunks.append(chunk)
+                    size += len(chunk)
+                    if size > API_CACHE_MAX_BYTES:
+                        chunks = None
+        if chunks is not None:
+            self.state.put(cache_key, version, content_type, b"".join(chunks))
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_api(host=None, port=None):
+    """Запуск HTTP API для чтения (ThreadingHTTPServer, по потоку на запрос)"""
+    init_sqlite_tables()
+    handler = type("BoundApiHandler", (ApiHandler,), {"state": ApiState()})
+    server = ThreadingHTTPServer((host or API_HOST, port or API_PORT), handler)
+    print(f"HTTP API: http://{server.server_address[0]}:{server.server_address[1]}/api/services")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Кеш API: попаданий {handler.state.hits}, промахов {handler.state.misses}")
+
+
 if __name__ == "__main__":
-    main()
+    import argparse
+    import socket
+
+    arg_parser = argparse.ArgumentParser(description="Парсер detector404.ru")
+    arg_parser.add_argument("--worker", action="store_true",
+                            help="режим воркера: брать сервисы из общей таблицы заданий в SQLite")
+    arg_parser.add_argument("--worker-id", default=None,
+                            help="имя воркера (по умолчанию hostname-pid)")
+    arg_parser.add_argument("--sweep-id", default=None,
+                            help="--worker: общий обход (по умолчанию — незавершённый обход этого дня или новый)")
+    arg_parser.add_argument("--retention", action="store_true",
+                            help="только задача хранения: прореживание, архивирование и сжатие базы")
+    arg_parser.add_argument("--serve", action="store_true",
+                            help="запустить HTTP API для чтения данных из SQLite")
+    arg_parser.add_argument("--port", type=int, default=None, help="порт HTTP API")
+    arg_parser.add_argument("--reparse", action="store_true",
+                            help="пересобрать таблицы SQLite из архива сырых страниц (без браузера)")
+    arg_parser.add_argument("--from", dest="date_from", default=None, help="--reparse: с даты YYYY-MM-DD")
+    arg_parser.add_argument("--to", dest="date_to", default=None, help="--reparse: по дату YYYY-MM-DD")
+    arg_parser.add_argument("--jobs", type=int, default=None, help="--reparse: число процессов")
+    arg_parser.add_argument("--backfill", type=int, default=None, metavar="DAYS",
+                            help="дозагрузка истории сообщений за DAYS дней (можно запускать несколько воркеров)")
+    args = arg_parser.parse_args()
+
+    if args.backfill:
+        main(worker_id=args.worker_id or f"{socket.gethostname()}-{os.getpid()}", backfill_days=args.backfill)
+    elif args.reparse:
+        rebuild_from_archive(args.date_from, args.date_to, workers=args.jobs)
+    elif args.serve:
+        serve_api(port=args.port)
+    elif args.retention:
+        init_sqlite_tables()
+        run_retention(optimize_fts=True)
+    elif args.worker:
+        main(worker_id=args.worker_id or f"{socket.gethostname()}-{os.getpid()}", sweep_id=args.sweep_id)
+    else:
+        main()
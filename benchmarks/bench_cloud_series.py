@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Сравнение текущей таблицы cloud_tags (текстовые company/word в каждой строке)
+со словарным хранилищем cloud_series: размер БД и время запросов тренда/топа.
+
+Запуск: python benchmarks/bench_cloud_series.py [--companies 11] [--words 300] [--runs 720]
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import DownDetectorParser as ddp  # noqa: E402
+
+
+def timed(label, func, repeat=20):
+    """Среднее время вызова func в миллисекундах"""
+    func()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    elapsed = (time.perf_counter() - start) / repeat * 1000
+    print(f"  {label:<38} {elapsed:8.2f} мс")
+    return elapsed
+
+
+def generate_snapshots(companies, words, runs):
+    """Синтетические снимки облака: каждый запуск — 50 случайных слов на компанию"""
+    rnd = random.Random(42)
+    vocab = [f"слово{i}" for i in range(words)]
+    start = ddp.MSK.localize(datetime(2026, 1, 1))
+    for run in range(runs):
+        moment = start + timedelta(hours=run)
+        for company in companies:
+            for word in rnd.sample(vocab, 50):
+                yield moment, [company, moment.strftime("%Y-%m-%d"), word, round(rnd.uniform(0, 100), 2)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--companies", type=int, default=len(ddp.SERVICES))
+    parser.add_argument("--words", type=int, default=300)
+    parser.add_argument("--runs", type=int, default=720)
+    args = parser.parse_args()
+    companies = ddp.SERVICES[:args.companies] or ddp.SERVICES
+
+    with tempfile.TemporaryDirectory() as tmp:
+        ddp.DB_PATH = os.path.join(tmp, "bench.db")
+        with sqlite3.connect(ddp.DB_PATH) as conn:
+            conn.execute("CREATE TABLE cloud_tags (id INTEGER PRIMARY KEY AUTOINCREMENT, company TEXT, "
+                         "parse_date TEXT, word TEXT, frequency REAL)")
+            ddp.init_cloud_series(conn)
+            legacy, series, total = [], [], 0
+            for moment, row in generate_snapshots(companies, args.words, args.runs):
+                legacy.append(row)
+                series.extend(ddp.cloud_rows_to_series(conn, [row], ddp.to_epoch(moment)))
+                if len(legacy) >= 50000:
+                    conn.executemany("INSERT INTO cloud_tags (company, parse_date, word, frequency) VALUES (?, ?, ?, ?)", legacy)
+                    conn.executemany("INSERT OR REPLACE INTO cloud_series VALUES (?, ?, ?, ?)", series)
+                    total += len(legacy)
+                    legacy, series = [], []
+            conn.executemany("INSERT INTO cloud_tags (company, parse_date, word, frequency) VALUES (?, ?, ?, ?)", legacy)
+            conn.executemany("INSERT OR REPLACE INTO cloud_series VALUES (?, ?, ?, ?)", series)
+            total += len(legacy)
+            conn.commit()
+
+            def table_bytes(*names):
+                placeholders = ",".join("?" * len(names))
+                return conn.execute(f"SELECT SUM(pgsize) FROM dbstat WHERE name IN ({placeholders})", names).fetchone()[0]
+
+            try:
+                legacy_size = table_bytes("cloud_tags", "sqlite_sequence")
+                series_size = table_bytes("cloud_series", "idx_cloud_series_company_ts", "dict_words",
+                                          "dict_companies", "sqlite_autoindex_dict_words_1",
+                                          "sqlite_autoindex_dict_companies_1")
+            except sqlite3.OperationalError:
+                legacy_size = series_size = None
+
+        print(f"Строк облака: {total} ({len(companies)} компаний, {args.words} слов, {args.runs} запусков)")
+        if legacy_size:
+            print(f"Размер cloud_tags:   {legacy_size / 1024 / 1024:8.2f} МБ")
+            print(f"Размер cloud_series: {series_size / 1024 / 1024:8.2f} МБ (со словарями и индексом)")
+
+        company, word = companies[0], "слово7"
+        end = ddp.MSK.localize(datetime(2026, 1, 1)) + timedelta(hours=args.runs)
+        since = (end - timedelta(days=7)).strftime("%Y-%m-%d")
+
+        def legacy_trend():
+            with sqlite3.connect(ddp.DB_PATH) as c:
+                return c.execute("SELECT parse_date, AVG(frequency) FROM cloud_tags WHERE company = ? AND word = ? "
+                                 "GROUP BY parse_date ORDER BY parse_date", (company, word)).fetchall()
+
+        def legacy_top():
+            with sqlite3.connect(ddp.DB_PATH) as c:
+                return c.execute("SELECT word, AVG(frequency) AS f FROM cloud_tags WHERE company = ? AND parse_date >= ? "
+                                 "GROUP BY word ORDER BY f DESC LIMIT 20", (company, since)).fetchall()
+
+        print("Запросы:")
+        timed("тренд слова, cloud_tags", legacy_trend)
+        timed("тренд слова, cloud_series", lambda: ddp.word_trend(company, word))
+        timed("топ-20 за 7 дней, cloud_tags", legacy_top)
+        timed("топ-20 за 7 дней, cloud_series", lambda: ddp.top_words(company, since=since))
+        timed("рост за 24ч vs 7 дней, cloud_series", lambda: ddp.rising_words(company, now=end))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Сравнение append_to_csv (открытие файла на каждую пачку, один растущий файл)
+с CsvSink (открытые буферизованные файлы по дням): скорость записи
+и время чтения одного дня.
+
+Запуск: python benchmarks/bench_csv_sink.py [--days 30] [--batches-per-day 200] [--batch 20]
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import DownDetectorParser as ddp  # noqa: E402
+
+
+def generate_batches(days, batches_per_day, batch):
+    """Пачки строк сообщений, как их отдаёт parse_user_messages"""
+    rnd = random.Random(1)
+    for day in range(days):
+        date = f"2026-09-{day + 1:02d}" if day < 30 else f"2026-10-{day - 29:02d}"
+        for _ in range(batches_per_day):
+            service = rnd.choice(ddp.SERVICES)
+            yield [
+                [service, date, f"{rnd.randrange(24):02d}:{rnd.randrange(60):02d}:00", "Гость",
+                 "не работает приложение; " + "x" * rnd.randrange(10, 120)]
+                for _ in range(batch)
+            ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--batches-per-day", type=int, default=200)
+    parser.add_argument("--batch", type=int, default=20)
+    args = parser.parse_args()
+    batches = list(generate_batches(args.days, args.batches_per_day, args.batch))
+    total = sum(len(b) for b in batches)
+    headers = ddp.CSV_HEADERS["messages"]
+    probe_day = batches[len(batches) // 2][0][1]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_path = os.path.join(tmp, "user_messages.csv")
+        start = time.perf_counter()
+        for b in batches:
+            ddp.append_to_csv(legacy_path, b, headers)
+        legacy_write = time.perf_counter() - start
+
+        sink = ddp.CsvSink(root=os.path.join(tmp, "csv"))
+        start = time.perf_counter()
+        for b in batches:
+            sink.write("messages", b)
+        sink.close()
+        sink_write = time.perf_counter() - start
+
+        start = time.perf_counter()
+        df = pd.read_csv(legacy_path, sep=";", encoding="utf-8-sig")
+        legacy_day = df[df["Дата парсинга"] == probe_day]
+        legacy_read = time.perf_counter() - start
+
+        start = time.perf_counter()
+        sink_day = ddp.read_csv_partitions("messages", date_from=probe_day, date_to=probe_day,
+                                           root=os.path.join(tmp, "csv"))
+        sink_read = time.perf_counter() - start
+
+        assert len(df) == total == sum(
+            len(pd.read_csv(p, sep=";", encoding="utf-8-sig"))
+            for p in ddp.csv_partition_files("messages", root=os.path.join(tmp, "csv"))
+        )
+        assert len(legacy_day) == len(sink_day)
+
+    print(f"Строк: {total} в {len(batches)} пачках по {args.batch}")
+    print(f"Запись  append_to_csv: {legacy_write:7.2f} с ({total / legacy_write:10.0f} строк/с)")
+    print(f"Запись  CsvSink:       {sink_write:7.2f} с ({total / sink_write:10.0f} строк/с)")
+    print(f"Чтение дня {probe_day}, единый файл: {legacy_read * 1000:8.1f} мс")
+    print(f"Чтение дня {probe_day}, разделы:     {sink_read * 1000:8.1f} мс")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Поиск по комментариям на большом объёме: прежний запрос (глобальный MATCH по словам,
+фильтр компании и дат после JOIN, bm25 по всем совпадениям) против search_messages,
+где компания и дни входят в MATCH токенами колонки scope.
+
+Запуск: python benchmarks/bench_fts_search.py [--messages 2000000] [--days 365] [--companies 11]
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import DownDetectorParser as ddp  # noqa: E402
+
+# Частые слова жалоб и редкие — как в реальной ленте: "не", "работает" почти в каждом комментарии
+COMMON = ["не", "работает", "оплата", "связи", "нет", "интернет", "приложение", "опять", "сбой", "уже"]
+RARE = [f"редкое{i}" for i in range(2000)]
+
+LEGACY_SQL = '''
+    SELECT m.id, m.company, m.message_date, m.message_time, m.nickname, m.comment,
+           bm25(user_messages_fts) AS score
+    FROM user_messages_fts
+    JOIN user_messages m ON m.id = user_messages_fts.rowid
+    WHERE user_messages_fts MATCH ?
+'''
+
+
+def timed(label, func, repeat=5):
+    """Среднее время вызова func в миллисекундах"""
+    func()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    elapsed = (time.perf_counter() - start) / repeat * 1000
+    print(f"  {label:<52} {elapsed:9.2f} мс")
+    return elapsed
+
+
+def generate_messages(count, companies, days, first_day):
+    """Синтетические сообщения: 3–8 частых слов и одно редкое, компании с перекосом к первым"""
+    rnd = random.Random(42)
+    weights = [1 / (i + 1) for i in range(len(companies))]
+    for i in range(count):
+        words = rnd.sample(COMMON, rnd.randint(3, 8)) + [rnd.choice(RARE)]
+        rnd.shuffle(words)
+        day = first_day + timedelta(days=rnd.randrange(days))
+        yield (rnd.choices(companies, weights)[0], day.isoformat(), f"{rnd.randrange(24):02d}:{rnd.randrange(60):02d}",
+               f"user{i % 5000}", " ".join(words))
+
+
+def legacy_search(query, company=None, date_from=None, date_to=None, limit=50):
+    """Запрос search_messages до переноса фильтров в MATCH"""
+    sql, params = LEGACY_SQL, [ddp.build_fts_query(query)]
+    if company:
+        sql += " AND m.company = ?"
+        params.append(company)
+    if date_from:
+        sql += " AND m.message_date >= ?"
+        params.append(date_from)
+    if date_to:
+        sql += " AND m.message_date <= ?"
+        params.append(date_to)
+    sql += " ORDER BY score, m.id DESC LIMIT ?"
+    params.append(limit)
+    with sqlite3.connect(ddp.DB_PATH) as conn:
+        return conn.execute(sql, params).fetchall()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=2000000)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--companies", type=int, default=len(ddp.SERVICES))
+    args = parser.parse_args()
+    companies = ddp.SERVICES[:args.companies] or ddp.SERVICES
+    first_day = date(2025, 10, 1)
+    last_day = first_day + timedelta(days=args.days - 1)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        ddp.DB_PATH = os.path.join(tmp, "bench.db")
+        ddp.init_sqlite_tables()
+        started = time.perf_counter()
+        with sqlite3.connect(ddp.DB_PATH) as conn:
+            batch = []
+            for row in generate_messages(args.messages, companies, args.days, first_day):
+                batch.append(row)
+                if len(batch) >= 100000:
+                    conn.executemany("INSERT INTO user_messages (company, message_date, message_time, nickname, comment) "
+                                     "VALUES (?, ?, ?, ?, ?)", batch)
+                    ddp.sync_messages_fts(conn)
+                    conn.commit()
+                    batch = []
+            conn.executemany("INSERT INTO user_messages (company, message_date, message_time, nickname, comment) "
+                             "VALUES (?, ?, ?, ?, ?)", batch)
+            ddp.sync_messages_fts(conn)
+            conn.execute("INSERT INTO user_messages_fts (user_messages_fts) VALUES ('optimize')")
+            conn.commit()
+        print(f"Сообщений: {args.messages} ({len(companies)} компаний, {args.days} дней), "
+              f"загрузка и индекс {time.perf_counter() - started:.0f} с, "
+              f"база {os.path.getsize(ddp.DB_PATH) / 1024 / 1024:.0f} МБ")
+
+        # Крупнейшая и самая маленькая компании: при фильтре после MATCH обе стоят одинаково дорого
+        large, small = companies[0], companies[-1]
+        week_from = (last_day - timedelta(days=6)).isoformat()
+        month_from = (last_day - timedelta(days=29)).isoformat()
+        cases = [
+            ("частое слово, крупная компания, 7 дней", ("оплата", large, week_from, last_day.isoformat())),
+            ("частое слово, малая компания, 7 дней", ("оплата", small, week_from, last_day.isoformat())),
+            ("два частых слова, малая компания, 30 дней", ("не работает", small, month_from, None)),
+            ("редкое слово, малая компания, 30 дней", ("редкое7", small, month_from, None)),
+            ("частое слово, малая компания, всё время", ("оплата", small, None, None)),
+            ("частое слово, все компании, 7 дней", ("оплата", None, week_from, None)),
+        ]
+        print("Запросы (limit 50):")
+        for label, (query, comp, date_from, date_to) in cases:
+            legacy = timed(f"{label}, прежний", lambda: legacy_search(query, comp, date_from, date_to))
+            current = timed(f"{label}, scope в MATCH",
+                            lambda: ddp.search_messages(query, comp, date_from, date_to))
+            # Порядок bm25 у запросов разный (idf по разным спискам), поэтому сравниваются все совпадения
+            expected = {r[0] for r in legacy_search(query, comp, date_from, date_to, limit=-1)}
+            found = {r["id"] for r in ddp.search_messages(query, comp, date_from, date_to, limit=-1)}
+            same = f"совпадений {len(found)}" if found == expected else "НАБОРЫ СОВПАДЕНИЙ РАЗЛИЧАЮТСЯ"
+            print(f"  {'':<52} x{legacy / max(current, 1e-6):6.1f}, {same}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Сравнение однопроходного parse_histograms с прежней версией на BeautifulSoup
+(select + find_previous): совпадение результатов и время на больших страницах.
+
+Страницы: синтетические с --regions регионами/неполадками либо сохранённые HTML-файлы.
+
+Запуск: python benchmarks/bench_histograms.py [--regions 2000] [page.html ...]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import DownDetectorParser as ddp  # noqa: E402
+
+
+def parse_histograms_soup(html, service):
+    """Прежняя реализация: полный разбор BeautifulSoup и find_previous для каждого span"""
+    soup = BeautifulSoup(html, "html.parser")
+    hist_data = []
+    for span in soup.select("label span.region"):
+        percent = ddp.normalize_percent(span.get("data-pos", ""))
+        if percent is not None:
+            hist_data.append([service, ddp.RUN_DATE, "Регион", span.find_previous("a").text.strip(), percent])
+    for span in soup.select("label span.cause"):
+        percent = ddp.normalize_percent(span.get("data-pos", ""))
+        if percent is not None:
+            hist_data.append([service, ddp.RUN_DATE, "Неполадка", span.find_previous("a").text.strip(), percent])
+    for span in soup.select("div.os span[data-size]"):
+        text = span.text.strip()
+        if "%" in text:
+            raw, name = text.split("%", 1)
+            percent = ddp.normalize_percent(raw)
+            if percent is not None:
+                hist_data.append([service, ddp.RUN_DATE, "Устройство", name.strip(), percent])
+    return hist_data
+
+
+def synthetic_page(regions, seed=0):
+    """Страница в разметке detector404: списки регионов и неполадок, блок устройств, шум"""
+    rnd = random.Random(seed)
+    parts = ["<html><head><script>var x = '<a>не ссылка</a>';</script></head><body><div class='report'>"]
+    for i in range(regions // 4):
+        parts.append(f"<p>Комментарий {i} &amp; ещё текст <a href='#'>ссылка {i}</a><br></p>")
+    for kind in ("region", "cause"):
+        parts.append("<ul>")
+        for i in range(regions):
+            pos = f"{rnd.uniform(0, 100):.1f}".replace(".", rnd.choice([".", ","])) + "%"
+            parts.append(
+                f"<li><label><a href='/r/{i}'>{kind.title()} &laquo;{i}&raquo; <b>м</b></a>"
+                f"<span class='bar {kind}' data-pos='{pos}'></span></label></li>"
+            )
+        parts.append("</ul>")
+    parts.append("<div class='os'>")
+    for name in ("Android", "iOS", "Windows", "Другое"):
+        parts.append(f"<span data-size='x'>{rnd.randint(1, 60)}% <i>{name}</i></span><img src='x.png'>")
+    parts.append("</div></div></body></html>")
+    return "".join(parts)
+
+
+def timed(func, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--regions", type=int, default=2000)
+    parser.add_argument("pages", nargs="*", help="сохранённые HTML-страницы сервисов")
+    args = parser.parse_args()
+
+    pages = []
+    for path in args.pages:
+        with open(path, encoding="utf-8") as f:
+            pages.append((os.path.basename(path), f.read()))
+    if not pages:
+        for n in (args.regions // 10, args.regions // 2, args.regions):
+            pages.append((f"synthetic-{n}", synthetic_page(n, seed=n)))
+
+    for name, html in pages:
+        old_time, old_rows = timed(parse_histograms_soup, html, "sberbank")
+        new_time, new_batch = timed(ddp.parse_histograms, html, "sberbank")
+        new_rows = [list(row) for row in new_batch]
+        status = "совпадает" if old_rows == new_rows else "РАСХОЖДЕНИЕ"
+        print(f"{name:<20} {len(html) / 1024:8.0f} КБ, строк {len(new_rows):6d}: "
+              f"BeautifulSoup {old_time * 1000:9.1f} мс, один проход {new_time * 1000:8.1f} мс — {status}")
+        if old_rows != new_rows:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
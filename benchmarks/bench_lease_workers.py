@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Проверка распределения сервисов через sweep_jobs на одной машине:
+несколько локальных процессов-воркеров без браузера разбирают общую очередь,
+часть из них «падает» посреди сервиса (os._exit), а их сервисы после
+истечения аренды забирают оставшиеся воркеры.
+
+Запуск: python benchmarks/bench_lease_workers.py [--workers 4] [--services 40] [--crash-rate 0.1]
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import DownDetectorParser as ddp  # noqa: E402
+
+
+def configure(db_path):
+    ddp.DB_PATH = db_path
+    ddp.JOB_LEASE_SECONDS = 2
+    ddp.JOB_HEARTBEAT_SECONDS = 0.5
+    ddp.JOB_IDLE_POLL_SECONDS = 0.2
+
+
+def worker(db_path, worker_id, crash_rate, seed):
+    configure(db_path)
+    rnd = random.Random(seed)
+
+    def handle_service(service):
+        time.sleep(rnd.uniform(0.05, 0.3))
+        if rnd.random() < crash_rate:
+            print(f"[{worker_id}] имитация падения на {service}")
+            os._exit(1)
+        with sqlite3.connect(db_path, timeout=ddp.SQLITE_TIMEOUT) as conn:
+            conn.execute("INSERT INTO processed (service, worker) VALUES (?, ?)", (service, worker_id))
+
+    def finalize():
+        with sqlite3.connect(db_path, timeout=ddp.SQLITE_TIMEOUT) as conn:
+            conn.execute("INSERT INTO processed (service, worker) VALUES ('__report__', ?)", (worker_id,))
+
+    ddp.run_jobs(worker_id, handle_service, sweep_id="bench", finalize=finalize)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--services", type=int, default=40)
+    parser.add_argument("--crash-rate", type=float, default=0.1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "jobs.db")
+        configure(db_path)
+        ddp.init_sqlite_tables()
+        with sqlite3.connect(db_path) as conn:
+            conn.execute("CREATE TABLE processed (service TEXT, worker TEXT)")
+        services = [f"service-{i}" for i in range(args.services)]
+        ddp.enqueue_sweep("bench", services)
+
+        start = time.perf_counter()
+        procs = []
+        # Запасные воркеры без падений гарантируют, что очередь будет разобрана
+        for i in range(args.workers):
+            crash_rate = args.crash_rate if i < args.workers - 1 else 0.0
+            p = multiprocessing.Process(target=worker, args=(db_path, f"w{i}", crash_rate, i))
+            p.start()
+            procs.append(p)
+        for p in procs:
+            p.join()
+        elapsed = time.perf_counter() - start
+
+        with sqlite3.connect(db_path) as conn:
+            done = conn.execute("SELECT COUNT(DISTINCT service) FROM processed WHERE service != '__report__'").fetchone()[0]
+            reports = conn.execute("SELECT COUNT(*) FROM processed WHERE service = '__report__'").fetchone()[0]
+            retried = conn.execute("SELECT COUNT(*) FROM sweep_jobs WHERE attempts > 1").fetchone()[0]
+        crashed = sum(1 for p in procs if p.exitcode)
+        print(f"Воркеров {args.workers} (упало {crashed}), сервисов {args.services}: "
+              f"обработано {done}, переназначено {retried}, отчёт сформирован {reports} раз, {elapsed:.1f} с")
+        print(f"Итог: {ddp.sweep_status('bench')}")
+        if reports != 1:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
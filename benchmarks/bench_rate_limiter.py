@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Проверка HostRateLimiter на локальном сервере, который имитирует ограничение
+частоты: не более --server-rps запросов в секунду, сверх того — HTTP 429
+с Retry-After, а при перегрузке ответы замедляются.
+
+Несколько потоков-клиентов обращаются к серверу через http_request
+(общий лимитер) и без него; выводятся достигнутая частота и доля 429.
+С --processes N > 1 дополнительно нагружают N процессов с общим файлом
+состояния лимитера — как воркеры и дозагрузка.
+
+Запуск: python benchmarks/bench_rate_limiter.py [--server-rps 5] [--clients 4] [--seconds 20] [--processes 1]
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import DownDetectorParser as ddp  # noqa: E402
+
+
+class ThrottlingHandler(BaseHTTPRequestHandler):
+    """Сервер с собственным token bucket: превышение — 429, очередь — медленные ответы"""
+    lock = threading.Lock()
+    rps = 5.0
+    tokens = 5.0
+    updated = time.monotonic()
+
+    def do_GET(self):
+        cls = type(self)
+        with cls.lock:
+            now = time.monotonic()
+            cls.tokens = min(cls.rps, cls.tokens + (now - cls.updated) * cls.rps)
+            cls.updated = now
+            allowed = cls.tokens >= 1.0
+            if allowed:
+                cls.tokens -= 1.0
+            overload = cls.tokens < 1.0
+        if not allowed:
+            self.send_response(429)
+            self.send_header("Retry-After", "1")
+            self.end_headers()
+            return
+        if overload:
+            time.sleep(0.3)
+        body = b"ok"
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def run_clients(url, clients, seconds, limited):
+    """Нагрузка из нескольких потоков; возвращает (успешных, 429)"""
+    counts = {"ok": 0, "throttled": 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def worker():
+        session = requests.Session()
+        while time.monotonic() < deadline:
+            if limited:
+                status = ddp.http_request("GET", url, timeout=10).status_code
+            else:
+                status = session.get(url, timeout=10).status_code
+            with lock:
+                counts["ok" if status == 200 else "throttled"] += 1
+
+    threads = [threading.Thread(target=worker) for _ in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return counts["ok"], counts["throttled"]
+
+
+def make_limiter(state_path=None):
+    return ddp.HostRateLimiter(start_interval=1.0, min_interval=0.05, slow_seconds=0.25, state_path=state_path)
+
+
+def process_clients(url, clients, seconds, state_path, results):
+    ddp.RATE_LIMITER = make_limiter(state_path)
+    results.put(run_clients(url, clients, seconds, True))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--server-rps", type=float, default=5.0)
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=20.0)
+    parser.add_argument("--processes", type=int, default=1)
+    args = parser.parse_args()
+
+    ThrottlingHandler.rps = ThrottlingHandler.tokens = args.server_rps
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ThrottlingHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/sberbank"
+
+    try:
+        for limited in (False, True):
+            # Даём серверу восстановить запас токенов после предыдущего прогона
+            time.sleep(2)
+            ddp.RATE_LIMITER = make_limiter()
+            ok, throttled = run_clients(url, args.clients, args.seconds, limited)
+            total = ok + throttled
+            label = "с лимитером " if limited else "без лимитера"
+            print(f"{label}: {ok / args.seconds:6.2f} успешных/с, 429: {throttled} из {total} "
+                  f"({throttled / max(total, 1):.0%})")
+            if limited:
+                ddp.RATE_LIMITER.report_stats()
+        if args.processes > 1:
+            time.sleep(2)
+            with tempfile.TemporaryDirectory() as tmp:
+                results = multiprocessing.Queue()
+                procs = [multiprocessing.Process(target=process_clients,
+                                                 args=(url, args.clients, args.seconds,
+                                                       os.path.join(tmp, "rate_limits.json"), results))
+                         for _ in range(args.processes)]
+                for p in procs:
+                    p.start()
+                counts = [results.get() for _ in procs]
+                for p in procs:
+                    p.join()
+            ok = sum(c[0] for c in counts)
+            throttled = sum(c[1] for c in counts)
+            total = ok + throttled
+            print(f"{args.processes} процессов с общим лимитером: {ok / args.seconds:6.2f} успешных/с, "
+                  f"429: {throttled} из {total} ({throttled / max(total, 1):.0%})")
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Сравнение прежних строк-списков с RowBatch: память и число выделенных блоков
+(tracemalloc) на --rows строк каждого вида, а также пиковая память и время
+записи в SQLite и CSV (прежний append_to_csv через DataFrame против csv.writer).
+
+Запуск: python benchmarks/bench_row_batches.py [--rows 100000]
+"""
+
+import argparse
+import gc
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import DownDetectorParser as ddp  # noqa: E402
+
+
+def legacy_graph(n, start):
+    """Как прежний parse_graph_data: список на строку, дата и время строками"""
+    rows = []
+    for i in range(n):
+        dt = datetime.fromtimestamp(start - i * 60, ddp.MSK)
+        rows.append(["sberbank", dt.strftime("%Y-%m-%d"), dt.strftime("%H:%M:%S"), int(i % 500), float(i % 7)])
+    return rows
+
+
+def batch_graph(n, start):
+    rows = ddp.RowBatch("graph", "sberbank")
+    for i in range(n):
+        rows.append(start - i * 60, int(i % 500), float(i % 7))
+    return rows
+
+
+def legacy_hist(n, start):
+    return [["sberbank", ddp.RUN_DATE, "Регион", f"Регион {i % 300}", float(i % 100)] for i in range(n)]
+
+
+def batch_hist(n, start):
+    rows = ddp.RowBatch("hist", "sberbank")
+    for i in range(n):
+        rows.append("Регион", f"Регион {i % 300}", float(i % 100))
+    return rows
+
+
+def legacy_messages(n, start):
+    """Как прежний parse_ids_from_report: ник и текст — новые строки разбора, дата/время — strftime"""
+    rnd = random.Random(1)
+    rows = []
+    for i in range(n):
+        dt = datetime.fromtimestamp(start - i * 30, ddp.MSK)
+        rows.append(["sberbank", dt.strftime("%Y-%m-%d"), dt.strftime("%H:%M:%S"), "Гость".strip(),
+                     f"не работает приложение {rnd.randrange(1000)}", f"m{i}"])
+    return rows
+
+
+def batch_messages(n, start):
+    rnd = random.Random(1)
+    rows = ddp.RowBatch("messages", "sberbank")
+    for i in range(n):
+        rows.append(start - i * 30, "Гость".strip(), f"не работает приложение {rnd.randrange(1000)}", f"m{i}", None)
+    return rows
+
+
+def append_to_csv_dataframe(csv_path, data, headers):
+    """Прежний append_to_csv: копия строк в DataFrame на каждую пачку"""
+    df = pd.DataFrame([row[:len(headers)] for row in data], columns=headers)
+    if os.path.exists(csv_path):
+        df.to_csv(csv_path, mode='a', header=False, index=False, sep=';', encoding='utf-8-sig')
+    else:
+        df.to_csv(csv_path, index=False, sep=';', encoding='utf-8-sig')
+
+
+def measure(func, *args):
+    """(результат, удерживаемые байты, пик байт, живых блоков, секунды).
+
+    Время — отдельным прогоном без tracemalloc, который сильно замедляет выделения.
+    """
+    gc.collect()
+    start = time.perf_counter()
+    func(*args)
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.take_snapshot()
+    result = func(*args)
+    current, peak = tracemalloc.get_traced_memory()
+    stats = tracemalloc.take_snapshot().compare_to(base, "filename")
+    blocks = sum(max(stat.count_diff, 0) for stat in stats)
+    tracemalloc.stop()
+    return result, current, peak, blocks, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100000)
+    args = parser.parse_args()
+    n = args.rows
+    start = ddp.to_epoch(ddp.NOW)
+    kinds = (("graph", legacy_graph, batch_graph),
+             ("hist", legacy_hist, batch_hist),
+             ("messages", legacy_messages, batch_messages))
+
+    print(f"Строк каждого вида: {n}")
+    print(f"{'вид':<9}{'вариант':<10}{'удерживает':>12}{'пик':>10}{'блоков':>10}{'сборка':>10}")
+    for key, legacy, batched in kinds:
+        rows = {}
+        for label, func in (("списки", legacy), ("RowBatch", batched)):
+            rows[label], current, peak, blocks, elapsed = measure(func, n, start)
+            print(f"{key:<9}{label:<10}{current / n:>9.0f} Б/с{peak / 1024 / 1024:>7.1f} МБ"
+                  f"{blocks:>10}{elapsed:>8.2f} с")
+        assert [list(r)[:6] for r in rows["RowBatch"]] == [r[:6] for r in rows["списки"]]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            ddp.DB_PATH = os.path.join(tmp, "bench.db")
+            ddp.FTS_ENABLED = False
+            ddp.init_sqlite_tables()
+            table, headers = ddp.SQLITE_TABLES[key], ddp.CSV_HEADERS[key]
+            writers = (
+                ("SQLite", "списки", lambda: ddp.append_to_sqlite(table, rows["списки"])),
+                ("SQLite", "RowBatch", lambda: ddp.append_to_sqlite(table, rows["RowBatch"])),
+                ("CSV", "DataFrame", lambda: append_to_csv_dataframe(os.path.join(tmp, "old.csv"), rows["списки"], headers)),
+                ("CSV", "RowBatch", lambda: ddp.append_to_csv(os.path.join(tmp, "new.csv"), rows["RowBatch"], headers)),
+            )
+            for sink, label, func in writers:
+                _, _, peak, _, elapsed = measure(func)
+                print(f"  запись {sink:<7}{label:<10} пик {peak / 1024 / 1024:7.1f} МБ, {elapsed:6.2f} с")
+            assert (pd.read_csv(os.path.join(tmp, "old.csv"), sep=";", encoding="utf-8-sig")
+                    .equals(pd.read_csv(os.path.join(tmp, "new.csv"), sep=";", encoding="utf-8-sig")))
+
+
+if __name__ == "__main__":
+    main()